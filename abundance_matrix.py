@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Merge the per-sample results of a kraken2M run into one sparse
+# samples x taxa matrix of direct and clade read counts. It is built
+# from the <sample>out.txt files with the taxonomy loaded once (tally
+# and rollup of kreport_builder.py, in forked workers), or from the
+# kreports. The matrix is saved as a .npz of CSR arrays sharing one
+# sparsity pattern (the non-zero clade counts), with the taxon names in
+# a utf-8 blob and a CSR sub-matrix per rank code precomputed, so no
+# SciPy or pandas is needed to build or load it.
+#################################################################
+import argparse, os, re, sys, time, logging
+from argparse import ArgumentDefaultsHelpFormatter
+import numpy as np
+from kreport_builder import KTaxonomy, read_taxids
+from taxonomy_cache import StringTable, load_taxonomy_cache, taxonomy_pool, pool_taxonomy
+
+FORMAT_VERSION = 1
+# ranks with a precomputed sub-matrix
+ROLLUP_RANKS = ['D', 'K', 'P', 'C', 'O', 'F', 'G', 'S']
+
+def sample_name(path):
+    return re.sub(r'(kreport|out)\.txt$', '', os.path.basename(path))
+
+class AbundanceMatrix(object):
+    """Read counts of samples (rows) by taxa (columns) in CSR form.
+
+    Row i holds the columns indices[indptr[i]:indptr[i+1]] with their
+    clade and direct counts; a column is kept only where its clade count
+    is non-zero, so direct may hold zeros.
+    """
+    def __init__(self, samples, taxids, ranks, names, indptr, indices, direct, clade, unclassified):
+        self.samples = list(samples)
+        self.taxids = np.asarray(taxids, dtype = np.int64)
+        self.ranks = list(ranks)
+        self.names = names
+        self.indptr = np.asarray(indptr, dtype = np.int64)
+        self.indices = np.asarray(indices, dtype = np.int32)
+        self.direct = np.asarray(direct, dtype = np.int64)
+        self.clade = np.asarray(clade, dtype = np.int64)
+        self.unclassified = np.asarray(unclassified, dtype = np.int64)
+        self.rollups = dict()
+
+    @property
+    def shape(self):
+        return len(self.samples), len(self.taxids)
+
+    def totals(self):
+        """Reads per sample, unclassified included."""
+        classified = np.zeros(len(self.samples), dtype = np.int64)
+        np.add.at(classified, np.repeat(np.arange(len(self.samples)), np.diff(self.indptr)), self.direct)
+        return classified + self.unclassified
+
+    def dense(self, kind = 'clade', columns = None):
+        """Return a dense samples x columns array of 'clade' or 'direct' counts (all columns by default)."""
+        values = self.clade if kind == 'clade' else self.direct
+        out = np.zeros(self.shape, dtype = np.int64)
+        out[np.repeat(np.arange(len(self.samples)), np.diff(self.indptr)), self.indices] = values
+        return out if columns is None else out[:, columns]
+
+    def rank(self, code):
+        """Return (taxids, dense samples x taxa clade counts) of the taxa of one rank code, e.g. 'S'."""
+        if code in self.rollups:
+            cols, indptr, indices, data = self.rollups[code]
+            out = np.zeros((len(self.samples), len(cols)), dtype = np.int64)
+            out[np.repeat(np.arange(len(self.samples)), np.diff(indptr)), indices] = data
+            return self.taxids[cols], out
+        cols = np.array([j for j, r in enumerate(self.ranks) if r == code], dtype = np.int64)
+        return self.taxids[cols], self.dense('clade', cols)
+
+    def compute_rollups(self):
+        """Precompute the CSR sub-matrix of the clade counts of every rank in ROLLUP_RANKS."""
+        rowOf = np.repeat(np.arange(len(self.samples)), np.diff(self.indptr))
+        ranks = np.array(self.ranks)
+        for code in ROLLUP_RANKS:
+            cols = np.nonzero(ranks == code)[0]
+            if not len(cols):
+                continue
+            remap = np.full(len(self.taxids), -1, dtype = np.int64)
+            remap[cols] = np.arange(len(cols))
+            keep = remap[self.indices] >= 0
+            indptr = np.zeros(len(self.samples) + 1, dtype = np.int64)
+            np.cumsum(np.bincount(rowOf[keep], minlength = len(self.samples)), out = indptr[1:])
+            self.rollups[code] = (cols, indptr, remap[self.indices[keep]].astype(np.int32), self.clade[keep])
+
+    def save(self, path):
+        if not self.rollups:
+            self.compute_rollups()
+        sampleTable = StringTable.build(self.samples)
+        rankTable = StringTable.build(self.ranks)
+        nameTable = StringTable.build([self.names[j] for j in range(len(self.taxids))])
+        arrays = {'version': np.array([FORMAT_VERSION]), 'taxids': self.taxids, 'indptr': self.indptr, 'indices': self.indices,
+                  'direct': self.direct, 'clade': self.clade, 'unclassified': self.unclassified,
+                  'sampleBlob': sampleTable.blob, 'sampleOffsets': sampleTable.offsets,
+                  'rankBlob': rankTable.blob, 'rankOffsets': rankTable.offsets,
+                  'nameBlob': nameTable.blob, 'nameOffsets': nameTable.offsets}
+        for code, (cols, indptr, indices, data) in self.rollups.items():
+            arrays.update({code + '_columns': cols, code + '_indptr': indptr, code + '_indices': indices, code + '_clade': data})
+        # np.savez adds .npz to names without it, write to a .npz temporary name and rename
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as z:
+            if int(z['version'][0]) != FORMAT_VERSION:
+                raise ValueError(path + ' was written by another version of abundance_matrix.py.')
+            samples = StringTable(z['sampleBlob'], z['sampleOffsets'])
+            ranks = StringTable(z['rankBlob'], z['rankOffsets'])
+            m = cls([samples[i] for i in range(len(samples))], z['taxids'], [ranks[j] for j in range(len(ranks))],
+                    StringTable(z['nameBlob'], z['nameOffsets']), z['indptr'], z['indices'], z['direct'], z['clade'], z['unclassified'])
+            for code in ROLLUP_RANKS:
+                if code + '_columns' in z:
+                    m.rollups[code] = (z[code + '_columns'], z[code + '_indptr'], z[code + '_indices'], z[code + '_clade'])
+        return m
+
+    def write_tsv(self, path, code = None, kind = 'clade'):
+        """Write a taxa x samples table of one rank (or of all taxa), the layout the per-sample kreports were merged into."""
+        if code is None:
+            cols = np.arange(len(self.taxids))
+        else:
+            cols = np.array([j for j, r in enumerate(self.ranks) if r == code], dtype = np.int64)
+        table = self.dense(kind, cols)
+        with open(path, 'w') as f:
+            f.write('taxid\trank\tname\t' + '\t'.join(self.samples) + '\n')
+            for k, j in enumerate(cols):
+                f.write(str(self.taxids[j]) + '\t' + self.ranks[j] + '\t' + self.names[j] + '\t' + '\t'.join(map(str, table[:, k])) + '\n')
+
+def _stack(samples, perSample, taxids, ranks, names):
+    """Make the matrix from per-sample (columns, direct, clade, unclassified), columns indexing taxids."""
+    indptr = np.zeros(len(samples) + 1, dtype = np.int64)
+    np.cumsum([len(p[0]) for p in perSample], out = indptr[1:])
+    def cat(k, dtype):
+        return np.concatenate([p[k] for p in perSample]).astype(dtype) if perSample else np.zeros(0, dtype = dtype)
+    return AbundanceMatrix(samples, taxids, ranks, names, indptr, cat(0, np.int32), cat(1, np.int64), cat(2, np.int64),
+                           [p[3] for p in perSample])
+
+def sample_counts(taxonomy, krakenOut):
+    """Return (nodes with reads in their clade, direct counts, clade counts, unclassified) of one Kraken2 output file."""
+    taxids = read_taxids(krakenOut)
+    unclassified = int(np.count_nonzero(taxids == 0))
+    counts, missing = taxonomy.tally(taxids[taxids != 0])
+    if missing:
+        logging.warning(os.path.basename(krakenOut) + ': ' + str(missing) + ' reads assigned to taxids missing from the taxonomy.')
+    clade = taxonomy.rollup(counts)
+    nodes = np.nonzero(clade)[0]
+    return nodes, counts[nodes], clade[nodes], unclassified
+
+def _sample_counts_job(path):
+    return sample_counts(pool_taxonomy(), path)
+
+def matrix_from_outputs(taxonomy, paths, threads = 1, pool = None):
+    """Build the matrix of Kraken2 output files, in pool (a taxonomy_pool of taxonomy) or forked workers when threads > 1."""
+    if pool is not None:
+        perSample = pool.map(_sample_counts_job, paths, chunksize = 1)
+    elif threads > 1 and len(paths) > 1:
+        with taxonomy_pool(taxonomy, min(threads, len(paths))) as p:
+            perSample = p.map(_sample_counts_job, paths, chunksize = 1)
+    else:
+        perSample = [sample_counts(taxonomy, p) for p in paths]
+    # columns are the nodes seen in any sample, in taxonomy order
+    nodes = np.unique(np.concatenate([p[0] for p in perSample])) if perSample else np.zeros(0, dtype = np.int64)
+    perSample = [(np.searchsorted(nodes, n), d, c, u) for n, d, c, u in perSample]
+    return _stack([sample_name(p) for p in paths], perSample, taxonomy.taxids[nodes],
+                  [taxonomy.ranks[int(i)] for i in nodes], [taxonomy.names[int(i)] for i in nodes])
+
+def read_kreport(path):
+    """Return the taxids, direct and clade counts, rank codes and names of a kreport, and its unclassified count."""
+    taxids, direct, clade, ranks, names = [], [], [], [], []
+    unclassified = 0
+    with open(path) as f:
+        for line in f:
+            vals = line.rstrip('\n').split('\t')
+            if len(vals) < 6:
+                continue
+            if vals[3] == 'U':
+                unclassified = int(vals[1])
+                continue
+            clade.append(int(vals[1]))
+            direct.append(int(vals[2]))
+            ranks.append(vals[3])
+            taxids.append(int(vals[4]))
+            names.append(vals[5].strip())
+    return np.array(taxids, dtype = np.int64), np.array(direct, dtype = np.int64), np.array(clade, dtype = np.int64), ranks, names, unclassified
+
+def matrix_from_kreports(paths):
+    """Build the matrix of kreports, for runs made without a taxonomy at hand."""
+    reports = [read_kreport(p) for p in paths]
+    allTaxids = np.unique(np.concatenate([r[0] for r in reports])) if reports else np.zeros(0, dtype = np.int64)
+    ranks, names = [''] * len(allTaxids), [''] * len(allTaxids)
+    perSample = []
+    for taxids, direct, clade, r, n, unclassified in reports:
+        cols = np.searchsorted(allTaxids, taxids)
+        for j, rank, name in zip(cols.tolist(), r, n):
+            ranks[j], names[j] = rank, name
+        srt = np.argsort(cols, kind = 'stable')
+        perSample.append((cols[srt], direct[srt], clade[srt], unclassified))
+    return _stack([sample_name(p) for p in paths], perSample, allTaxids, ranks, names)
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'abundance_matrix',
+                                     description = 'Merge per-sample Kraken2 outputs or kreports into one sparse samples x taxa matrix.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', type = str, nargs = '+', default = None,
+                        help = '<sample>out.txt files (needs -t or -d) or <sample>kreport.txt files.')
+    parser.add_argument('-t', '--taxonomy', type = str, default = None,
+                        help = 'The taxonomy file made by make_ktaxonomy.py.')
+    parser.add_argument('-d', '--db', type = str, default = None,
+                        help = 'A Kraken2 DB with taxonomy/nodes.dmp, whose taxonomy cache is used.')
+    parser.add_argument('-o', '--output', type = str, default = 'abundance_matrix.npz',
+                        help = 'The matrix to write, or to read with --tsv and no -i.')
+    parser.add_argument('-p', '--processes', type = int, default = 1,
+                        help = 'Number of worker processes.')
+    parser.add_argument('--tsv', type = str, default = None,
+                        help = 'Also write a taxa x samples table of clade counts to this file.')
+    parser.add_argument('--rank', type = str, default = None,
+                        help = 'Limit the --tsv table to one rank code, e.g. S or G.')
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s > %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S')
+    t0 = time.time()
+    if opt.input:
+        if all(p.endswith('kreport.txt') for p in opt.input):
+            matrix = matrix_from_kreports(opt.input)
+        elif opt.db or opt.taxonomy:
+            taxonomy = load_taxonomy_cache(opt.db) if opt.db else KTaxonomy.from_ktaxonomy(opt.taxonomy)
+            matrix = matrix_from_outputs(taxonomy, opt.input, opt.processes)
+        else:
+            parser.error('Kraken2 output files need the taxonomy, give -t or -d.')
+        matrix.save(opt.output)
+        logging.info(str(matrix.shape[0]) + ' samples x ' + str(matrix.shape[1]) + ' taxa (' + str(len(matrix.indices)) + ' non-zero) saved to ' + opt.output + ' in ' + '{:.2f}'.format(time.time() - t0) + ' s')
+    else:
+        matrix = AbundanceMatrix.load(opt.output)
+        logging.info('Loaded ' + str(matrix.shape[0]) + ' samples x ' + str(matrix.shape[1]) + ' taxa in ' + '{:.2f}'.format(time.time() - t0) + ' s')
+    if opt.tsv:
+        matrix.write_tsv(opt.tsv, opt.rank)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Compare two snapshots written by deal_with_assembly_summary.py (its
+# --output directories) table by table: <set>_<domain>_assembly_summary.txt
+# and the _rep_ subsets. Assemblies are matched by their integer acc9
+# with a hash join, and every difference is one line of
+# <output>/<set>_<domain>[_rep]_diff.txt:
+#   added     acc9 only in the new snapshot
+#   removed   acc9 only in the old snapshot
+#   version   a newer (or older) version of the assembly
+#   accession same version, other accession, i.e. GCA in one snapshot and GCF in the other
+#   category  refseq_category changed
+# The lines of the new table that have to be fetched again (added,
+# version, accession) are copied to <set>_<domain>[_rep]_changed_assembly_summary.txt,
+# and the counts of every table go to diff_summary.txt.
+#################################################################
+import argparse, os, re, sys, time, logging
+from argparse import ArgumentDefaultsHelpFormatter
+import numpy as np
+import pandas as pd
+from assembly_summary import load_summary, write_rows
+
+TABLE_RE = re.compile(r'^(rsgb|refseq|genbank)_(.+?)(_rep)?_assembly_summary\.txt$')
+CHANGES = ['added', 'removed', 'version', 'accession', 'category']
+# the changes after which the genome of the new snapshot has to be added to the library
+FETCH = ['added', 'version', 'accession']
+KEEP = ['acc9', 'version', 'assembly_accession', 'refseq_category', 'taxid', 'species_taxid', 'row']
+
+def snapshot_tables(snapshot, setType):
+    """Return {table name: path} of the merged tables of a snapshot, e.g. rsgb_viral and rsgb_viral_rep."""
+    asDir = os.path.join(snapshot, 'assembly_summary')
+    tables = dict()
+    for f in sorted(os.listdir(asDir)):
+        m = TABLE_RE.match(f)
+        if m and m.group(1) == setType:
+            tables[f[:-len('_assembly_summary.txt')]] = os.path.join(asDir, f)
+    return tables
+
+def unique_acc9(df, name):
+    dup = df['acc9'].duplicated()
+    if dup.any():
+        # refseq comes first in the merged tables, so its line is kept
+        logging.warning(name + ': ' + str(int(dup.sum())) + ' assemblies share their acc9 with an earlier line and are ignored.')
+        df = df[~dup]
+    return df
+
+def diff_tables(old, new, name = ''):
+    """Join two parsed tables on acc9, returns a DataFrame of the differences with a change column."""
+    old = unique_acc9(old, name + ' (old)')[KEEP]
+    new = unique_acc9(new, name + ' (new)')[KEEP]
+    m = old.merge(new, on = 'acc9', how = 'outer', suffixes = ('_old', '_new'), indicator = True)
+    both = m['_merge'] == 'both'
+    kinds = {'added': m['_merge'] == 'right_only',
+             'removed': m['_merge'] == 'left_only',
+             'version': both & (m['version_old'] != m['version_new']),
+             'accession': both & (m['version_old'] == m['version_new']) & (m['assembly_accession_old'] != m['assembly_accession_new']),
+             'category': both & (m['refseq_category_old'].astype(str) != m['refseq_category_new'].astype(str))}
+    parts = []
+    for c in CHANGES:
+        part = m[kinds[c].to_numpy()]
+        parts.append(pd.DataFrame({'change': c,
+                                   'acc9': part['acc9'],
+                                   'old_accession': part['assembly_accession_old'],
+                                   'new_accession': part['assembly_accession_new'],
+                                   'old_category': part['refseq_category_old'].astype(object),
+                                   'new_category': part['refseq_category_new'].astype(object),
+                                   # the taxids of the new line, of the old one for removed assemblies
+                                   'taxid': part['taxid_new'].fillna(part['taxid_old']).astype(np.int64),
+                                   'species_taxid': part['species_taxid_new'].fillna(part['species_taxid_old']).astype(np.int64),
+                                   'new_row': part['row_new'].fillna(-1).astype(np.int64)}))
+    res = pd.concat(parts, ignore_index = True)
+    res['change'] = pd.Categorical(res['change'], CHANGES)
+    return res.sort_values(['change', 'acc9'], kind = 'stable').reset_index(drop = True)
+
+def diff_snapshots(oldDir, newDir, outDir, setType = 'rsgb', domains = None):
+    """Diff every table found in both snapshots into outDir, returns the summary DataFrame."""
+    t0 = time.time()
+    os.makedirs(outDir, exist_ok = True)
+    oldTables = snapshot_tables(oldDir, setType)
+    newTables = snapshot_tables(newDir, setType)
+    names = [n for n in newTables if n in oldTables]
+    if domains:
+        names = [n for n in names if re.sub(r'_rep$', '', n[len(setType) + 1:]) in domains]
+    for n in sorted(set(oldTables) ^ set(newTables)):
+        logging.warning(n + ' is only in the ' + ('old' if n in oldTables else 'new') + ' snapshot, not compared.')
+    summary = []
+    for n in names:
+        old = load_summary(oldTables[n], os.path.join(oldDir, 'assembly_summary', 'cache'))
+        new = load_summary(newTables[n], os.path.join(newDir, 'assembly_summary', 'cache'))
+        d = diff_tables(old, new, n)
+        d.drop(columns = 'new_row').to_csv(os.path.join(outDir, n + '_diff.txt'), sep = '\t', index = False)
+        fetch = d['new_row'][d['change'].isin(FETCH)]
+        write_rows(os.path.join(outDir, n + '_changed_assembly_summary.txt'), [(newTables[n], np.sort(fetch.to_numpy()))])
+        counts = d['change'].value_counts()
+        summary.append(dict([('table', n), ('old', len(old)), ('new', len(new))] + [(c, int(counts[c])) for c in CHANGES] +
+                            [('to_fetch', len(fetch))]))
+        logging.info(n + ': ' + ', '.join(str(int(counts[c])) + ' ' + c for c in CHANGES))
+    summary = pd.DataFrame(summary, columns = ['table', 'old', 'new'] + CHANGES + ['to_fetch'])
+    summary.to_csv(os.path.join(outDir, 'diff_summary.txt'), sep = '\t', index = False)
+    logging.info(str(len(names)) + ' tables compared in ' + '{:.2f}'.format(time.time() - t0) + ' s, saved to ' + outDir)
+    return summary
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'assembly_diff',
+                                     description = 'Compare the merged assembly summaries of two deal_with_assembly_summary.py snapshots.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-a', '--old', type = str, required = True,
+                        help = 'The --output directory of the older snapshot.')
+    parser.add_argument('-b', '--new', type = str, required = True,
+                        help = 'The --output directory of the newer snapshot.')
+    parser.add_argument('-o', '--output', type = str, default = None,
+                        help = 'A directory for the differences, <new>/assembly_summary/diff by default.')
+    parser.add_argument('-s', '--set', type = str, default = 'rsgb', choices = ['rsgb', 'refseq', 'genbank'],
+                        help = 'The --set of both snapshots.')
+    parser.add_argument('-d', '--domain', type = str, nargs = '*', default = None,
+                        help = 'Only compare these domains, all of them by default.')
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s > %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S')
+    outDir = opt.output or os.path.join(opt.new, 'assembly_summary', 'diff')
+    summary = diff_snapshots(opt.old, opt.new, outDir, opt.set, opt.domain)
+    print(summary.to_string(index = False))
+
+if __name__ == '__main__':
+    main()
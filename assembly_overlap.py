@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Overlap of refseq, genbank and the representative genomes of every
+# domain in deal_with_assembly_summary.py, for acc9, taxid and
+# species_taxid. The counts of every region of the Venn diagrams are
+# taken from sorted unique integer arrays (np.unique/np.intersect1d)
+# and saved as a table, one line per domain, key and region:
+#   domain  key  venn  region  count
+# where venn is rs_gb (regions 10, 01, 11 for refseq, genbank) or
+# rs_gb_rep (regions 100 ... 111, refseq, genbank, representative),
+# the subset ids of matplotlib_venn. The diagrams are drawn from the
+# table only when asked, one PDF per domain in parallel workers, and
+# matplotlib is imported in those workers alone.
+#################################################################
+import argparse, os, sys, time, logging
+import multiprocessing
+from argparse import ArgumentDefaultsHelpFormatter
+import numpy as np
+
+KEYS = ['acc9', 'taxid', 'species_taxid']
+VENN2 = ['10', '01', '11']
+VENN3 = ['100', '010', '110', '001', '101', '011', '111']
+COLORS = ('#80B1D3', '#FDB462', '#B3DE68')
+
+def overlap_counts(rs, gb, rep = None):
+    """Return the region counts of the Venn diagram of 2 or 3 integer arrays, in matplotlib_venn order."""
+    a, b = np.unique(rs), np.unique(gb)
+    ab = len(np.intersect1d(a, b, assume_unique = True))
+    if rep is None:
+        return [len(a) - ab, len(b) - ab, ab]
+    c = np.unique(rep)
+    abc = len(np.intersect1d(np.intersect1d(a, b, assume_unique = True), c, assume_unique = True))
+    ac = len(np.intersect1d(a, c, assume_unique = True))
+    bc = len(np.intersect1d(b, c, assume_unique = True))
+    return [len(a) - ab - ac + abc, len(b) - ab - bc + abc, ab - abc, len(c) - ac - bc + abc, ac - abc, bc - abc, abc]
+
+def domain_overlaps(domain, rsDF, gbDF, repDF):
+    """Return the table lines (domain, key, venn, region, count) of a domain."""
+    rows = []
+    for key in KEYS:
+        rs, gb, rep = rsDF[key].to_numpy(), gbDF[key].to_numpy(), repDF[key].to_numpy()
+        rows += [(domain, key, 'rs_gb', r, n) for r, n in zip(VENN2, overlap_counts(rs, gb))]
+        rows += [(domain, key, 'rs_gb_rep', r, n) for r, n in zip(VENN3, overlap_counts(rs, gb, rep))]
+    return rows
+
+def write_overlaps(path, rows):
+    with open(path + '.tmp', 'w') as f:
+        f.write('domain\tkey\tvenn\tregion\tcount\n')
+        for row in rows:
+            f.write('\t'.join(str(x) for x in row) + '\n')
+    os.replace(path + '.tmp', path)
+
+def read_overlaps(path):
+    """Return {domain: {(key, venn): [counts in region order]}} of an overlap table."""
+    res = dict()
+    with open(path) as f:
+        next(f)
+        for line in f:
+            domain, key, venn, _, n = line.rstrip('\n').split('\t')
+            res.setdefault(domain, dict()).setdefault((key, venn), []).append(int(n))
+    return res
+
+def plot_domain(job):
+    """Draw the 6 Venn diagrams of a domain into a PDF, returns its path."""
+    domain, counts, pdfPath = job
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    from matplotlib_venn import venn2_circles, venn2_unweighted, venn3_circles, venn3_unweighted
+    fig, axs = plt.subplots(1, 6, figsize = (24, 4), dpi = 150)
+    for j, key in enumerate(KEYS):
+        venn2_unweighted(subsets = counts[(key, 'rs_gb')], set_labels = ('RefSeq', 'GenBank'), set_colors = COLORS[:2],
+                         alpha = 0.6, normalize_to = 1.0, ax = axs[j])
+        venn2_circles(subsets = (1, 1, 1), ax = axs[j], linewidth = 0.7, linestyle = 'dashed')
+        venn3_unweighted(subsets = counts[(key, 'rs_gb_rep')], set_labels = ('RefSeq', 'GenBank', 'Representative'),
+                         set_colors = COLORS, alpha = 0.6, normalize_to = 1.0, ax = axs[j + 3])
+        venn3_circles(subsets = (1, 1, 1, 1, 1, 1, 1), ax = axs[j + 3], linewidth = 0.7, linestyle = 'dashed')
+        title = domain.capitalize() + ' ' + ('accession' if key == 'acc9' else key)
+        axs[j].title.set_text(title)
+        axs[j + 3].title.set_text(title)
+    fig.savefig(pdfPath)
+    plt.close(fig)
+    return pdfPath
+
+def plot_overlaps(tablePath, prefix, domains = None, processes = None):
+    """Draw <prefix>_<domain>_venn.pdf for the domains of an overlap table, returns the paths."""
+    t0 = time.time()
+    table = read_overlaps(tablePath)
+    jobs = [(d, table[d], prefix + '_' + d + '_venn.pdf') for d in (domains or table)]
+    processes = min(processes or os.cpu_count() or 1, len(jobs))
+    if processes > 1:
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            paths = pool.map(plot_domain, jobs, chunksize = 1)
+    else:
+        paths = [plot_domain(j) for j in jobs]
+    logging.info(str(len(paths)) + ' Venn diagrams drawn in ' + '{:.2f}'.format(time.time() - t0) + ' s')
+    return paths
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'assembly_overlap',
+                                     description = 'Draw the Venn diagrams of an overlap table of deal_with_assembly_summary.py.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', type = str, required = True,
+                        help = 'The overlap table, <output>/assembly_summary/stat/<set>_overlap.txt.')
+    parser.add_argument('-o', '--output', type = str, required = True,
+                        help = 'Prefix of the PDFs, <prefix>_<domain>_venn.pdf.')
+    parser.add_argument('-d', '--domain', type = str, nargs = '*', default = None,
+                        help = 'Only draw these domains, all of them by default.')
+    parser.add_argument('-p', '--processes', type = int, default = None,
+                        help = 'Number of worker processes, one per domain up to the number of CPUs by default.')
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s > %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S')
+    for p in plot_overlaps(opt.input, opt.output, opt.domain, opt.processes):
+        logging.info(p)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Load NCBI assembly_summary.txt tables for deal_with_assembly_summary.py
+# with only the columns it uses: categorical dtypes for the status
+# columns, integers for the taxids and the accession split into acc9
+# (the 9 digits, int64), version and GCA/GCF prefix with vectorized
+# string slicing. The row number of every assembly in the file is
+# kept, so subsets can be written back with all their columns by
+# copying the original lines. The parsed table is cached in
+# <cache>/<md5>.v1.feather (pickle without pyarrow), keyed by the md5
+# of the source file, and the md5 itself is remembered by path, size
+# and mtime so an unchanged file is not hashed again.
+#################################################################
+import argparse, os, sys, json, time, hashlib, logging
+import importlib.util
+from argparse import ArgumentDefaultsHelpFormatter
+import numpy as np
+import pandas as pd
+
+CACHE_VERSION = 1
+CATEGORIES = ['refseq_category', 'version_status', 'assembly_level', 'release_type', 'genome_rep', 'paired_asm_comp']
+INTEGERS = ['taxid', 'species_taxid']
+STRINGS = ['assembly_accession', 'gbrs_paired_asm', 'ftp_path']
+REPRESENTATIVE = ['representative genome', 'reference genome']
+
+# feather needs pyarrow, which is optional
+CACHE_FORMAT = 'feather' if importlib.util.find_spec('pyarrow') is not None else 'pkl'
+
+def header_line(path):
+    """Return (line number, column names) of the header, the '#' line naming assembly_accession."""
+    with open(path, encoding = 'utf-8') as f:
+        for i, line in enumerate(f):
+            if not line.startswith('#'):
+                break
+            names = [c.strip() for c in line.lstrip('#').rstrip('\n').split('\t')]
+            if names and names[0] == 'assembly_accession':
+                return i, names
+    raise ValueError(path + ' has no assembly_accession header line.')
+
+def file_md5(path, blockSize = 16 * 1024 * 1024):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blockSize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def cached_md5(path, cacheDir):
+    """The md5 of path, taken from cacheDir/md5.json while its size and mtime do not change."""
+    memoPath = os.path.join(cacheDir, 'md5.json')
+    try:
+        with open(memoPath) as f:
+            memo = json.load(f)
+    except (OSError, ValueError):
+        memo = dict()
+    st = os.stat(path)
+    key = os.path.abspath(path)
+    entry = memo.get(key)
+    if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+        return entry['md5']
+    md5 = file_md5(path)
+    memo[key] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'md5': md5}
+    tmp = memoPath + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(memo, f, indent = 1)
+    os.replace(tmp, memoPath)
+    if entry and entry['md5'] != md5 and entry['md5'] not in [e['md5'] for e in memo.values()]:
+        # no file known to the cache has the old content any more
+        for fmt in ('feather', 'pkl'):
+            old = cache_path(cacheDir, entry['md5'], fmt)
+            if os.path.isfile(old):
+                os.remove(old)
+    return md5
+
+def split_accessions(acc):
+    """Split a bytes array of accessions (GCF_000001405.39) into acc9, version, prefix code (0 GCA, 1 GCF) and a valid mask."""
+    width = acc.dtype.itemsize
+    if width < 15:
+        acc = acc.astype('S15')
+        width = 15
+    # one row of characters per accession, 0 after its end
+    m = acc.view(np.uint8).reshape(len(acc), width)
+    digits = m[:, 4:13].astype(np.int64) - ord('0')
+    ok = ((m[:, 0] == ord('G')) & (m[:, 1] == ord('C')) & ((m[:, 2] == ord('A')) | (m[:, 2] == ord('F'))) &
+          (m[:, 3] == ord('_')) & (m[:, 13] == ord('.')) & ((digits >= 0) & (digits <= 9)).all(axis = 1))
+    acc9 = digits @ (10 ** np.arange(8, -1, -1, dtype = np.int64))
+    vd = m[:, 14:].astype(np.int64) - ord('0')
+    isDigit = (vd >= 0) & (vd <= 9)
+    ok &= isDigit[:, 0] & (isDigit | (m[:, 14:] == 0)).all(axis = 1)
+    version = np.zeros(len(acc), dtype = np.int64)
+    for j in range(vd.shape[1]):
+        version = np.where(isDigit[:, j], version * 10 + vd[:, j], version)
+    return np.where(ok, acc9, -1), version.astype(np.int16), (m[:, 2] == ord('F')).astype(np.int8), ok
+
+def parse_summary(path):
+    """Read the columns of an assembly summary that are used, with compact dtypes, plus acc9/version/prefix/row."""
+    skip, names = header_line(path)
+    usecols = [c for c in STRINGS + INTEGERS + CATEGORIES if c in names]
+    dtype = dict([(c, 'category') for c in CATEGORIES] + [(c, str) for c in STRINGS])
+    df = pd.read_csv(path, sep = '\t', skiprows = skip + 1, header = None, names = names, usecols = usecols,
+                     dtype = dtype, quoting = 3, na_filter = False, engine = 'c')
+    for c in INTEGERS:
+        if c in df:
+            df[c] = pd.to_numeric(df[c], downcast = 'integer')
+    acc9, version, prefix, ok = split_accessions(df['assembly_accession'].to_numpy(dtype = 'S'))
+    if not ok.all():
+        logging.warning(os.path.basename(path) + ': ' + str(int((~ok).sum())) + ' malformed accessions are dropped, e.g. ' +
+                        df['assembly_accession'][~ok].iloc[0])
+    df['acc9'] = acc9
+    df['version'] = version
+    df['prefix'] = pd.Categorical.from_codes(prefix, ['GCA', 'GCF'])
+    # position of the assembly among the data lines, for copying the original line later
+    df['row'] = np.arange(len(df), dtype = np.int64)
+    return df[ok].reset_index(drop = True) if not ok.all() else df
+
+def cache_path(cacheDir, md5, fmt = CACHE_FORMAT):
+    # named after the content, so copies of a file share one cached table
+    return os.path.join(cacheDir, md5 + '.v' + str(CACHE_VERSION) + '.' + fmt)
+
+def load_summary(path, cacheDir = None):
+    """Return the parsed table of an assembly summary, from the cache when the file did not change."""
+    t0 = time.time()
+    if cacheDir is None:
+        return parse_summary(path)
+    os.makedirs(cacheDir, exist_ok = True)
+    md5 = cached_md5(path, cacheDir)
+    cached = cache_path(cacheDir, md5)
+    if os.path.isfile(cached):
+        df = pd.read_feather(cached) if CACHE_FORMAT == 'feather' else pd.read_pickle(cached)
+        logging.info(os.path.basename(path) + ': ' + str(len(df)) + ' assemblies loaded from the cache in ' + '{:.2f}'.format(time.time() - t0) + ' s')
+        return df
+    df = parse_summary(path)
+    tmp = cached + '.tmp'
+    if CACHE_FORMAT == 'feather':
+        df.to_feather(tmp)
+    else:
+        df.to_pickle(tmp, compression = None)
+    os.replace(tmp, cached)
+    logging.info(os.path.basename(path) + ': ' + str(len(df)) + ' assemblies parsed and cached in ' + '{:.2f}'.format(time.time() - t0) + ' s')
+    return df
+
+def write_rows(outPath, parts):
+    """Write the header of the first file and the data lines at the given rows of each (path, rows) in parts."""
+    with open(outPath + '.tmp', 'w', encoding = 'utf-8') as out:
+        for k, (path, rows) in enumerate(parts):
+            skip, _ = header_line(path)
+            wanted = np.zeros(0, dtype = bool)
+            if len(rows):
+                wanted = np.zeros(int(np.max(rows)) + 1, dtype = bool)
+                wanted[np.asarray(rows, dtype = np.int64)] = True
+            with open(path, encoding = 'utf-8') as f:
+                for i, line in enumerate(f):
+                    if i == skip and k == 0:
+                        out.write(line)
+                    elif i > skip:
+                        j = i - skip - 1
+                        if j >= len(wanted):
+                            break
+                        if wanted[j]:
+                            out.write(line)
+    os.replace(outPath + '.tmp', outPath)
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'assembly_summary',
+                                     description = 'Load NCBI assembly summaries with compact dtypes, caching the parsed tables.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', type = str, nargs = '+', required = True,
+                        help = 'assembly_summary.txt files.')
+    parser.add_argument('-c', '--cache', type = str, default = None,
+                        help = 'A directory for the cached tables, none to always parse.')
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s > %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S')
+    print('file\tassemblies\tunique_acc9\trepresentative\tmemory_mb')
+    for p in opt.input:
+        df = load_summary(p, opt.cache)
+        rep = int(df['refseq_category'].isin(REPRESENTATIVE).sum()) if 'refseq_category' in df else 0
+        print('\t'.join([p, str(len(df)), str(df['acc9'].nunique()), str(rep), '%.1f' % (df.memory_usage(deep = True).sum() / 1024 ** 2)]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Group the samples of a kraken2M run into batches under a byte or
+# read budget. The plan is saved in tmp/batches.json so a restarted run
+# gets the same batches and resumes at the first incomplete one. The
+# same grouping puts the DBs of a multi-DB run into waves that fit in
+# the available memory, and the samples of a sharded run are divided
+# into contiguous shards of about the same input size, one per node.
+#################################################################
+import os, re, json, logging
+
+UNITS = {'': 1, 'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3, 'T': 1000 ** 4}
+
+def parse_size(value):
+    """Parse a budget like '500000', '20M' or '50G' into an integer."""
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$', str(value), re.I)
+    if not m:
+        raise ValueError('Bad size: ' + str(value))
+    return int(float(m.group(1)) * UNITS[m.group(2).upper()])
+
+def plan_batches(weights, budget):
+    """Split range(len(weights)) in order into batches whose weights sum to at most budget.
+
+    A single sample heavier than the budget gets a batch of its own.
+    """
+    batches = []
+    current, total = [], 0
+    for i, w in enumerate(weights):
+        if current and total + w > budget:
+            batches.append(current)
+            current, total = [], 0
+        current.append(i)
+        total += w
+    if current:
+        batches.append(current)
+    return batches
+
+def load_or_plan(planPath, sampleNames, weights, budget, unit):
+    """Return the batches (lists of sample names), reusing a saved plan made for the same samples and budget."""
+    if os.path.isfile(planPath):
+        with open(planPath) as f:
+            plan = json.load(f)
+        if plan.get('samples') == list(sampleNames) and plan.get('budget') == budget and plan.get('unit') == unit:
+            logging.info('Reusing the batch plan in ' + planPath)
+            return plan['batches']
+        logging.warning('The samples or the budget changed, the batches are planned again.')
+    batches = [[sampleNames[i] for i in b] for b in plan_batches(weights, budget)]
+    with open(planPath + '.tmp', 'w') as f:
+        json.dump({'samples': list(sampleNames), 'budget': budget, 'unit': unit, 'batches': batches}, f, indent = 1)
+    os.replace(planPath + '.tmp', planPath)
+    return batches
+
+def plan_shards(weights, n):
+    """Split range(len(weights)) in order into n contiguous shards of about equal weight, some may be empty."""
+    total = sum(weights)
+    shards = [[] for _ in range(n)]
+    acc = 0
+    for i, w in enumerate(weights):
+        # a sample goes to the shard its weight midpoint falls in
+        k = int((acc + w / 2) * n // total) if total else i * n // len(weights)
+        shards[min(k, n - 1)].append(i)
+        acc += w
+    return shards
+
+def load_or_plan_shards(planPath, sampleNames, weights, n):
+    """Return the shards (lists of sample names), reusing a saved plan made for the same samples and shard count.
+
+    Every shard of a run computes the plan on its own node, the saved one
+    keeps them consistent if the input files are touched in between.
+    """
+    if os.path.isfile(planPath):
+        with open(planPath) as f:
+            plan = json.load(f)
+        if plan.get('samples') == list(sampleNames) and plan.get('shards') == n:
+            return plan['plan']
+        logging.warning('The samples or the number of shards changed, the shards are planned again.')
+    shards = [[sampleNames[i] for i in s] for s in plan_shards(weights, n)]
+    tmp = planPath + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'samples': list(sampleNames), 'shards': n, 'plan': shards}, f, indent = 1)
+    os.replace(tmp, planPath)
+    return shards
+
+def shard_dir(outDir, k, n):
+    """The output directory of shard k (1-based) of n."""
+    return os.path.join(outDir, 'shard_' + str(k) + '_of_' + str(n))
+
+def batch_dir(tmpDir, k):
+    return os.path.join(tmpDir, 'batch_' + '%04d' % (k + 1))
+
+def available_memory():
+    """Return the memory available for new processes in bytes (MemAvailable of /proc/meminfo, else the physical memory)."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def db_memory(dbDir):
+    """Estimate the memory Kraken2 needs for a DB: the size of its hash.k2d, opts.k2d and taxo.k2d."""
+    return sum(os.path.getsize(os.path.join(dbDir, f)) for f in ('hash.k2d', 'opts.k2d', 'taxo.k2d')
+               if os.path.isfile(os.path.join(dbDir, f)))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Check that kreport_builder.py writes the same kreports as
+# make_kreport.py of KrakenTools: both are run on the same Kraken2
+# outputs and taxonomy (mydb_taxonomy.txt of make_ktaxonomy.py) and
+# the reports are compared byte for byte, the first differing lines
+# of every sample are printed. kraken2M.py keeps --kreport-engine
+# krakentools as its default until this passes on real outputs.
+#################################################################
+import argparse, os, re, sys, difflib, shutil, subprocess, tempfile
+from argparse import ArgumentDefaultsHelpFormatter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+from kreport_builder import KTaxonomy, build_kreport
+
+def compare(krakenOut, taxonomy, taxonomyPath, krakenTools, tmpDir, context = 5):
+    """Return the unified diff (a list of lines, empty when identical) of both kreports of krakenOut."""
+    name = re.sub(r'out\.txt$', '', os.path.basename(krakenOut))
+    ref = os.path.join(tmpDir, name + 'kreport.krakentools.txt')
+    res = os.path.join(tmpDir, name + 'kreport.builtin.txt')
+    subprocess.run([sys.executable, os.path.join(krakenTools, 'make_kreport.py'), '-i', krakenOut, '-t', taxonomyPath,
+                    '-o', ref], check = True, stdout = subprocess.DEVNULL)
+    build_kreport(taxonomy, krakenOut, res)
+    with open(ref, 'rb') as f:
+        a = f.read()
+    with open(res, 'rb') as f:
+        b = f.read()
+    if a == b:
+        return []
+    diff = difflib.unified_diff(a.decode().splitlines(True), b.decode().splitlines(True), 'make_kreport.py', 'kreport_builder.py', n = 0)
+    return list(diff)[:2 + context * 2]
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'compare_kreports',
+                                     description = 'Compare the kreports of kreport_builder.py with those of make_kreport.py.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', type = str, nargs = '+', required = True,
+                        help = 'Kraken2 output files, e.g. the <sample>out.txt of a kraken2M.py run.')
+    parser.add_argument('-t', '--taxonomy', type = str, required = True,
+                        help = 'The taxonomy file made by make_ktaxonomy.py.')
+    parser.add_argument('-kt', '--kraken-tools', type = str, required = True,
+                        help = 'The KrakenTools directory with make_kreport.py.')
+    parser.add_argument('--keep', type = str, default = None,
+                        help = 'Keep both kreports of every sample in this directory.')
+    opt = parser.parse_args(argv)
+    tmpDir = opt.keep or tempfile.mkdtemp(prefix = 'compare_kreports.')
+    os.makedirs(tmpDir, exist_ok = True)
+    taxonomy = KTaxonomy.from_ktaxonomy(opt.taxonomy)
+    failed = 0
+    try:
+        for k in opt.input:
+            diff = compare(k, taxonomy, opt.taxonomy, opt.kraken_tools, tmpDir)
+            print(('identical  ' if not diff else 'DIFFERENT  ') + k)
+            if diff:
+                failed += 1
+                sys.stdout.writelines('    ' + line for line in diff)
+    finally:
+        if not opt.keep:
+            shutil.rmtree(tmpDir)
+    print(str(len(opt.input) - failed) + '/' + str(len(opt.input)) + ' kreports identical')
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# A stand-in for the kraken2 binary, for benchmarks and local runs
+# without a real DB. It takes the kraken2 options used by kraken2M.py,
+# reads the fastq files (plain, gzip or named pipes) and writes
+# output.txt, report.txt and the classified/unclassified fastq files
+# in Kraken2's formats. Every read gets a pseudo-random k-mer hit list
+# over the taxonomy of the DB (taxonomy/nodes.dmp and names.dmp, see
+# make_synthetic_fastq.py), and is classified from it with Kraken2's
+# rules, confidence threshold included.
+#################################################################
+import argparse, os, sys, gzip, random, zlib
+from collections import Counter
+
+K = 35
+UNCLASSIFIED_RATE = 0.2
+
+def load_taxonomy(dbDir):
+    parents, ranks, names = dict(), dict(), dict()
+    with open(os.path.join(dbDir, 'taxonomy', 'nodes.dmp')) as f:
+        for line in f:
+            vals = line.split('\t|\t')
+            taxid, parent = int(vals[0]), int(vals[1])
+            parents[taxid] = parent if parent != taxid else 0
+            ranks[taxid] = vals[2]
+    with open(os.path.join(dbDir, 'taxonomy', 'names.dmp')) as f:
+        for line in f:
+            vals = line.rstrip('\t|\n').split('\t|\t')
+            if vals[3] == 'scientific name':
+                names[int(vals[0])] = vals[1]
+    return parents, ranks, names
+
+def is_ancestor(parents, a, b):
+    """True if a is b or an ancestor of b."""
+    while b:
+        if a == b:
+            return True
+        b = parents.get(b, 0)
+    return False
+
+def lca(parents, a, b):
+    path = set()
+    while a:
+        path.add(a)
+        a = parents.get(a, 0)
+    while b and b not in path:
+        b = parents.get(b, 0)
+    return b
+
+def resolve(parents, hits, total, confidence):
+    """Kraken2's ResolveTree: best root-to-leaf score, then climb until the clade reaches the confidence."""
+    best, bestScore = 0, 0
+    for taxid in hits:
+        score = sum(n for t, n in hits.items() if is_ancestor(parents, t, taxid))
+        if score > bestScore:
+            best, bestScore = taxid, score
+        elif score == bestScore:
+            best = lca(parents, best, taxid)
+    required = confidence * total
+    while best:
+        clade = sum(n for t, n in hits.items() if is_ancestor(parents, best, t))
+        if clade >= required:
+            break
+        best = parents.get(best, 0)
+    return best
+
+def hit_list(rng, parents, leaves, leaf, nKmers):
+    """Return [(taxid, run length)] for one mate: no hits without a leaf, else mostly hits around the leaf."""
+    if not leaf:
+        return [(0, nKmers)]
+    candidates = [leaf, parents.get(leaf, 0), parents.get(parents.get(leaf, 0), 0), rng.choice(leaves), 0]
+    runs, left = [], nKmers
+    while left > 0:
+        n = min(left, rng.randint(1, max(1, nKmers // 4)))
+        taxid = candidates[min(int(rng.expovariate(1.2)), len(candidates) - 1)]
+        if runs and runs[-1][0] == taxid:
+            runs[-1] = (taxid, runs[-1][1] + n)
+        else:
+            runs.append((taxid, n))
+        left -= n
+    return runs
+
+def read_fastq(path, gzipped):
+    fh = gzip.open(path, 'rb') if gzipped else open(path, 'rb')
+    with fh:
+        while True:
+            rec = [fh.readline() for _ in range(4)]
+            if not rec[0]:
+                return
+            yield rec
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'fake_kraken2', description = 'A stand-in for kraken2 used by the benchmarks.')
+    parser.add_argument('--db', required = True)
+    parser.add_argument('--threads', default = '1')
+    parser.add_argument('--confidence', type = float, default = 0.0)
+    parser.add_argument('--report')
+    parser.add_argument('--output')
+    parser.add_argument('--classified-out')
+    parser.add_argument('--unclassified-out')
+    parser.add_argument('--use-names', action = 'store_true')
+    parser.add_argument('--paired', action = 'store_true')
+    parser.add_argument('--gzip-compressed', action = 'store_true')
+    parser.add_argument('--memory-mapping', action = 'store_true')
+    parser.add_argument('files', nargs = '+')
+    opt = parser.parse_args(argv)
+    parents, ranks, names = load_taxonomy(opt.db)
+    children = set(parents.values())
+    leaves = sorted(t for t in parents if t not in children)
+
+    def outs(pattern):
+        if not pattern:
+            return []
+        if opt.paired:
+            return [open(pattern.replace('#', '_' + str(m)), 'wb') for m in (1, 2)]
+        return [open(pattern, 'wb')]
+    cOut, uOut = outs(opt.classified_out), outs(opt.unclassified_out)
+    kOut = open(opt.output, 'w') if opt.output else sys.stdout
+    readers = [read_fastq(p, opt.gzip_compressed) for p in opt.files[:2 if opt.paired else 1]]
+    counts = Counter()
+    total = 0
+    for recs in zip(*readers):
+        total += 1
+        readId = recs[0][0][1:].split()[0].decode()
+        if opt.paired and readId.endswith('/1'):
+            readId = readId[:-2]
+        lens = [len(r[1].rstrip(b'\n')) for r in recs]
+        rng = random.Random(zlib.crc32(recs[0][1]))
+        leaf = 0 if rng.random() < UNCLASSIFIED_RATE else rng.choice(leaves)
+        mateHits = [hit_list(rng, parents, leaves, leaf, max(1, n - K + 1)) for n in lens]
+        hits = Counter()
+        for runs in mateHits:
+            for taxid, n in runs:
+                if taxid:
+                    hits[taxid] += n
+        call = resolve(parents, hits, sum(n for runs in mateHits for _, n in runs), opt.confidence) if hits else 0
+        counts[call] += 1
+        if opt.use_names:
+            label = (names.get(call, 'unclassified') if call else 'unclassified') + ' (taxid ' + str(call) + ')'
+        else:
+            label = str(call)
+        hitStr = ' |:| '.join(' '.join(str(t) + ':' + str(n) for t, n in runs) for runs in mateHits)
+        kOut.write(('C' if call else 'U') + '\t' + readId + '\t' + label + '\t' + '|'.join(str(n) for n in lens) + '\t' + hitStr + '\n')
+        for fh, r in zip(cOut if call else uOut, recs):
+            fh.write(b''.join(r))
+    for fh in cOut + uOut:
+        fh.close()
+    if kOut is not sys.stdout:
+        kOut.close()
+    if opt.report:
+        write_report(opt.report, parents, ranks, names, counts, total)
+    sys.stderr.write(str(total) + ' sequences processed\n')
+
+def write_report(path, parents, ranks, names, counts, total):
+    """Kraken2's report.txt of the whole run (rank codes simplified to the standard letters)."""
+    code = {'superkingdom': 'D', 'phylum': 'P', 'class': 'C', 'order': 'O', 'family': 'F', 'genus': 'G', 'species': 'S'}
+    clade = Counter()
+    for taxid, n in counts.items():
+        while taxid:
+            clade[taxid] += n
+            taxid = parents.get(taxid, 0)
+    kids = dict()
+    for t, p in parents.items():
+        kids.setdefault(p, []).append(t)
+    with open(path, 'w') as f:
+        if counts[0]:
+            f.write('%6.2f\t%i\t%i\t%s\t%i\t%s\n' % (100.0 * counts[0] / total, counts[0], counts[0], 'U', 0, 'unclassified'))
+        stack = [(1, 0)]
+        while stack:
+            taxid, depth = stack.pop()
+            if not clade[taxid]:
+                continue
+            rank = 'R' if taxid == 1 else code.get(ranks[taxid], '-')
+            f.write('%6.2f\t%i\t%i\t%s\t%i\t%s%s\n' % (100.0 * clade[taxid] / total, clade[taxid], counts[taxid], rank, taxid, '  ' * depth, names[taxid]))
+            for c in sorted(kids.get(taxid, []), key = lambda t: clade[t]):
+                if c != taxid:
+                    stack.append((c, depth + 1))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# A local stand-in for the NCBI FTP/HTTP server, for testing the
+# downloads of deal_with_assembly_summary.py without network. It
+# serves a directory over HTTP/1.1 with keep-alive, ETag and
+# Last-Modified headers, answers If-None-Match / If-Modified-Since
+# with 304 and Range / If-Range with 206. With --cut-after every file
+# is cut off once after that many bytes, to exercise resumed
+# transfers. Requests are counted per path and connection in
+# --stats, so reuse of connections can be checked.
+#################################################################
+import argparse, os, sys, json, threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from argparse import ArgumentDefaultsHelpFormatter
+
+class Handler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    cutAfter = None
+    cut = set()
+    stats = {'requests': 0, 'connections': 0, 'status': dict()}
+    lock = threading.Lock()
+
+    def setup(self):
+        SimpleHTTPRequestHandler.setup(self)
+        with self.lock:
+            self.stats['connections'] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def count(self, status):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['status'][str(status)] = self.stats['status'].get(str(status), 0) + 1
+
+    def reply(self, status, headers = (), body = b''):
+        self.count(status)
+        self.send_response(status)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.reply(404)
+            return
+        st = os.stat(path)
+        etag = '"' + format(st.st_size, 'x') + '-' + format(st.st_mtime_ns, 'x') + '"'
+        lastModified = formatdate(st.st_mtime, usegmt = True)
+        validators = [('ETag', etag), ('Last-Modified', lastModified)]
+        inm = self.headers.get('If-None-Match')
+        ims = self.headers.get('If-Modified-Since')
+        if inm is not None:
+            if inm == etag:
+                self.reply(304, validators)
+                return
+        elif ims is not None and int(st.st_mtime) <= parsedate_to_datetime(ims).timestamp():
+            self.reply(304, validators)
+            return
+        start = 0
+        rng = self.headers.get('Range')
+        ifRange = self.headers.get('If-Range')
+        if rng and rng.startswith('bytes=') and ifRange in (None, etag, lastModified):
+            start = int(rng[len('bytes='):].split('-')[0])
+            if start >= st.st_size:
+                self.reply(416, [('Content-Range', 'bytes */' + str(st.st_size))])
+                return
+        with open(path, 'rb') as f:
+            f.seek(start)
+            body = f.read()
+        self.count(206 if start else 200)
+        self.send_response(206 if start else 200)
+        for k, v in validators:
+            self.send_header(k, v)
+        if start:
+            self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(st.st_size - 1) + '/' + str(st.st_size))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        with self.lock:
+            cut = self.cutAfter is not None and self.path not in self.cut and len(body) > self.cutAfter
+            if cut:
+                self.cut.add(self.path)
+        if cut:
+            # drop the connection in the middle of the body, once per file
+            self.wfile.write(body[:self.cutAfter])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+def serve(root, port = 0, cutAfter = None):
+    """Start the server in a thread, returns it (server.server_address[1] is the port)."""
+    handler = type('RootHandler', (Handler,), {'cutAfter': cutAfter, 'cut': set(),
+                                               'stats': {'requests': 0, 'connections': 0, 'status': dict()},
+                                               'lock': threading.Lock()})
+    server = ThreadingHTTPServer(('127.0.0.1', port), lambda *a: handler(*a, directory = root))
+    server.handler = handler
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'http_stand_in',
+                                     description = 'Serve a directory like the NCBI server, for offline download tests.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-r', '--root', type = str, required = True, help = 'The directory to serve, e.g. with genomes/<set>/<domain>/assembly_summary.txt.')
+    parser.add_argument('-p', '--port', type = int, default = 8000, help = 'Port on 127.0.0.1.')
+    parser.add_argument('--cut-after', type = int, default = None, help = 'Drop the first transfer of every file after this many bytes.')
+    parser.add_argument('--stats', type = str, default = None, help = 'Write the request counts to this JSON file on exit.')
+    opt = parser.parse_args(argv)
+    server = serve(opt.root, opt.port, opt.cut_after)
+    sys.stderr.write('serving ' + opt.root + ' on http://127.0.0.1:' + str(server.server_address[1]) + '\n')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        if opt.stats:
+            with open(opt.stats, 'w') as f:
+                json.dump(server.handler.stats, f, indent = 1)
+
+if __name__ == '__main__':
+    main()
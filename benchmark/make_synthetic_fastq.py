@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Generate a synthetic benchmark data set for kraken2M.py: single or
+# paired-end fastq samples (plain or gzip) of a given depth, and a tiny
+# Kraken2-like DB (taxonomy/nodes.dmp, taxonomy/names.dmp and a
+# placeholder hash.k2d) to be used with fake_kraken2.py.
+#################################################################
+import argparse, os, sys, gzip, random
+from argparse import ArgumentDefaultsHelpFormatter
+
+RANKS = ['superkingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+DOMAINS = [(2, 'Bacteria'), (2157, 'Archaea'), (2759, 'Eukaryota')]
+BASES = bytes.maketrans(bytes(range(256)), b'ACGT' * 64)
+
+def make_db(dbDir, branching = 2, seed = 1):
+    """Write a synthetic taxonomy of 3 domains and branching children per rank down to species."""
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(dbDir, 'taxonomy'), exist_ok = True)
+    nodes = [(1, 1, 'no rank', 'root'), (131567, 1, 'no rank', 'cellular organisms')]
+    nextTaxid = 10000
+    level = []
+    for taxid, name in DOMAINS:
+        nodes.append((taxid, 131567, 'superkingdom', name))
+        level.append(taxid)
+    for rank in RANKS[1:]:
+        nxt = []
+        for parent in level:
+            for _ in range(branching):
+                nodes.append((nextTaxid, parent, rank, rank.capitalize() + ' ' + str(nextTaxid)))
+                nxt.append(nextTaxid)
+                nextTaxid += 1
+        level = nxt
+    # a few strains below species, as in NCBI
+    for parent in rng.sample(level, max(1, len(level) // 10)):
+        nodes.append((nextTaxid, parent, 'strain', 'Strain ' + str(nextTaxid)))
+        nextTaxid += 1
+    with open(os.path.join(dbDir, 'taxonomy', 'nodes.dmp'), 'w') as f:
+        for taxid, parent, rank, _ in nodes:
+            f.write('%d\t|\t%d\t|\t%s\t|\t\t|\t0\t|\n' % (taxid, parent, rank))
+    with open(os.path.join(dbDir, 'taxonomy', 'names.dmp'), 'w') as f:
+        for taxid, _, _, name in nodes:
+            f.write('%d\t|\t%s\t|\t\t|\tscientific name\t|\n' % (taxid, name))
+    with open(os.path.join(dbDir, 'hash.k2d'), 'wb') as f:
+        f.write(b'\0' * 4096)
+    return len(nodes)
+
+def random_seq(rng, n):
+    return rng.randbytes(n).translate(BASES)
+
+def make_samples(outDir, samples = 4, reads = 10000, readLength = 150, paired = True, gzipped = False, seed = 1):
+    """Write the fastq files and return their suffixes, e.g. ['_R1.fq.gz', '_R2.fq.gz']."""
+    os.makedirs(outDir, exist_ok = True)
+    rng = random.Random(seed)
+    ext = '.fq.gz' if gzipped else '.fq'
+    suffix = ['_R1' + ext, '_R2' + ext] if paired else [ext]
+    qual = b'I' * readLength
+    for i in range(samples):
+        name = 'sample%03d' % (i + 1)
+        opener = (lambda p: gzip.open(p, 'wb', compresslevel = 1)) if gzipped else (lambda p: open(p, 'wb'))
+        handles = [opener(os.path.join(outDir, name + sf)) for sf in suffix]
+        # depth varies a little between samples, like real runs
+        n = max(1, int(reads * rng.uniform(0.5, 1.5)))
+        for j in range(n):
+            for m, fh in enumerate(handles):
+                header = b'@' + name.encode() + b'.' + str(j).encode()
+                if paired:
+                    header += b'/' + str(m + 1).encode()
+                fh.write(header + b'\n' + random_seq(rng, readLength) + b'\n+\n' + qual + b'\n')
+        for fh in handles:
+            fh.close()
+    return suffix
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'make_synthetic_fastq',
+                                     description = 'Generate synthetic fastq samples and a tiny DB for benchmarking kraken2M.py.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-o', '--output', type = str, required = True,
+                        help = 'Directory for the samples (<output>/reads) and the DB (<output>/db).')
+    parser.add_argument('-n', '--samples', type = int, default = 4,
+                        help = 'Number of samples.')
+    parser.add_argument('-r', '--reads', type = int, default = 10000,
+                        help = 'Mean number of reads (pairs) per sample.')
+    parser.add_argument('-l', '--read-length', type = int, default = 150,
+                        help = 'Read length.')
+    parser.add_argument('--single', action = 'store_true',
+                        help = 'Write single-end instead of paired-end samples.')
+    parser.add_argument('--gzip', action = 'store_true',
+                        help = 'Compress the fastq files with gzip.')
+    parser.add_argument('--seed', type = int, default = 1,
+                        help = 'Random seed.')
+    opt = parser.parse_args(argv)
+    n = make_db(os.path.join(opt.output, 'db'), seed = opt.seed)
+    suffix = make_samples(os.path.join(opt.output, 'reads'), opt.samples, opt.reads, opt.read_length,
+                          not opt.single, opt.gzip, opt.seed)
+    print('DB with ' + str(n) + ' taxa in ' + os.path.join(opt.output, 'db'))
+    print('suffix: ' + ','.join(suffix))
+
+if __name__ == '__main__':
+    main()
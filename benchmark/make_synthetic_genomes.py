@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Generate a synthetic mirror of the NCBI genomes directory, to be
+# served by http_stand_in.py for deal_with_assembly_summary.py and
+# fetch_genomes.py: genomes/<set>/<domain>/assembly_summary.txt for
+# refseq and genbank (every refseq assembly paired with a genbank one,
+# plus genbank-only ones), and for every assembly
+# genomes/all/GC[AF]/nnn/nnn/nnn/<accession>_<name>/ with its
+# _genomic.fna.gz and md5checksums.txt. The ftp_path columns point to
+# https://ftp.ncbi.nlm.nih.gov/genomes/all/..., as NCBI's do.
+#################################################################
+import argparse, os, sys, gzip, random, hashlib
+from argparse import ArgumentDefaultsHelpFormatter
+from make_synthetic_fastq import random_seq
+
+NCBI = 'https://ftp.ncbi.nlm.nih.gov/genomes'
+COLUMNS = ['assembly_accession', 'bioproject', 'biosample', 'wgs_master', 'refseq_category', 'taxid', 'species_taxid',
+           'organism_name', 'infraspecific_name', 'isolate', 'version_status', 'assembly_level', 'release_type',
+           'genome_rep', 'seq_rel_date', 'asm_name', 'submitter', 'gbrs_paired_asm', 'paired_asm_comp', 'ftp_path',
+           'excluded_from_refseq', 'relation_to_type_material']
+
+def assembly_dir(acc, asmName):
+    return '/'.join(['all', acc[:3], acc[4:7], acc[7:10], acc[10:13], acc + '_' + asmName])
+
+def write_genome(mirror, acc, asmName, rng, contigs, length):
+    """Write the _genomic.fna.gz and md5checksums.txt of an assembly, returns its ftp_path."""
+    rel = assembly_dir(acc, asmName)
+    d = os.path.join(mirror, 'genomes', rel)
+    os.makedirs(d, exist_ok = True)
+    name = acc + '_' + asmName + '_genomic.fna.gz'
+    with gzip.open(os.path.join(d, name), 'wb', compresslevel = 1) as f:
+        for k in range(contigs):
+            seq = random_seq(rng, max(100, int(length * rng.uniform(0.5, 1.5))))
+            f.write(b'>' + ('NZ_%s%06d.1' % (acc[4:7], k)).encode() + b' Synthetic organism contig ' + str(k).encode() + b'\n')
+            for i in range(0, len(seq), 80):
+                f.write(seq[i:i + 80] + b'\n')
+    with open(os.path.join(d, name), 'rb') as f:
+        md5 = hashlib.md5(f.read()).hexdigest()
+    with open(os.path.join(d, 'md5checksums.txt'), 'w') as f:
+        f.write(md5 + '  ./' + name + '\n')
+    return NCBI + '/' + rel
+
+def make_mirror(mirror, domains = ('viral', 'archaea'), assemblies = 20, contigs = 3, length = 5000, seed = 1):
+    """Write the mirror, returns the number of assemblies per set."""
+    rng = random.Random(seed)
+    counts = {'refseq': 0, 'genbank': 0}
+    for d in domains:
+        rows = {'refseq': [], 'genbank': []}
+        for i in range(assemblies):
+            acc9 = rng.randrange(10 ** 9)
+            version = rng.randrange(1, 4)
+            taxid = rng.randrange(10000, 10500)
+            category = rng.choice(['na', 'na', 'representative genome', 'reference genome'])
+            asmName = 'ASM' + str(acc9 % 100000) + 'v' + str(version)
+            inRefseq = rng.random() < 0.6
+            for st, prefix in (('genbank', 'GCA'), ('refseq', 'GCF')):
+                if st == 'refseq' and not inRefseq:
+                    continue
+                acc = prefix + '_%09d.%d' % (acc9, version)
+                paired = ('GCF' if prefix == 'GCA' else 'GCA') + acc[3:] if inRefseq else 'na'
+                ftpPath = write_genome(mirror, acc, asmName, rng, contigs, length)
+                rows[st].append([acc, 'PRJNA' + str(i), 'SAMN' + str(i), '', category, str(taxid), str(taxid - taxid % 10),
+                                 'Synthetic organism ' + str(taxid), 'strain=' + str(i), '', 'latest',
+                                 rng.choice(['Complete Genome', 'Scaffold', 'Contig']), 'Major', 'Full', '2021/07/06',
+                                 asmName, 'synthetic', paired, 'identical' if paired != 'na' else 'na', ftpPath, '', ''])
+        for st, r in rows.items():
+            p = os.path.join(mirror, 'genomes', st, d)
+            os.makedirs(p, exist_ok = True)
+            with open(os.path.join(p, 'assembly_summary.txt'), 'w') as f:
+                f.write('#   See ftp://ftp.ncbi.nlm.nih.gov/genomes/README_assembly_summary.txt for a description of the columns in this file.\n')
+                f.write('# ' + '\t'.join(COLUMNS) + '\n')
+                for row in r:
+                    f.write('\t'.join(row) + '\n')
+            counts[st] += len(r)
+    return counts
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'make_synthetic_genomes',
+                                     description = 'Generate a synthetic mirror of the NCBI genomes directory.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-o', '--output', type = str, required = True,
+                        help = 'The mirror directory, genomes/ is written in it.')
+    parser.add_argument('-d', '--domain', type = str, nargs = '+', default = ['viral', 'archaea'],
+                        help = 'Domains.')
+    parser.add_argument('-n', '--assemblies', type = int, default = 20,
+                        help = 'Number of genbank assemblies per domain, about 60%% of them are also in refseq.')
+    parser.add_argument('-c', '--contigs', type = int, default = 3,
+                        help = 'Contigs per genome.')
+    parser.add_argument('-l', '--length', type = int, default = 5000,
+                        help = 'Average contig length.')
+    parser.add_argument('--seed', type = int, default = 1,
+                        help = 'Random seed.')
+    opt = parser.parse_args(argv)
+    counts = make_mirror(opt.output, opt.domain, opt.assemblies, opt.contigs, opt.length, opt.seed)
+    print('refseq: ' + str(counts['refseq']) + ', genbank: ' + str(counts['genbank']) + ' assemblies in ' + opt.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Benchmark kraken2M.py and reorder_kraken2_report.py offline: generate
+# synthetic samples for every layout (single/paired) and compression
+# (plain/gzip) asked for, run kraken2M.py on them with fake_kraken2.py
+# in each mode (default, --stream, --batch-size, and --shard with the
+# shards run as parallel processes then merged), collect the per-stage
+# metrics.json of every run and time the reordering of the kreports.
+# Results are saved to benchmark/results/<label>.json and can be
+# compared with an earlier result file.
+#################################################################
+import argparse, os, sys, json, time, shutil, subprocess, tempfile
+from argparse import ArgumentDefaultsHelpFormatter
+from make_synthetic_fastq import make_db, make_samples
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+MODES = {'default': [], 'stream': ['--stream'], 'batch': ['--batch-size', None], 'shard': []}
+
+def git_rev():
+    try:
+        return subprocess.check_output(['git', '-C', ROOT, 'rev-parse', '--short', 'HEAD'], stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_kraken2M(reads, db, suffix, outDir, gzipped, mode, opt):
+    """Run kraken2M.py once and return its metrics summary and total wall time."""
+    command = [sys.executable, os.path.join(ROOT, 'kraken2M.py'), '-i', reads, '-s', ','.join(suffix), '-d', db,
+               '-k', os.path.join(HERE, 'fake_kraken2.py'), '-kt', db, '-o', outDir, '-t', str(opt.threads),
+               # no KrakenTools offline, the kreports come from the taxonomy cache of the DB
+               '--kreport-engine', 'builtin']
+    if gzipped:
+        command.append('--gzip-compressed')
+    for a in MODES[mode]:
+        command.append(a if a is not None else opt.batch_size)
+    t0 = time.time()
+    if mode == 'shard':
+        # every shard is its own process, as it would be on its own node
+        procs = [subprocess.Popen(command + ['--shard', str(k) + '/' + str(opt.shards)]) for k in range(1, opt.shards + 1)]
+        stat = max(p.wait() for p in procs)
+        if stat == 0:
+            stat = subprocess.call([sys.executable, os.path.join(ROOT, 'merge_shards.py'), '-o', outDir])
+    else:
+        stat = subprocess.call(command)
+    wall = round(time.time() - t0, 3)
+    if stat != 0 or not os.path.isfile(outDir + '/metrics.json'):
+        return {'error': 'kraken2M.py exited with ' + str(stat) + ', see ' + outDir + '/log.log', 'wall_s': wall}
+    with open(outDir + '/metrics.json') as f:
+        summary = json.load(f)['summary']
+    return {'wall_s': wall, 'stages': {s['stage']: s for s in summary}}
+
+def run_reorder(outDir, extraArgs = ()):
+    """Time reorder_kraken2_report.py on the kreports of one kraken2M run."""
+    inDir = outDir + '/reorder_in'
+    os.makedirs(inDir, exist_ok = True)
+    n = 0
+    for f in os.listdir(outDir):
+        if f.endswith('kreport.txt'):
+            shutil.copy(os.path.join(outDir, f), os.path.join(inDir, f[:-len('kreport.txt')] + '.report'))
+            n += 1
+    t0 = time.time()
+    proc = subprocess.run([sys.executable, os.path.join(ROOT, 'reorder_kraken2_report.py'), '-i', inDir, '-o', inDir] + list(extraArgs),
+                          stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    res = {'files': n, 'wall_s': round(time.time() - t0, 3)}
+    if proc.returncode != 0:
+        res['error'] = proc.stderr.decode().strip().splitlines()[-1] if proc.stderr else 'exit ' + str(proc.returncode)
+    return res
+
+def benchmark(opt, workDir):
+    runs = []
+    layouts = ['single', 'paired'] if opt.layout == 'both' else [opt.layout]
+    compressions = ['plain', 'gzip'] if opt.compression == 'both' else [opt.compression]
+    db = os.path.join(workDir, 'db')
+    make_db(db, seed = opt.seed)
+    for layout in layouts:
+        for compression in compressions:
+            data = layout + '_' + compression
+            reads = os.path.join(workDir, data)
+            suffix = make_samples(reads, opt.samples, opt.reads, opt.read_length, layout == 'paired', compression == 'gzip', opt.seed)
+            for mode in opt.modes.split(','):
+                outDir = os.path.join(workDir, 'out_' + data + '_' + mode)
+                sys.stderr.write('running ' + data + ' ' + mode + '\n')
+                res = run_kraken2M(reads, db, suffix, outDir, compression == 'gzip', mode, opt)
+                if 'error' not in res:
+                    res['reorder'] = run_reorder(outDir, opt.reorder_args.split())
+                res.update({'data': data, 'mode': mode})
+                runs.append(res)
+    return runs
+
+def table(runs, other = None):
+    """Format wall times per run and stage, with the ratio to the other result when given."""
+    stages = []
+    for r in runs:
+        for s in r.get('stages', dict()):
+            if s not in stages:
+                stages.append(s)
+    cols = ['data', 'mode', 'total'] + stages + ['reorder']
+    ref = {(r['data'], r['mode']): r for r in (other or [])}
+    rows = [cols]
+    for r in runs:
+        o = ref.get((r['data'], r['mode']))
+        def cell(new, old):
+            if new is None:
+                return '-'
+            if old:
+                return '%.2f (x%.2f)' % (new, new / old)
+            return '%.2f' % new
+        row = [r['data'], r['mode'], cell(r['wall_s'], o and o['wall_s'])]
+        for s in stages:
+            new = r.get('stages', dict()).get(s, dict()).get('wall_s')
+            old = o and o.get('stages', dict()).get(s, dict()).get('wall_s')
+            row.append(cell(new, old))
+        reorder = r.get('reorder', dict())
+        row.append('error' if 'error' in reorder else cell(reorder.get('wall_s'), o and o.get('reorder', dict()).get('wall_s')))
+        rows.append(row)
+    widths = [max(len(row[j]) for row in rows) for j in range(len(cols))]
+    return ['  '.join(v.rjust(w) if j > 1 else v.ljust(w) for j, (v, w) in enumerate(zip(row, widths))) for row in rows]
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'run_benchmark',
+                                     description = 'Benchmark kraken2M.py and reorder_kraken2_report.py on synthetic data with a stand-in kraken2.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-n', '--samples', type = int, default = 4, help = 'Number of samples per data set.')
+    parser.add_argument('-r', '--reads', type = int, default = 20000, help = 'Mean number of reads (pairs) per sample.')
+    parser.add_argument('-l', '--read-length', type = int, default = 150, help = 'Read length.')
+    parser.add_argument('--layout', choices = ['single', 'paired', 'both'], default = 'both', help = 'Read layouts to test.')
+    parser.add_argument('--compression', choices = ['plain', 'gzip', 'both'], default = 'both', help = 'Compressions to test.')
+    parser.add_argument('-m', '--modes', type = str, default = 'default,stream,batch', help = 'Comma separated kraken2M modes: ' + ', '.join(MODES) + '.')
+    parser.add_argument('--batch-size', type = str, default = '2M', help = '--batch-size of the batch mode.')
+    parser.add_argument('--shards', type = int, default = 2, help = 'Number of shards of the shard mode.')
+    parser.add_argument('-t', '--threads', type = int, default = 2, help = '--threads of kraken2M.py.')
+    parser.add_argument('--reorder-args', type = str, default = '', help = 'Extra options of reorder_kraken2_report.py, e.g. "--fast -p 4".')
+    parser.add_argument('--label', type = str, default = time.strftime('%Y%m%d-%H%M%S'), help = 'Name of the result file.')
+    parser.add_argument('--results', type = str, default = os.path.join(HERE, 'results'), help = 'Directory of the result files.')
+    parser.add_argument('--compare', type = str, default = None, help = 'An earlier result file to compare with.')
+    parser.add_argument('--workdir', type = str, default = None, help = 'Keep the data and outputs here instead of a temporary directory.')
+    parser.add_argument('--seed', type = int, default = 1, help = 'Random seed.')
+    opt = parser.parse_args(argv)
+    for m in opt.modes.split(','):
+        if m not in MODES:
+            parser.error('Unknown mode: ' + m)
+    if opt.workdir:
+        os.makedirs(opt.workdir, exist_ok = True)
+        runs = benchmark(opt, opt.workdir)
+    else:
+        with tempfile.TemporaryDirectory(prefix = 'kraken2M_bench_') as workDir:
+            runs = benchmark(opt, workDir)
+    params = {k: v for k, v in vars(opt).items() if k not in ('label', 'results', 'compare', 'workdir')}
+    result = {'label': opt.label, 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'git': git_rev(), 'params': params, 'runs': runs}
+    os.makedirs(opt.results, exist_ok = True)
+    path = os.path.join(opt.results, opt.label + '.json')
+    with open(path, 'w') as f:
+        json.dump(result, f, indent = 1)
+    other = None
+    if opt.compare:
+        with open(opt.compare) as f:
+            other = json.load(f)['runs']
+    for line in table(runs, other):
+        print(line)
+    for r in runs:
+        for e in [r.get('error'), r.get('reorder', dict()).get('error')]:
+            if e:
+                print(r['data'] + ' ' + r['mode'] + ': ' + e)
+    print('results saved to ' + path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# A compact columnar binary form of the per-sample Kraken2 outputs,
+# <sample>out.k2b, next to <sample>out.txt. Every read (in the order
+# of the sample's fastq, so the row is the read index) gets a
+# classified flag (uint8), its taxid (uint32) and the lengths of its
+# mates (uint32, 0 for single-end). The k-mer hit lists can be kept
+# too, zlib compressed in blocks of HIT_BLOCK_READS reads with the end
+# offset of every read inside its block. The file is a small JSON
+# header followed by the 64-byte aligned columns, which the reader
+# memory-maps, so taxids can be tallied at disk bandwidth without
+# parsing text. The read IDs and names are not stored.
+#################################################################
+import argparse, os, re, sys, json, time, zlib, logging
+from argparse import ArgumentDefaultsHelpFormatter
+import numpy as np
+from taxonomy_cache import taxonomy_pool
+
+MAGIC = b'K2BO'
+FORMAT_VERSION = 1
+SUFFIX = 'out.k2b'
+ALIGN = 64
+HIT_BLOCK_READS = 4096
+BLOCK_SIZE = 16 * 1024 * 1024
+# classified flag, taxid (with or without --use-names), mate lengths and hit list of a Kraken2 output line
+LINE_RE = re.compile(rb'^([CU])\t[^\t\n]*\t(?:[^\t\n]*\(taxid )?(\d+)\)?\t(\d+)(?:\|(\d+))?\t?([^\n]*)$', re.M)
+COLUMNS = [('classified', np.uint8), ('taxids', np.uint32), ('lengths', np.uint32), ('lengths2', np.uint32)]
+
+class BinaryOutputWriter(object):
+    """Turn the text of a Kraken2 output file, fed in pieces of any size, into a .k2b file on close()."""
+    def __init__(self, path, hitLists = False):
+        self.path = path
+        self.hitLists = hitLists
+        self.rest = b''
+        self.columns = {name: [] for name, _ in COLUMNS}
+        self.reads = 0
+        # hit lists of the current block, then the compressed blocks
+        self.pending = []
+        self.pendingEnds = []
+        self.blocks = []
+        self.hitEnds = []
+
+    def write(self, data):
+        data = self.rest + data
+        cut = data.rfind(b'\n') + 1
+        self.rest = data[cut:]
+        if cut:
+            self.parse(data[:cut])
+
+    def parse(self, data):
+        rows = LINE_RE.findall(data)
+        if len(rows) != data.count(b'\n'):
+            raise ValueError(os.path.basename(self.path) + ': some lines are not Kraken2 output lines.')
+        if not rows:
+            return
+        flags, taxids, lengths, lengths2, hits = zip(*rows)
+        self.columns['classified'].append(np.array(flags) == b'C')
+        self.columns['taxids'].append(np.array(taxids).astype(np.uint32))
+        self.columns['lengths'].append(np.array(lengths).astype(np.uint32))
+        self.columns['lengths2'].append(np.array([n or b'0' for n in lengths2]).astype(np.uint32))
+        self.reads += len(rows)
+        if self.hitLists:
+            for h in hits:
+                self.pending.append(h)
+                self.pendingEnds.append((self.pendingEnds[-1] if self.pendingEnds else 0) + len(h))
+                if len(self.pending) == HIT_BLOCK_READS:
+                    self.flush_hits()
+
+    def flush_hits(self):
+        self.blocks.append(zlib.compress(b''.join(self.pending), 1))
+        self.hitEnds.append(np.array(self.pendingEnds, dtype = np.uint32))
+        self.pending, self.pendingEnds = [], []
+
+    def close(self):
+        if self.rest:
+            self.parse(self.rest + b'\n')
+            self.rest = b''
+        arrays = [(name, np.concatenate(self.columns[name]).astype(dtype) if self.columns[name] else np.zeros(0, dtype = dtype))
+                  for name, dtype in COLUMNS]
+        if self.hitLists:
+            if self.pending:
+                self.flush_hits()
+            blockOffsets = np.zeros(len(self.blocks) + 1, dtype = np.uint64)
+            np.cumsum([len(b) for b in self.blocks], out = blockOffsets[1:])
+            arrays += [('hitEnds', np.concatenate(self.hitEnds) if self.hitEnds else np.zeros(0, dtype = np.uint32)),
+                       ('hitBlockOffsets', blockOffsets),
+                       ('hitBlob', np.frombuffer(b''.join(self.blocks), dtype = np.uint8))]
+        write_columns(self.path, arrays, {'reads': self.reads, 'hitBlockReads': HIT_BLOCK_READS if self.hitLists else 0})
+        return self.reads
+
+def write_columns(path, arrays, extra):
+    """Write the named arrays after a JSON header, each at an ALIGN-byte boundary, atomically."""
+    columns, offset = dict(), 0
+    for name, a in arrays:
+        columns[name] = {'dtype': a.dtype.str, 'offset': offset, 'count': len(a)}
+        offset += -(-a.nbytes // ALIGN) * ALIGN
+    header = dict(extra, version = FORMAT_VERSION, columns = columns)
+    head = json.dumps(header).encode()
+    # the columns start at the first boundary after the magic, the header length and the header
+    start = -(-(len(MAGIC) + 4 + len(head)) // ALIGN) * ALIGN
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + np.uint32(len(head)).tobytes() + head)
+        f.write(b'\0' * (start - f.tell()))
+        for name, a in arrays:
+            f.write(a.tobytes())
+            f.write(b'\0' * (-a.nbytes % ALIGN))
+    os.replace(tmp, path)
+
+class BinaryOutput(object):
+    """Memory-mapped reader of a .k2b file: classified, taxids, lengths and lengths2 arrays, hit_list(i)."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(path + ' is not a .k2b file.')
+            size = int(np.frombuffer(f.read(4), dtype = np.uint32)[0])
+            header = json.loads(f.read(size))
+        if header['version'] != FORMAT_VERSION:
+            raise ValueError(path + ' was written by another version of binary_output.py.')
+        self.reads = header['reads']
+        self.hitBlockReads = header['hitBlockReads']
+        start = -(-(len(MAGIC) + 4 + size) // ALIGN) * ALIGN
+        for name, c in header['columns'].items():
+            if c['count']:
+                a = np.memmap(path, dtype = np.dtype(c['dtype']), mode = 'r', offset = start + c['offset'], shape = (c['count'],))
+            else:
+                a = np.zeros(0, dtype = np.dtype(c['dtype']))
+            setattr(self, name, a)
+        self.block = (-1, b'')
+
+    def __len__(self):
+        return self.reads
+
+    @property
+    def has_hit_lists(self):
+        return self.hitBlockReads > 0
+
+    def hit_list(self, i):
+        """The k-mer hit list of read i, e.g. b'562:13 0:4 |:| 562:20'."""
+        if not self.has_hit_lists:
+            raise ValueError(self.path + ' was written without hit lists.')
+        b = i // self.hitBlockReads
+        if self.block[0] != b:
+            offsets = self.hitBlockOffsets
+            self.block = (b, zlib.decompress(self.hitBlob[int(offsets[b]):int(offsets[b + 1])].tobytes()))
+        start = int(self.hitEnds[i - 1]) if i % self.hitBlockReads else 0
+        return self.block[1][start:int(self.hitEnds[i])]
+
+def read_taxids(path):
+    """Return the taxid column of a .k2b file as an int64 array, 0 for unclassified reads."""
+    return np.asarray(BinaryOutput(path).taxids, dtype = np.int64)
+
+def convert(krakenOut, binaryOut, hitLists = False, blockSize = BLOCK_SIZE):
+    """Write the .k2b file of a Kraken2 output file, returns the number of reads."""
+    writer = BinaryOutputWriter(binaryOut, hitLists)
+    with open(krakenOut, 'rb') as f:
+        while True:
+            block = f.read(blockSize)
+            if not block:
+                break
+            writer.write(block)
+    return writer.close()
+
+def _convert_job(job):
+    return convert(*job)
+
+def convert_files(jobs, hitLists = False, processes = 1, pool = None):
+    """Convert a list of (krakenOut, binaryOut) pairs, in pool (a taxonomy_pool) or forked workers when processes > 1, returns the reads of each."""
+    jobs = [(k, b, hitLists) for k, b in jobs]
+    if pool is not None:
+        return pool.map(_convert_job, jobs, chunksize = 1)
+    if processes > 1 and len(jobs) > 1:
+        with taxonomy_pool(None, min(processes, len(jobs))) as p:
+            return p.map(_convert_job, jobs, chunksize = 1)
+    return [convert(*job) for job in jobs]
+
+def binary_path(krakenOut):
+    return re.sub(r'out\.txt$', '', krakenOut) + SUFFIX
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'binary_output',
+                                     description = 'Convert Kraken2 output files (<name>out.txt) into compact columnar <name>out.k2b files.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', type = str, nargs = '+', required = True,
+                        help = 'Kraken2 output files, or .k2b files with --summary.')
+    parser.add_argument('--hit-lists', action = 'store_true',
+                        help = 'Also keep the k-mer hit lists (zlib compressed).')
+    parser.add_argument('-p', '--processes', type = int, default = 1,
+                        help = 'Number of worker processes.')
+    parser.add_argument('--summary', action = 'store_true',
+                        help = 'Print the reads, classified reads and size of .k2b files instead of converting.')
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s > %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S')
+    if opt.summary:
+        print('file\treads\tclassified\tbytes\thit_lists')
+        for p in opt.input:
+            b = BinaryOutput(p)
+            print('\t'.join([p, str(len(b)), str(int(np.count_nonzero(b.classified))), str(os.path.getsize(p)), str(b.has_hit_lists)]))
+        return
+    t0 = time.time()
+    jobs = [(p, binary_path(p)) for p in opt.input]
+    reads = convert_files(jobs, opt.hit_lists, opt.processes)
+    for (p, out), n in zip(jobs, reads):
+        logging.info(p + ' -> ' + out + ': ' + str(n) + ' reads, ' + str(os.path.getsize(p)) + ' -> ' + str(os.path.getsize(out)) + ' bytes')
+    logging.info(str(len(jobs)) + ' files (' + str(sum(reads)) + ' reads) converted in ' + '{:.2f}'.format(time.time() - t0) + ' s')
+
+if __name__ == '__main__':
+    main()
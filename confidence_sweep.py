@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Re-apply Kraken2's confidence scoring to the k-mer hit lists stored
+# in Kraken2 outputs, for several thresholds in one pass, instead of
+# running Kraken2 again for every --confidence value. For each read the
+# taxon with the best root-to-leaf score is found once (ties resolved to
+# their LCA), then for every threshold the call climbs towards the root
+# until its clade holds ceil(confidence * k-mers) hits, as in Kraken2's
+# ResolveTree. The files are cut into newline-aligned chunks handled by
+# forked workers sharing the taxonomy, and every threshold gets its own
+# <sample>out.txt and <sample>kreport.txt.
+#
+# Kraken2's --minimum-hit-groups filter (default 2) counts distinct
+# minimizers, which the hit lists do not record, so it is not applied.
+#################################################################
+import argparse, os, re, sys, time, math, logging
+from bisect import bisect_left
+from argparse import ArgumentDefaultsHelpFormatter
+import numpy as np
+from kreport_builder import KTaxonomy, format_kreport
+from taxonomy_cache import load_taxonomy_cache, taxonomy_pool, pool_taxonomy
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+def threshold_dir(outDir, confidence):
+    return os.path.join(outDir, 'confidence_' + '%g' % confidence)
+
+def chunks(path, chunkSize = CHUNK_SIZE):
+    """Return the (start, end) byte ranges of path, cut just after newlines."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        while bounds[-1] + chunkSize < size:
+            f.seek(bounds[-1] + chunkSize)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+class Resolver(object):
+    """Kraken2's call for a hit list at several thresholds, with the ancestor paths of the taxonomy cached."""
+    def __init__(self, taxonomy):
+        self.taxonomy = taxonomy
+        self.nodes = dict()
+        self.paths = dict()
+
+    def node(self, taxid):
+        i = self.nodes.get(taxid)
+        if i is None:
+            index = self.taxonomy.index
+            i = int(index[taxid]) if 0 <= taxid < len(index) else -1
+            self.nodes[taxid] = i
+        return i
+
+    def path(self, i):
+        """Node i and its ancestors up to the root."""
+        p = self.paths.get(i)
+        if p is None:
+            p = []
+            parents = self.taxonomy.parents
+            j = i
+            while j >= 0:
+                p.append(j)
+                j = int(parents[j])
+            self.paths[i] = p
+        return p
+
+    def parse(self, hitList):
+        """Return ({node: hits}, k-mers) of a hit list like '562:13 0:4 A:2 |:| 561:20'."""
+        hits = dict()
+        total = 0
+        for tok in hitList.split():
+            if tok == b'|:|':
+                continue
+            taxid, n = tok.split(b':')
+            n = int(n)
+            total += n
+            # ambiguous (A) and unmatched (0) k-mers only count towards the total
+            if taxid != b'A' and taxid != b'0':
+                i = self.node(int(taxid))
+                if i >= 0:
+                    hits[i] = hits.get(i, 0) + n
+        return hits, total
+
+    def resolve(self, hits, required):
+        """Return the called node (-1 for unclassified) for every required score."""
+        if not hits:
+            return [-1] * len(required)
+        best, bestScore = -1, 0
+        for h in hits:
+            score = sum(hits.get(a, 0) for a in self.path(h))
+            if score > bestScore:
+                best, bestScore = h, score
+            elif score == bestScore:
+                bestPath = set(self.path(best))
+                best = next(a for a in self.path(h) if a in bestPath)
+        bestPath = self.path(best)
+        pos = {a: k for k, a in enumerate(bestPath)}
+        # clade[k] is the sum of the hits in the subtree of bestPath[k], non-decreasing towards the root
+        clade = [0] * len(bestPath)
+        for h, n in hits.items():
+            for a in self.path(h):
+                if a in pos:
+                    clade[pos[a]] += n
+                    break
+        for k in range(1, len(clade)):
+            clade[k] += clade[k - 1]
+        res = []
+        for r in required:
+            k = bisect_left(clade, r)
+            res.append(bestPath[k] if k < len(bestPath) else -1)
+        return res
+
+def reclassify_chunk(taxonomy, job):
+    """Return per threshold the called taxids of the lines of one chunk and, if asked, the rewritten lines."""
+    path, start, end, thresholds, writeOut = job
+    resolver = Resolver(taxonomy)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    calls = [[] for _ in thresholds]
+    outs = [[] for _ in thresholds] if writeOut else None
+    labels = dict()
+    for line in data.splitlines():
+        if not line:
+            continue
+        vals = line.split(b'\t')
+        hits, total = resolver.parse(vals[4])
+        nodes = resolver.resolve(hits, [math.ceil(c * total) for c in thresholds])
+        for t, i in enumerate(nodes):
+            taxid = int(taxonomy.taxids[i]) if i >= 0 else 0
+            calls[t].append(taxid)
+            if writeOut:
+                label = labels.get(taxid)
+                if label is None:
+                    if b'(taxid ' in vals[2]:
+                        name = taxonomy.names[i] if i >= 0 else 'unclassified'
+                        label = (name + ' (taxid ' + str(taxid) + ')').encode()
+                    else:
+                        label = str(taxid).encode()
+                    labels[taxid] = label
+                outs[t].append(b'\t'.join([b'C' if taxid else b'U', vals[1], label] + vals[3:]) + b'\n')
+    calls = [np.array(c, dtype = np.int64) for c in calls]
+    return calls, [b''.join(o) for o in outs] if writeOut else None
+
+def write_report(taxonomy, taxids, reportOut):
+    unclassified = int(np.count_nonzero(taxids == 0))
+    counts, _ = taxonomy.tally(taxids[taxids != 0])
+    with open(reportOut, 'w') as f:
+        f.writelines(format_kreport(taxonomy, counts, taxonomy.rollup(counts), unclassified, len(taxids)))
+
+def _reclassify_job(job):
+    return reclassify_chunk(pool_taxonomy(), job)
+
+def sweep(taxonomy, krakenOuts, thresholds, outDir, threads = 1, writeOut = True, chunkSize = CHUNK_SIZE, pool = None):
+    """Reclassify the Kraken2 output files at every threshold into outDir/confidence_<c>/.
+
+    The chunks are reclassified in pool (a taxonomy_pool of taxonomy) when
+    given, else in forked workers when threads > 1.
+    Returns {sample: [classified reads at each threshold]}.
+    """
+    t0 = time.time()
+    for c in thresholds:
+        os.makedirs(threshold_dir(outDir, c), exist_ok = True)
+    jobs, owners = [], []
+    for path in krakenOuts:
+        for start, end in chunks(path, chunkSize):
+            jobs.append((path, start, end, list(thresholds), writeOut))
+            owners.append(path)
+    ownPool = None
+    if pool is None and threads > 1 and len(jobs) > 1:
+        pool = ownPool = taxonomy_pool(taxonomy, min(threads, len(jobs)))
+    res = dict()
+    reads = 0
+    try:
+        results = pool.imap(_reclassify_job, jobs, chunksize = 1) if pool else (reclassify_chunk(taxonomy, j) for j in jobs)
+        current, outFiles, calls = None, [], []
+        def close_sample():
+            name = re.sub(r'out\.txt$', '', os.path.basename(current))
+            for fh in outFiles:
+                fh.close()
+            taxids = [np.concatenate(c) if c else np.zeros(0, dtype = np.int64) for c in calls]
+            for c, t in zip(thresholds, taxids):
+                write_report(taxonomy, t, os.path.join(threshold_dir(outDir, c), name + 'kreport.txt'))
+            res[name] = [int(np.count_nonzero(t)) for t in taxids]
+            return len(taxids[0]) if taxids else 0
+        for path, (chunkCalls, chunkOuts) in zip(owners, results):
+            if path != current:
+                if current is not None:
+                    reads += close_sample()
+                current = path
+                name = re.sub(r'out\.txt$', '', os.path.basename(path))
+                outFiles = [open(os.path.join(threshold_dir(outDir, c), name + 'out.txt'), 'wb') for c in thresholds] if writeOut else []
+                calls = [[] for _ in thresholds]
+            for t in range(len(thresholds)):
+                calls[t].append(chunkCalls[t])
+                if writeOut:
+                    outFiles[t].write(chunkOuts[t])
+        if current is not None:
+            reads += close_sample()
+    finally:
+        if ownPool is not None:
+            ownPool.close()
+            ownPool.join()
+    elapsed = time.time() - t0
+    rate = reads / elapsed if elapsed > 0 else float('inf')
+    logging.info('reclassified ' + str(reads) + ' reads at ' + str(len(thresholds)) + ' thresholds in ' + '{:.2f}'.format(elapsed) + ' s (' + '{:.0f}'.format(rate) + ' reads/s)')
+    return res
+
+def parse_thresholds(value):
+    thresholds = [float(v) for v in str(value).split(',') if v.strip()]
+    for c in thresholds:
+        if not 0 <= c <= 1:
+            raise ValueError('Confidence thresholds must be in [0, 1]: ' + str(c))
+    return thresholds
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'confidence_sweep',
+                                     description = 'Reclassify Kraken2 outputs at several confidence thresholds from their k-mer hit lists.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', type = str, nargs = '+', required = True,
+                        help = 'Kraken2 output files (<sample>out.txt).')
+    parser.add_argument('-c', '--confidence', type = str, required = True,
+                        help = 'Comma separated confidence thresholds, e.g. 0.05,0.1,0.2.')
+    parser.add_argument('-t', '--taxonomy', type = str, default = None,
+                        help = 'The taxonomy file made by make_ktaxonomy.py.')
+    parser.add_argument('-d', '--db', type = str, default = None,
+                        help = 'A Kraken2 DB with taxonomy/nodes.dmp, whose taxonomy cache is used.')
+    parser.add_argument('-o', '--output', type = str, default = '.',
+                        help = 'A directory for the confidence_<c> directories.')
+    parser.add_argument('-p', '--processes', type = int, default = 1,
+                        help = 'Number of worker processes.')
+    parser.add_argument('--reports-only', action = 'store_true',
+                        help = 'Write the kreports only, not the reclassified out.txt files.')
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s > %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S')
+    if not (opt.db or opt.taxonomy):
+        parser.error('The taxonomy is needed, give -t or -d.')
+    try:
+        thresholds = parse_thresholds(opt.confidence)
+    except ValueError as e:
+        parser.error(str(e))
+    taxonomy = load_taxonomy_cache(opt.db) if opt.db else KTaxonomy.from_ktaxonomy(opt.taxonomy)
+    res = sweep(taxonomy, opt.input, thresholds, opt.output, opt.processes, not opt.reports_only)
+    print('sample\t' + '\t'.join('%g' % c for c in thresholds))
+    for name, classified in res.items():
+        print(name + '\t' + '\t'.join(map(str, classified)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Count the reads of (gzip compressed) fastq files in-process.
+# Newlines are counted on large blocks, gzip input is inflated with a
+# streaming zlib object, samples are counted in a process pool and the
+# counts are cached in a JSON manifest keyed by path, size and mtime.
+#################################################################
+import argparse, os, sys, json, zlib, logging
+from argparse import ArgumentDefaultsHelpFormatter
+from concurrent.futures import ProcessPoolExecutor
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+def file_key(path):
+    """Return the (path, size, mtime) fingerprint of a file as a dict."""
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+def is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+class LineCounter(object):
+    """Count newlines of a (gzip) byte stream fed block by block."""
+    def __init__(self, gzipped = False):
+        self.lines = 0
+        self.gzipped = gzipped
+        self.dec = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+
+    def feed(self, block):
+        if not self.gzipped:
+            self.lines += block.count(b'\n')
+            return
+        while block:
+            self.lines += self.dec.decompress(block).count(b'\n')
+            if not self.dec.eof:
+                break
+            # concatenated gzip members, start a new decompressor for the rest
+            block = self.dec.unused_data
+            self.dec = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def count_lines(path, gzipped = None, blockSize = BLOCK_SIZE):
+    """Return the number of lines of path, gzip is detected from the magic bytes if gzipped is None."""
+    if gzipped is None:
+        gzipped = is_gzip(path)
+    counter = LineCounter(gzipped)
+    with open(path, 'rb', buffering = 0) as f:
+        while True:
+            block = f.read(blockSize)
+            if not block:
+                break
+            counter.feed(block)
+    return counter.lines
+
+def copy_and_count(src, dst, append = False, gzipped = None, blockSize = BLOCK_SIZE):
+    """Append (or write) src to dst in blocks and return the number of lines of src."""
+    if gzipped is None:
+        gzipped = is_gzip(src)
+    counter = LineCounter(gzipped)
+    with open(src, 'rb', buffering = 0) as fi, open(dst, 'ab' if append else 'wb') as fo:
+        while True:
+            block = fi.read(blockSize)
+            if not block:
+                break
+            fo.write(block)
+            counter.feed(block)
+    return counter.lines
+
+class ReadCountManifest(object):
+    """Read counts cached on disk, an entry is valid while the file keeps its size and mtime."""
+    def __init__(self, path):
+        self.path = path
+        self.data = dict()
+        if path and os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.data = json.load(f)
+            except ValueError:
+                logging.warning('Ignoring the broken read count manifest ' + path + '.')
+
+    def get(self, fastq):
+        key = file_key(fastq)
+        entry = self.data.get(key['path'])
+        if entry and entry['size'] == key['size'] and entry['mtime'] == key['mtime']:
+            return entry['reads']
+        return None
+
+    def set(self, fastq, reads):
+        key = file_key(fastq)
+        key['reads'] = reads
+        self.data[key['path']] = key
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f, indent = 1)
+        os.replace(tmp, self.path)
+
+def count_reads(paths, threads = 1, manifest = None, gzipped = None):
+    """Return the number of reads (lines / 4) of each fastq in paths, in order.
+
+    manifest is a ReadCountManifest or the path of its file. Files
+    already in it are not read again, the others are counted in a pool
+    of threads processes and added to it.
+    """
+    if not isinstance(manifest, ReadCountManifest):
+        manifest = ReadCountManifest(manifest)
+    counts = [manifest.get(p) for p in paths]
+    todo = [i for i, c in enumerate(counts) if c is None]
+    logging.info(str(len(paths) - len(todo)) + '/' + str(len(paths)) + ' read counts found in the manifest')
+    if todo:
+        if threads > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers = min(threads, len(todo))) as pool:
+                lines = list(pool.map(count_lines, [paths[i] for i in todo], [gzipped] * len(todo)))
+        else:
+            lines = [count_lines(paths[i], gzipped) for i in todo]
+        for i, n in zip(todo, lines):
+            counts[i] = n // 4
+            manifest.set(paths[i], counts[i])
+        manifest.save()
+    return counts
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'count_reads',
+                                     description = 'Count the reads of (gzip compressed) fastq files.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('fastq', nargs = '+',
+                        help = 'Fastq files, gzip is detected automatically.')
+    parser.add_argument('-t', '--threads', type = int, default = 1,
+                        help = 'Number of processes for counting.')
+    parser.add_argument('-m', '--manifest', type = str, default = None,
+                        help = 'A JSON file caching the counts between runs.')
+    opt = parser.parse_args(argv)
+    for p, n in zip(opt.fastq, count_reads(opt.fastq, opt.threads, opt.manifest)):
+        print(p + '\t' + str(n))
+
+if __name__ == '__main__':
+    main()
@@ -4,19 +4,16 @@ debug = False
 # %% import modules
 import argparse
 from argparse import ArgumentDefaultsHelpFormatter
-from operator import index
 import os
+import sys
 import logging
-from typing import Counter, ItemsView, Tuple
-from typing_extensions import Concatenate
-import urllib.request
 import ssl
 import pandas as pd
-import re
-from matplotlib_venn import venn2_circles, venn2_unweighted
-from matplotlib_venn import venn3_unweighted, venn3_circles
-from matplotlib import pyplot as plt
-from matplotlib.backends.backend_pdf import PdfPages
+from http_fetch import fetch_all, FetchError
+from assembly_summary import load_summary, write_rows, REPRESENTATIVE
+from assembly_diff import diff_snapshots
+from fetch_genomes import load_assemblies, fetch_genomes
+from assembly_overlap import domain_overlaps, write_overlaps, plot_overlaps
 ssl._create_default_https_context = ssl._create_unverified_context
 
 # %% pass arguments
@@ -34,6 +31,19 @@ parser.add_argument('-s', '--set', action="store", type=str, default = 'rsgb', c
 parser.add_argument('-r', '--rep', action="store", type=str,
                     nargs='*', default=['plant','invertebrate','vertebrate_mammalian','vertebrate_other'], 
                     help="Specify the domain(s) that you may want to use their representative genome.")
+parser.add_argument('-t', '--threads', action="store", type=int, default=4,
+                    help="Number of parallel downloads.")
+parser.add_argument('--base-url', action="store", type=str, default='http://ftp.ncbi.nlm.nih.gov/genomes',
+                    help="Where the <set>/<domain>/assembly_summary.txt files are, e.g. a local mirror or test server.")
+parser.add_argument('--no-refresh', action="store_true",
+                    help="Keep the assembly summaries already downloaded without asking NCBI whether they changed.")
+parser.add_argument('--diff-from', action="store", type=str, default=None,
+                    help="The --output directory of an older snapshot, to list the assemblies added, removed or changed since in <output>/assembly_summary/diff.")
+parser.add_argument('--plot', action="store_true",
+                    help="Also draw the Venn diagrams of RefSeq, GenBank and the representative genomes, one PDF per domain.")
+parser.add_argument('--fetch', action="store_true",
+                    help="Also fetch the genomes of the merged tables (_rep tables for the --rep domains, only the changed assemblies with --diff-from) " \
+                         "into Kraken2 library files in <output>/genomes, see fetch_genomes.py.")
 if debug:
     parser.print_help()
     # preset args for debugging
@@ -59,159 +69,125 @@ logging.info('Domain(rep): ' + ' '.join(args['rep']))
 logging.info('Set type: ' + args['set'])
 
 # %% download assembly summary
+# the files that are already there are only fetched again if NCBI has a newer version
 logging.info('*' * 10 + ' download assembly summary ' + '*' * 10)
 pathDict = dict()
 asDir = args['output'] + '/assembly_summary'
 if not os.path.isdir(asDir):
     os.mkdir(asDir)
+sets = {'rsgb': ['refseq', 'genbank'], 'refseq': ['refseq'], 'genbank': ['genbank']}[args['set']]
+jobs = []
 for i, d in enumerate(args['domain']):
     logging.info('Domian [' + str(i+1) + ']: ' + d)
-    if args['set'] in ['rsgb', 'refseq']:
-        rsURL = 'http://ftp.ncbi.nlm.nih.gov/genomes/refseq/' + d + '/assembly_summary.txt'
-        rsFile = asDir + '/refseq_' + d + '_assembly_summary.txt'
-        if not os.path.isfile(rsFile) or os.stat(rsFile).st_size == 0:
-            logging.info('From NCBI refseq to ' + rsFile)
-            urllib.request.urlretrieve(rsURL, rsFile)
-            logging.info('Done.')
+    for st in sets:
+        url = args['base_url'] + '/' + st + '/' + d + '/assembly_summary.txt'
+        asFile = asDir + '/' + st + '_' + d + '_assembly_summary.txt'
+        pathDict[d + '_' + st] = asFile
+        if args['no_refresh'] and os.path.isfile(asFile) and os.stat(asFile).st_size > 0:
+            logging.info(asFile + ' is already exist.')
         else:
-            logging.info(rsFile + ' is already exist.')
-        pathDict[d + '_refseq'] = rsFile
-    if args['set'] in ['rsgb', 'genbank']:
-        gbURL = 'http://ftp.ncbi.nlm.nih.gov/genomes/genbank/' + d + '/assembly_summary.txt'
-        gbFile = asDir + '/genbank_' + d + '_assembly_summary.txt'
-        if not os.path.isfile(gbFile) or os.stat(gbFile).st_size == 0:
-            logging.info('From NCBI genbank to ' + gbFile)
-            urllib.request.urlretrieve(gbURL, gbFile)
-            logging.info('Done.')
-        else:
-            logging.info(gbFile + ' is already exist.')
-        pathDict[d + '_genbank'] = gbFile
+            logging.info('From NCBI ' + st + ' to ' + asFile)
+            jobs.append((url, asFile))
+if jobs:
+    status = fetch_all(jobs, args['threads'])
+    failed = [p for p, s in status.items() if isinstance(s, FetchError)]
+    if failed:
+        # an older copy is still usable, a missing one is not
+        missing = [p for p in failed if not os.path.isfile(p)]
+        for p in failed:
+            logging.warning('Unable to refresh ' + p + (', no copy to fall back on.' if p in missing else ', using the copy already there.'))
+        if missing:
+            sys.exit(1)
 
 # %% load assembly summary, meanwhile check each column
+# only the columns used here are parsed, and the parsed tables are cached next to the downloads
 statDir = asDir + '/stat'
 if not os.path.isdir(statDir):
     os.mkdir(statDir)
 datDict = dict()
 for k,v in pathDict.items():
-    df = pd.read_csv(v, delimiter = '\t',  skiprows = 1)
+    df = load_summary(v, asDir + '/cache')
     datDict[k] = df
-    f = open(statDir + '/' + k + '_stat.txt', 'w')
-    f.write('***** col 1: accession *****' + '\n')
-    f.write('counts: ' + str(df['# assembly_accession'].count()) + '\n')
-    f.write('unique: ' + str(df['# assembly_accession'].nunique()) + '\n')
-    df['acc9'] = [re.findall(r"GC[AF]_(\d+)\.[0-9]+", ac)[0] for ac in df['# assembly_accession']]
-    f.write('unique acc9: ' + str(df['acc9'].nunique()), file = f)
-    f.write('\n***** col 5: refseq_category *****', file = f)
-    f.write(df['refseq_category'].value_counts(), file = f)
-    f.write('\n***** col 6: taxid *****', file = f)
-    f.write('unique: ' + str(df['taxid'].nunique()), file = f)
-    f.write('\n***** col 7: species_taxid *****', file = f)
-    f.write('unique: ' + str(df['species_taxid'].nunique()), file = f)
-    f.write('\n***** col 11: version_status *****', file = f)
-    f.write(df['version_status'].value_counts(), file = f)
-    f.write('\n***** col 12: assembly_level *****', file = f)
-    f.write(df['assembly_level'].value_counts(), file = f)
-    f.write('\n***** col 13: release_type *****', file = f)
-    f.write(df['release_type'].value_counts(), file = f)
-    f.write('\n***** col 14: genome_rep *****', file = f)
-    f.write(df['genome_rep'].value_counts(), file = f)
-    f.write('\n***** col 18: gbrs_paired_asm *****', file = f)
-    f.write('paried:' + str(sum(df['gbrs_paired_asm'] != 'na')), file = f)
-    f.write('no paried:' + str(sum(df['gbrs_paired_asm'] == 'na')), file = f)
-    f.write('\n***** col 19: paired_asm_comparsion *****', file = f)
-    f.write(df['paired_asm_comp'].value_counts(), file = f)
-    f.close()
+    with open(statDir + '/' + k + '_stat.txt', 'w') as f:
+        f.write('***** col 1: accession *****' + '\n')
+        f.write('counts: ' + str(df['assembly_accession'].count()) + '\n')
+        f.write('unique: ' + str(df['assembly_accession'].nunique()) + '\n')
+        f.write('unique acc9: ' + str(df['acc9'].nunique()) + '\n')
+        f.write('\n***** col 5: refseq_category *****\n')
+        f.write(df['refseq_category'].value_counts().to_string() + '\n')
+        f.write('\n***** col 6: taxid *****\n')
+        f.write('unique: ' + str(df['taxid'].nunique()) + '\n')
+        f.write('\n***** col 7: species_taxid *****\n')
+        f.write('unique: ' + str(df['species_taxid'].nunique()) + '\n')
+        f.write('\n***** col 11: version_status *****\n')
+        f.write(df['version_status'].value_counts().to_string() + '\n')
+        f.write('\n***** col 12: assembly_level *****\n')
+        f.write(df['assembly_level'].value_counts().to_string() + '\n')
+        f.write('\n***** col 13: release_type *****\n')
+        f.write(df['release_type'].value_counts().to_string() + '\n')
+        f.write('\n***** col 14: genome_rep *****\n')
+        f.write(df['genome_rep'].value_counts().to_string() + '\n')
+        f.write('\n***** col 18: gbrs_paired_asm *****\n')
+        f.write('paried: ' + str(int((df['gbrs_paired_asm'] != 'na').sum())) + '\n')
+        f.write('no paried: ' + str(int((df['gbrs_paired_asm'] == 'na').sum())) + '\n')
+        f.write('\n***** col 19: paired_asm_comparsion *****\n')
+        f.write(df['paired_asm_comp'].value_counts().to_string() + '\n')
 
 # %% union refseq and genbank
+# the overlap of refseq, genbank and the representative genomes is counted once per domain into a table
 logging.info('*' * 10 + ' union refseq and genbank ' + '*' * 10)
 uDict = dict()
-mycol = ('#80B1D3', '#FDB462', '#B3DE68')
-linewidth = 0.7
-linestyle = 'dashed'
-figHeight = 4 * len(args['domain'])
-fig, axs=plt.subplots(len(args['domain']), 6, figsize=(24, figHeight), dpi=150)
+overlaps = []
 for i, d in enumerate(args['domain']):
     logging.info('Domian [' + str(i+1) + ']: ' + d)
     rsDF = datDict[d + '_refseq']
     gbDF = datDict[d + '_genbank']
-    acc2add = set(gbDF['acc9']) - set(rsDF['acc9'])
-    uDF = pd.concat([rsDF, gbDF[gbDF['acc9'].isin(acc2add)]])
+    gbAdd = gbDF[~gbDF['acc9'].isin(rsDF['acc9'])]
+    uDF = pd.concat([rsDF, gbAdd])
     uDict[d] = uDF
+    # the merged tables are the original lines of both files, so every column is kept
+    outPrefix = args['output'] + '/assembly_summary/' + args['set'] + '_' + d
     if d in args['rep']:
         logging.info('Also output the table only contain representative genome.')
-        uDict[d + '_rep'] = uDF[uDF['refseq_category'].isin(['representative genome', 'reference genome'])]
-        uDict[d + '_rep'].to_csv(args['output'] + '/assembly_summary/' + args['set'] + '_' + d + '_rep_assembly_summary.txt', index = None, sep = '\t')
-    uDF.to_csv(args['output'] + '/assembly_summary/' + args['set'] + '_' + d + '_assembly_summary.txt', index = None, sep = '\t')
-    g=venn2_unweighted([set(rsDF['acc9']), set(gbDF['acc9'])], 
-            set_labels = ('RefSeq', 'GenBank'), 
-            set_colors = mycol,
-            alpha = 0.6,
-            normalize_to = 1.0,
-            ax = axs[i, 0]
-        )
-    g=venn2_circles(subsets = (1, 1, 1), ax = axs[i, 0], 
-                    linewidth = linewidth, linestyle = linestyle)
-    g=venn2_unweighted([set(rsDF['taxid']), set(gbDF['taxid'])], 
-            set_labels = ('RefSeq', 'GenBank'), 
-            set_colors = mycol,
-            alpha = 0.6,
-            normalize_to = 1.0,
-            ax = axs[i, 1]
-        )
-    g=venn2_circles(subsets = (1, 1, 1), ax = axs[i, 1], 
-                    linewidth = linewidth, linestyle = linestyle)
-    g=venn2_unweighted([set(rsDF['species_taxid']), set(gbDF['species_taxid'])], 
-            set_labels = ('RefSeq', 'GenBank'), 
-            set_colors = mycol,
-            alpha = 0.6,
-            normalize_to = 1.0,
-            ax = axs[i, 2]
-        )
-    g=venn2_circles(subsets = (1, 1, 1), ax = axs[i, 2], 
-                    linewidth = linewidth, linestyle = linestyle)
-    title = [d, 'Accession', 'taxid', 'species_taxid']
-    axs[i, 0].title.set_text(d.capitalize() + ' accession')
-    axs[i, 1].title.set_text(d.capitalize() + ' taxid')
-    axs[i, 2].title.set_text(d.capitalize() + ' species_taxid')
+        uDict[d + '_rep'] = uDF[uDF['refseq_category'].isin(REPRESENTATIVE)]
+        write_rows(outPrefix + '_rep_assembly_summary.txt',
+                   [(pathDict[d + '_refseq'], rsDF['row'][rsDF['refseq_category'].isin(REPRESENTATIVE)]),
+                    (pathDict[d + '_genbank'], gbAdd['row'][gbAdd['refseq_category'].isin(REPRESENTATIVE)])])
+    write_rows(outPrefix + '_assembly_summary.txt', [(pathDict[d + '_refseq'], rsDF['row']), (pathDict[d + '_genbank'], gbAdd['row'])])
+    overlaps += domain_overlaps(d, rsDF, gbDF, uDF[uDF['refseq_category'].isin(REPRESENTATIVE)])
+overlapPath = statDir + '/' + args['set'] + '_overlap.txt'
+write_overlaps(overlapPath, overlaps)
+logging.info('Overlap of RefSeq, GenBank and representative genomes was saved to ' + overlapPath)
+
+# %% plot venn diagrams
+if args['plot']:
+    plotPath = args['output'] + '/assembly_summary/plot'
+    if not os.path.isdir(plotPath):
+        os.mkdir(plotPath)
+    plot_overlaps(overlapPath, plotPath + '/' + args['set'], args['domain'])
+    logging.info('Venn diagram for RefSeq and GenBank accession was saved to ' + plotPath)
 
-    repAcc9 = uDF['acc9'][uDF['refseq_category'].isin(['representative genome', 'reference genome'])]
-    g=venn3_unweighted([set(rsDF['acc9']), set(gbDF['acc9']), set(repAcc9)], 
-            set_labels = ('RefSeq', 'GenBank', 'Representative'), 
-            set_colors = mycol,
-            alpha = 0.6,
-            normalize_to = 1.0,
-            ax = axs[i, 3]
-        )
-    g=venn3_circles(subsets = (1, 1, 1, 1, 1, 1, 1), ax = axs[i, 3], 
-                    linewidth = linewidth, linestyle = linestyle)
-    
-    repAcc9 = uDF['taxid'][uDF['refseq_category'].isin(['representative genome', 'reference genome'])]
-    g=venn3_unweighted([set(rsDF['taxid']), set(gbDF['taxid']), set(repAcc9)], 
-            set_labels = ('RefSeq', 'GenBank', 'Representative'), 
-            set_colors = mycol,
-            alpha = 0.6,
-            normalize_to = 1.0,
-            ax = axs[i, 4]
-        )
-    g=venn3_circles(subsets = (1, 1, 1, 1, 1, 1, 1), ax = axs[i, 4], 
-                    linewidth = linewidth, linestyle = linestyle)
-    repAcc9 = uDF['species_taxid'][uDF['refseq_category'].isin(['representative genome', 'reference genome'])]
-    g=venn3_unweighted([set(rsDF['species_taxid']), set(gbDF['species_taxid']), set(repAcc9)], 
-            set_labels = ('RefSeq', 'GenBank', 'Representative'), 
-            set_colors = mycol,
-            alpha = 0.6,
-            normalize_to = 1.0,
-            ax = axs[i, 5]
-        )
-    g=venn3_circles(subsets = (1, 1, 1, 1, 1, 1, 1), ax = axs[i, 5], 
-                    linewidth = linewidth, linestyle = linestyle)
-    title = [d, 'Accession', 'taxid', 'species_taxid']
-    axs[i, 3].title.set_text(d.capitalize() + ' accession')
-    axs[i, 4].title.set_text(d.capitalize() + ' taxid')
-    axs[i, 5].title.set_text(d.capitalize() + ' species_taxid')
-plotPath = args['output'] + '/assembly_summary/plot'
-if not os.path.isdir(plotPath):
-    os.mkdir(plotPath)
-plt.savefig(plotPath + '/' + args['set'] + '_venn.pdf')
-logging.info('Venn diagram for RefSeq and GenBank accession was saved to ' + plotPath)
+# %% diff with an older snapshot
+if args['diff_from']:
+    logging.info('*' * 10 + ' diff with ' + args['diff_from'] + ' ' + '*' * 10)
+    diffDir = args['output'] + '/assembly_summary/diff'
+    diff_snapshots(args['diff_from'], args['output'], diffDir, args['set'], args['domain'])
+    logging.info('Added, removed and changed assemblies were saved to ' + diffDir)
 
+# %% fetch genomes
+if args['fetch']:
+    logging.info('*' * 10 + ' fetch genomes ' + '*' * 10)
+    tables = []
+    for d in args['domain']:
+        name = args['set'] + '_' + d + ('_rep' if d in args['rep'] else '')
+        if args['diff_from']:
+            tables.append(diffDir + '/' + name + '_changed_assembly_summary.txt')
+        else:
+            tables.append(args['output'] + '/assembly_summary/' + name + '_assembly_summary.txt')
+    genomeDir = args['output'] + '/genomes'
+    status = fetch_genomes(load_assemblies(tables), genomeDir, args['threads'], args['base_url'])
+    failed = [a for a, s in status.items() if isinstance(s, FetchError)]
+    if failed:
+        logging.error(str(len(failed)) + ' assemblies could not be fetched, e.g. ' + failed[0])
+        sys.exit(1)
+    logging.info('Library files were saved to ' + genomeDir + '/library')
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Demultiplex the combined classified/unclassified fastq files of a
+# Kraken2 run into one file per sample. Kraken2 writes them in the order
+# of the input, so each sample is a run of consecutive records whose
+# length is the number of C (or U) lines in its <sample>out.txt. Every
+# combined file is read once, in blocks, and the files are processed in
+# parallel threads; plain or gzip compressed output.
+#################################################################
+import argparse, os, sys, time, gzip, logging
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentDefaultsHelpFormatter
+from split_kraken2_output import BLOCK_SIZE, LineBlock, read_sample_reads
+
+LINES_PER_READ = 4
+# the per-sample files are intermediate, favour speed over size
+GZIP_LEVEL = 1
+
+def count_classified(path, blockSize = BLOCK_SIZE):
+    """Return (classified, unclassified) line counts of a Kraken2 output file."""
+    classified = lines = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(blockSize)
+            if not buf:
+                break
+            # every line starts with its C/U status, so a C after a newline starts a classified line
+            classified += (last + buf).count(b'\nC')
+            lines += buf.count(b'\n')
+            last = buf[-1:]
+    return classified, lines - classified
+
+def combined_names(kind, paired):
+    """Names of the combined files Kraken2 writes for kind 'classified' or 'unclassified'."""
+    if paired:
+        return [kind + '_seqs_1.fastq', kind + '_seqs_2.fastq']
+    return [kind + '_seqs.fastq']
+
+def sample_fastq(outDir, sample, combinedName, gzipped):
+    return os.path.join(outDir, sample + combinedName + ('.gz' if gzipped else ''))
+
+def demux_file(combinedPath, outPaths, readCounts, blockSize = BLOCK_SIZE):
+    """Copy readCounts[i] records of combinedPath into outPaths[i] (gzip if it ends in .gz, skipped if None).
+
+    Returns the number of records found for each sample.
+    """
+    need = [n * LINES_PER_READ for n in readCounts]
+    lines = [0] * len(readCounts)
+    ind = 0
+    out = None
+    with open(combinedPath, 'rb') as inF:
+        block = LineBlock()
+        while ind < len(readCounts):
+            if out is None and outPaths[ind] is not None:
+                if outPaths[ind].endswith('.gz'):
+                    out = gzip.open(outPaths[ind], 'wb', compresslevel = GZIP_LEVEL)
+                else:
+                    out = open(outPaths[ind], 'wb')
+            if not block:
+                block = LineBlock(inF.read(blockSize))
+                if not block:
+                    break
+            left = need[ind] - lines[ind]
+            nlines = block.lines()
+            if nlines < left:
+                # the rest of the block belongs to the current sample
+                data = block.take()
+                if out is not None:
+                    out.write(data)
+                lines[ind] += nlines
+                continue
+            data = block.take(left)
+            if out is not None:
+                out.write(data)
+                out.close()
+                out = None
+            lines[ind] += left
+            ind += 1
+        if out is not None:
+            out.close()
+        extra = len(block) or inF.read(1)
+    found = [n // LINES_PER_READ for n in lines]
+    # samples never reached because the combined file was too short still get an (empty) file
+    for j in range(ind + 1, len(readCounts)):
+        if outPaths[j] is not None:
+            (gzip.open if outPaths[j].endswith('.gz') else open)(outPaths[j], 'wb').close()
+    name = os.path.basename(combinedPath)
+    if ind == len(readCounts) and extra:
+        logging.warning(name + ' has more records than the samples account for, the extra ones are ignored.')
+    for j, n in enumerate(readCounts):
+        if found[j] != n:
+            logging.error(name + ': expected ' + str(n) + ' records for sample ' + str(j+1) + ' but got ' + str(found[j]) + '.')
+    return found
+
+def demux_samples(workDir, outDir, sampleNames, classifiedCounts, unclassifiedCounts, paired, gzipped = False, threads = 1, todo = None):
+    """Demultiplex the classified and unclassified fastq files of workDir into outDir.
+
+    Only the samples in todo (all by default) are written. Returns
+    {sample: [its output files]} of the samples whose record counts
+    matched in every combined file.
+    """
+    todo = set(sampleNames if todo is None else todo)
+    jobs = []
+    for kind, counts in (('classified', classifiedCounts), ('unclassified', unclassifiedCounts)):
+        for name in combined_names(kind, paired):
+            outPaths = [sample_fastq(outDir, s, name, gzipped) if s in todo else None for s in sampleNames]
+            jobs.append((os.path.join(workDir, name), outPaths, counts))
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers = max(1, min(threads, len(jobs)))) as pool:
+        futures = [pool.submit(demux_file, *job) for job in jobs]
+        results = [f.result() for f in futures]
+    ok = {s: [] for s in sampleNames if s in todo}
+    for (path, outPaths, counts), found in zip(jobs, results):
+        for s, p, n, w in zip(sampleNames, outPaths, counts, found):
+            if s in ok and n == w:
+                ok[s].append(p)
+            elif s in ok:
+                del ok[s]
+    elapsed = time.time() - t0
+    nbytes = sum(os.path.getsize(j[0]) for j in jobs)
+    rate = nbytes / 1e6 / elapsed if elapsed > 0 else float('inf')
+    logging.info('demultiplexed ' + str(len(jobs)) + ' fastq files in ' + '{:.2f}'.format(elapsed) + ' s (' + '{:.1f}'.format(rate) + ' MB/s)')
+    return ok
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'demux_fastq',
+                                     description = 'Split the combined classified/unclassified fastq files of a Kraken2 run into one file per sample.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-w', '--workdir', type = str, required = True,
+                        help = 'The directory of the combined classified_seqs*.fastq and unclassified_seqs*.fastq files.')
+    parser.add_argument('-c', '--counts', type = str, required = True,
+                        help = 'A two-column tab separated file of sample name and read count, in the order of the run (e.g. tmp/sample_reads.tsv).')
+    parser.add_argument('-k', '--kraken-out', type = str, required = True,
+                        help = 'The directory of the per-sample <sample>out.txt files.')
+    parser.add_argument('-o', '--output', type = str, default = '.',
+                        help = 'A directory for saving the per-sample fastq files.')
+    parser.add_argument('--paired', action = 'store_true',
+                        help = 'The run was paired-end (classified_seqs_1/_2.fastq).')
+    parser.add_argument('--gzip', action = 'store_true',
+                        help = 'Compress the per-sample files with gzip.')
+    parser.add_argument('-t', '--threads', type = int, default = 4,
+                        help = 'Number of combined files processed at once.')
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s > %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S')
+    sampleNames, _ = read_sample_reads(opt.counts)
+    counts = [count_classified(os.path.join(opt.kraken_out, s + 'out.txt')) for s in sampleNames]
+    ok = demux_samples(opt.workdir, opt.output, sampleNames, [c for c, _ in counts], [u for _, u in counts],
+                       opt.paired, opt.gzip, opt.threads)
+    if len(ok) != len(sampleNames):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
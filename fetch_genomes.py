@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Fetch the genomes listed in assembly summary tables (the merged,
+# _rep or _changed tables of deal_with_assembly_summary.py and
+# assembly_diff.py) and turn them into Kraken2 library files. A pool of
+# threads, each keeping its connection to the server open, reads the
+# md5checksums.txt of every assembly and streams its _genomic.fna.gz
+# through the md5 and the decompressor straight into
+# <output>/library/<accession>.fna, with the taxid of the assembly in
+# every header (>NC_000913.3|kraken:taxid|511145 ...). A file that
+# does not match its md5 is dropped and fetched again. Verified
+# assemblies are listed in <output>/verified.tsv and skipped by later
+# runs. With -l the files are also concatenated, in the order of the
+# tables, into one FASTA for kraken2-build --add-to-library.
+#################################################################
+import argparse, os, re, sys, time, zlib, shutil, hashlib, logging, threading
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentDefaultsHelpFormatter
+from http_fetch import Fetcher, FetchError, CHUNK_SIZE
+from assembly_summary import load_summary
+
+VERIFIED = 'verified.tsv'
+HEADER_RE = re.compile(rb'^>(\S+)', re.M)
+
+def genome_urls(ftpPath, baseUrl = None):
+    """Return the URLs of the _genomic.fna.gz and md5checksums.txt of an assembly."""
+    if baseUrl:
+        # the part below genomes/ is the same on every mirror
+        ftpPath = baseUrl.rstrip('/') + ftpPath[ftpPath.index('/genomes/') + len('/genomes'):]
+    elif ftpPath.startswith('ftp://'):
+        ftpPath = 'https://' + ftpPath[len('ftp://'):]
+    return ftpPath + '/' + ftpPath.rstrip('/').split('/')[-1] + '_genomic.fna.gz', ftpPath + '/md5checksums.txt'
+
+def load_verified(outDir):
+    path = os.path.join(outDir, VERIFIED)
+    verified = dict()
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                acc, md5, size = line.rstrip('\n').split('\t')
+                verified[acc] = (md5, int(size))
+    return verified
+
+class LibraryWriter(object):
+    """Decompress gzip data fed in pieces and write it with taxid-tagged headers, hashing the compressed bytes."""
+    def __init__(self, f, taxid):
+        self.f = f
+        self.tag = b'>\\1|kraken:taxid|' + str(taxid).encode()
+        self.md5 = hashlib.md5()
+        self.z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.rest = b''
+
+    def write(self, data):
+        self.md5.update(data)
+        while data:
+            if self.z.eof:
+                # the next gzip member
+                self.z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self.emit(self.z.decompress(data))
+            data = self.z.unused_data if self.z.eof else b''
+
+    def emit(self, text):
+        text = self.rest + text
+        # a header may continue in the next piece, so the last line waits
+        cut = text.rfind(b'\n') + 1
+        self.rest = text[cut:]
+        if cut:
+            self.f.write(HEADER_RE.sub(self.tag, text[:cut]))
+
+    def close(self):
+        if not self.z.eof:
+            raise zlib.error('the gzip data is truncated')
+        if self.rest:
+            self.f.write(HEADER_RE.sub(self.tag, self.rest + b'\n'))
+            self.rest = b''
+        return self.md5.hexdigest()
+
+class GenomeFetcher(object):
+    """Fetch assemblies into library files with one persistent connection per thread."""
+    def __init__(self, outDir, baseUrl = None, timeout = 60, retries = 3):
+        self.outDir = outDir
+        self.libDir = os.path.join(outDir, 'library')
+        os.makedirs(self.libDir, exist_ok = True)
+        self.baseUrl = baseUrl
+        self.retries = retries
+        self.fetcher = Fetcher(timeout, retries)
+        self.verified = load_verified(outDir)
+        self.lock = threading.Lock()
+
+    def open(self, url):
+        """Return a file-like object with the body of url, file:// URLs are read from disk."""
+        parts = urlsplit(url)
+        if parts.scheme == 'file':
+            return open(parts.path, 'rb')
+        _, resp = self.fetcher.request(url, dict())
+        if resp.status != 200:
+            resp.read()
+            raise FetchError(url + ': HTTP ' + str(resp.status) + ' ' + resp.reason)
+        return resp
+
+    def expected_md5(self, md5Url, fileName):
+        f = self.open(md5Url)
+        try:
+            text = f.read().decode()
+        finally:
+            f.close()
+        for line in text.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and os.path.basename(fields[1]) == fileName:
+                return fields[0]
+        raise FetchError(fileName + ' is not in ' + md5Url)
+
+    def library_path(self, acc):
+        return os.path.join(self.libDir, acc + '.fna')
+
+    def fetch(self, acc, ftpPath, taxid):
+        """Bring the library file of an assembly up to date, returns 'verified', 'fetched' or 'retried'."""
+        if acc in self.verified and os.path.isfile(self.library_path(acc)) and os.path.getsize(self.library_path(acc)) == self.verified[acc][1]:
+            return 'verified'
+        fnaUrl, md5Url = genome_urls(ftpPath, self.baseUrl)
+        error = None
+        for attempt in range(self.retries):
+            try:
+                md5 = self._fetch(acc, fnaUrl, md5Url, taxid)
+                with self.lock:
+                    self.verified[acc] = (md5, os.path.getsize(self.library_path(acc)))
+                    with open(os.path.join(self.outDir, VERIFIED), 'a') as f:
+                        f.write(acc + '\t' + md5 + '\t' + str(self.verified[acc][1]) + '\n')
+                return 'retried' if attempt else 'fetched'
+            except (OSError, zlib.error, http.client.HTTPException, FetchError) as e:
+                error = e
+                logging.warning(acc + ': ' + str(e) + ', attempt ' + str(attempt + 1) + '/' + str(self.retries))
+                if os.path.isfile(self.library_path(acc) + '.tmp'):
+                    os.remove(self.library_path(acc) + '.tmp')
+                parts = urlsplit(fnaUrl)
+                if parts.scheme != 'file':
+                    self.fetcher.connection(parts.scheme, parts.netloc, fresh = True)
+                time.sleep(min(2 ** attempt, 30))
+        raise FetchError('Unable to fetch ' + acc + ': ' + str(error))
+
+    def _fetch(self, acc, fnaUrl, md5Url, taxid):
+        expected = self.expected_md5(md5Url, fnaUrl.split('/')[-1])
+        out = self.library_path(acc)
+        src = self.open(fnaUrl)
+        try:
+            with open(out + '.tmp', 'wb') as f:
+                writer = LibraryWriter(f, taxid)
+                size = 0
+                while True:
+                    block = src.read(CHUNK_SIZE)
+                    if not block:
+                        break
+                    size += len(block)
+                    writer.write(block)
+                length = src.getheader('Content-Length') if hasattr(src, 'getheader') else None
+                if length is not None and size != int(length):
+                    raise http.client.IncompleteRead(b'', int(length) - size)
+                md5 = writer.close()
+        finally:
+            src.close()
+        if md5 != expected:
+            os.remove(out + '.tmp')
+            raise FetchError(fnaUrl.split('/')[-1] + ' has md5 ' + md5 + ', expected ' + expected)
+        os.replace(out + '.tmp', out)
+        return md5
+
+    def close(self):
+        self.fetcher.close()
+
+def load_assemblies(tables):
+    """Return [(accession, ftp_path, taxid)] of the tables, once per accession, in their order."""
+    res, seen = [], set()
+    for t in tables:
+        df = load_summary(t)
+        na = df['ftp_path'].isin(['na', ''])
+        if na.any():
+            logging.warning(t + ': ' + str(int(na.sum())) + ' assemblies without ftp_path are skipped.')
+        for acc, ftpPath, taxid in zip(df['assembly_accession'][~na], df['ftp_path'][~na], df['taxid'][~na]):
+            if acc not in seen:
+                seen.add(acc)
+                res.append((acc, ftpPath, int(taxid)))
+    return res
+
+def fetch_genomes(assemblies, outDir, threads = 4, baseUrl = None, timeout = 60, retries = 3):
+    """Fetch a list of (accession, ftp_path, taxid), returns {accession: status or FetchError}."""
+    t0 = time.time()
+    gf = GenomeFetcher(outDir, baseUrl, timeout, retries)
+    def run(a):
+        try:
+            return gf.fetch(*a)
+        except FetchError as e:
+            logging.error(str(e))
+            return e
+    try:
+        with ThreadPoolExecutor(max_workers = max(1, min(threads, len(assemblies)))) as pool:
+            res = dict(zip([a[0] for a in assemblies], pool.map(run, assemblies)))
+    finally:
+        gf.close()
+    done = [s for s in res.values() if not isinstance(s, FetchError)]
+    size = sum(os.path.getsize(gf.library_path(a)) for a, s in res.items() if not isinstance(s, FetchError))
+    logging.info(str(len(done)) + '/' + str(len(assemblies)) + ' assemblies in the library (' +
+                 ', '.join(str(done.count(s)) + ' ' + s for s in ('fetched', 'retried', 'verified')) + '), ' +
+                 '{:.1f}'.format(size / 1024 ** 2) + ' MB in ' + '{:.2f}'.format(time.time() - t0) + ' s')
+    return res
+
+def concat_library(outDir, accessions, libraryPath):
+    """Concatenate the library files of the accessions, in their order, into one FASTA."""
+    with open(libraryPath + '.tmp', 'wb') as out:
+        for acc in accessions:
+            with open(os.path.join(outDir, 'library', acc + '.fna'), 'rb') as f:
+                shutil.copyfileobj(f, out, CHUNK_SIZE)
+    os.replace(libraryPath + '.tmp', libraryPath)
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'fetch_genomes',
+                                     description = 'Fetch and verify the genomes of assembly summary tables into Kraken2 library files.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', type = str, nargs = '+', required = True,
+                        help = 'Assembly summary tables, e.g. rsgb_bacteria_assembly_summary.txt or rsgb_plant_rep_assembly_summary.txt.')
+    parser.add_argument('-o', '--output', type = str, required = True,
+                        help = 'A directory for the library files and verified.tsv.')
+    parser.add_argument('-t', '--threads', type = int, default = 4,
+                        help = 'Number of download threads.')
+    parser.add_argument('-l', '--library', type = str, default = None,
+                        help = 'Also concatenate the library files into this FASTA.')
+    parser.add_argument('--base-url', type = str, default = None,
+                        help = 'Fetch from this mirror of https://ftp.ncbi.nlm.nih.gov/genomes instead of the ftp_path '
+                               '(http(s):// or file://), e.g. benchmark/http_stand_in.py.')
+    parser.add_argument('--retries', type = int, default = 3,
+                        help = 'Attempts per assembly.')
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s > %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S')
+    assemblies = load_assemblies(opt.input)
+    res = fetch_genomes(assemblies, opt.output, opt.threads, opt.base_url, retries = opt.retries)
+    failed = [a for a, s in res.items() if isinstance(s, FetchError)]
+    if failed:
+        logging.error(str(len(failed)) + ' assemblies could not be fetched, e.g. ' + failed[0])
+        sys.exit(1)
+    if opt.library:
+        concat_library(opt.output, [a[0] for a in assemblies], opt.library)
+        logging.info('Library saved to ' + opt.library)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Download files over HTTP(S) with a bounded pool of threads, each
+# keeping one persistent connection per host. A file that is already
+# there is only fetched again if the server says it changed (ETag /
+# If-None-Match, Last-Modified / If-Modified-Since, kept in a
+# <file>.meta.json sidecar). Data goes to <file>.part and is renamed
+# into place once complete, and an interrupted .part is resumed with a
+# Range request (If-Range keeps it from being glued to a newer file).
+#################################################################
+import argparse, os, sys, json, time, logging, threading
+import http.client
+from urllib.parse import urlsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentDefaultsHelpFormatter
+
+CHUNK_SIZE = 1024 * 1024
+MAX_REDIRECTS = 5
+USER_AGENT = 'K2ols-http-fetch'
+
+class FetchError(Exception):
+    pass
+
+def meta_path(path):
+    return path + '.meta.json'
+
+def load_meta(path):
+    try:
+        with open(meta_path(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+def save_meta(path, meta):
+    tmp = meta_path(path) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent = 1)
+    os.replace(tmp, meta_path(path))
+
+class Fetcher(object):
+    """Conditional, resumable downloads over connections kept open per thread and host."""
+    def __init__(self, timeout = 60, retries = 3):
+        self.timeout = timeout
+        self.retries = retries
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = []
+
+    def connection(self, scheme, netloc, fresh = False):
+        conns = self.local.__dict__.setdefault('conns', dict())
+        key = (scheme, netloc)
+        if fresh and key in conns:
+            conns.pop(key).close()
+        if key not in conns:
+            cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            conns[key] = cls(netloc, timeout = self.timeout)
+            with self.lock:
+                self.opened.append(conns[key])
+        return conns[key]
+
+    def request(self, url, headers):
+        """Send a GET, following redirects, and return (final url, response) with the body unread."""
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            target = parts.path + ('?' + parts.query if parts.query else '')
+            for attempt in (0, 1):
+                # a kept-alive connection the server has since closed fails once, then a new one is opened
+                conn = self.connection(parts.scheme, parts.netloc, fresh = attempt > 0)
+                try:
+                    conn.request('GET', target, headers = dict(headers, **{'User-Agent': USER_AGENT}))
+                    resp = conn.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, http.client.CannotSendRequest, BrokenPipeError, ConnectionResetError):
+                    if attempt:
+                        raise
+            if resp.status in (301, 302, 303, 307, 308):
+                resp.read()
+                url = urljoin(url, resp.getheader('Location'))
+                continue
+            return url, resp
+        raise FetchError('Too many redirects for ' + url)
+
+    def fetch(self, url, path):
+        """Bring path up to date with url, returns 'downloaded', 'resumed' or 'not modified'."""
+        error = None
+        for attempt in range(self.retries):
+            try:
+                return self._fetch(url, path)
+            except (OSError, http.client.HTTPException) as e:
+                error = e
+                logging.warning('Fetching ' + url + ' failed (' + str(e) + '), attempt ' + str(attempt + 1) + '/' + str(self.retries))
+                self.connection(urlsplit(url).scheme, urlsplit(url).netloc, fresh = True)
+                time.sleep(min(2 ** attempt, 30))
+        raise FetchError('Unable to fetch ' + url + ': ' + str(error))
+
+    def _fetch(self, url, path):
+        meta = load_meta(path)
+        part = path + '.part'
+        headers = dict()
+        partSize = os.path.getsize(part) if os.path.isfile(part) else 0
+        if partSize and meta.get('partial') and meta.get('url') == url:
+            validator = meta['partial'].get('etag') or meta['partial'].get('last_modified')
+            if validator:
+                headers['Range'] = 'bytes=' + str(partSize) + '-'
+                headers['If-Range'] = validator
+        elif os.path.isfile(path) and meta.get('url') == url:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        _, resp = self.request(url, headers)
+        if resp.status == 304:
+            resp.read()
+            return 'not modified'
+        if resp.status == 416:
+            # the .part is already complete (or longer than the file), start over
+            resp.read()
+            os.remove(part)
+            save_meta(path, {k: v for k, v in meta.items() if k != 'partial'})
+            return self._fetch(url, path)
+        if resp.status not in (200, 206):
+            resp.read()
+            raise FetchError(url + ': HTTP ' + str(resp.status) + ' ' + resp.reason)
+        resumed = resp.status == 206
+        validators = {'etag': resp.getheader('ETag'), 'last_modified': resp.getheader('Last-Modified')}
+        if not resumed:
+            partSize = 0
+        # remember what the .part belongs to, so an interrupted transfer can be resumed
+        save_meta(path, dict(meta, url = url, partial = validators))
+        with open(part, 'ab' if resumed else 'wb') as f:
+            while True:
+                block = resp.read(CHUNK_SIZE)
+                if not block:
+                    break
+                f.write(block)
+        length = resp.getheader('Content-Length')
+        if length is not None and os.path.getsize(part) != partSize + int(length):
+            # retried by fetch(), which resumes the .part
+            raise http.client.IncompleteRead(b'', partSize + int(length) - os.path.getsize(part))
+        os.replace(part, path)
+        save_meta(path, dict(validators, url = url, size = os.path.getsize(path), fetched = time.strftime('%Y-%m-%d %H:%M:%S')))
+        return 'resumed' if resumed else 'downloaded'
+
+    def close(self):
+        with self.lock:
+            for conn in self.opened:
+                conn.close()
+            self.opened = []
+
+def fetch_all(jobs, threads = 4, timeout = 60, retries = 3):
+    """Fetch a list of (url, path) pairs with a pool of threads, returns {path: status or FetchError}."""
+    fetcher = Fetcher(timeout, retries)
+    def run(job):
+        url, path = job
+        t0 = time.time()
+        try:
+            status = fetcher.fetch(url, path)
+        except FetchError as e:
+            logging.error(str(e))
+            return e
+        logging.info(os.path.basename(path) + ': ' + status + ' in ' + '{:.2f}'.format(time.time() - t0) + ' s')
+        return status
+    t0 = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers = max(1, min(threads, len(jobs)))) as pool:
+            res = dict(zip([p for _, p in jobs], pool.map(run, jobs)))
+    finally:
+        fetcher.close()
+    done = [s for s in res.values() if not isinstance(s, FetchError)]
+    logging.info(str(len(done)) + '/' + str(len(jobs)) + ' files fetched (' +
+                 ', '.join(str(done.count(s)) + ' ' + s for s in ('downloaded', 'resumed', 'not modified')) + ') in ' +
+                 '{:.2f}'.format(time.time() - t0) + ' s')
+    return res
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'http_fetch',
+                                     description = 'Download files conditionally and resumably with a pool of persistent connections.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-u', '--url', type = str, nargs = '+', required = True,
+                        help = 'URLs to fetch.')
+    parser.add_argument('-o', '--output', type = str, default = '.',
+                        help = 'A directory for the files, named after the last part of their URL.')
+    parser.add_argument('-t', '--threads', type = int, default = 4,
+                        help = 'Number of download threads.')
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s > %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S')
+    os.makedirs(opt.output, exist_ok = True)
+    res = fetch_all([(u, os.path.join(opt.output, os.path.basename(urlsplit(u).path))) for u in opt.url], opt.threads)
+    if any(isinstance(s, FetchError) for s in res.values()):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -5,9 +5,21 @@
 # Updated: 07/06/2021
 debug = False
 # %% import modules
-import argparse, os, re, sys, subprocess, logging
+import argparse, os, re, sys, json, time, shutil, subprocess, logging, threading
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentDefaultsHelpFormatter
-import numpy as np
+from split_kraken2_output import split_output, write_sample_reads, OutputTailer
+from binary_output import convert_files, SUFFIX as BINARY_SUFFIX
+from count_reads import ReadCountManifest, copy_and_count, count_reads, BLOCK_SIZE as COPY_BLOCK
+from stream_samples import SampleStreamer
+from kreport_builder import KTaxonomy, build_kreports, submit_kreport
+from taxonomy_cache import load_taxonomy_cache, taxonomy_pool
+from batch_scheduler import parse_size, plan_batches, load_or_plan, batch_dir, available_memory, db_memory, load_or_plan_shards, shard_dir
+from run_manifest import RunManifest, fingerprints
+from stage_metrics import StageMetrics
+from demux_fastq import count_classified, combined_names, demux_samples
+from abundance_matrix import matrix_from_outputs, matrix_from_kreports
+from confidence_sweep import parse_thresholds, sweep, threshold_dir
 # %% pass arguments
 parser = argparse.ArgumentParser(prog = 'kraken2M', 
                                  description = 'Species classification for multiple (paired/single-end) fastq files one time with Kraken2, in order not to load the super index repeatly. Most of the following arguments are originated from Kraken2, not supporting the modification of other Kraken2 arguments, just using their default value setted by Kraken2. Please clone KrakenTools by jenniferlu717 from https://github.com/lexinwei/KrakenTools.git before running.', 
@@ -18,8 +30,8 @@ Rflag.add_argument('-i', '--input', type = str, required = True,
                     help = 'A directory of multiple fastq files, only the files with names ending in specific suffix (given by -s arguments) will be loaded.')
 Rflag.add_argument('-s', '--suffix', action="store", type=str, required = True, default = None, 
                     help="Specify the suffix of reads files, e.g. 'R1.fastq,R2.fastq' for paired-end files, '.fq' for single-end files.")
-Rflag.add_argument('-d', '--db', action="store", type=str, required = True, 
-                    help= "Name for Kraken2 DB.")
+Rflag.add_argument('-d', '--db', action="store", type=str, nargs = '+', required = True, 
+                    help= "Name for Kraken2 DB. Several DBs classify the same staged reads, each into its own <output>/<DB name> directory.")
 Rflag.add_argument('-k', '--kraken', action="store", type=str, required = True, default = None, 
                     help= "Path of Kraken2 program.")
 Rflag.add_argument('-kt', '--kraken-tools', action="store", type=str, required = True, default = None,
@@ -33,6 +45,30 @@ Oflag.add_argument('-t', '--threads', action="store", type=str, default = 1, req
                     help = "Number of threads to running Kraken2.")
 Oflag.add_argument('--gzip-compressed', action="store_true", required = False,
                     help = "Input files are compressed with gzip.")
+Oflag.add_argument('--stream', action="store_true", required = False,
+                    help = "Feed the samples to Kraken2 through named pipes instead of concatenating them into tmp/ first.")
+Oflag.add_argument('--kreport-engine', action="store", type=str, default = 'krakentools', choices = ['builtin', 'krakentools'],
+                    help = "Build the per-sample kreports in-process with a taxonomy loaded once (builtin), or run make_kreport.py of KrakenTools once per sample. Check builtin against KrakenTools with benchmark/compare_kreports.py before making it the default.")
+Oflag.add_argument('--batch-size', action="store", type=str, default = None, required = False,
+                    help = "Classify the samples in batches of at most this budget, e.g. '50G' input bytes or '200M' reads (see --batch-unit). Kraken2 memory-maps the DB, finished batches are split and reported while the next one is classified, and a restarted run resumes at the first incomplete batch.")
+Oflag.add_argument('--metrics-per-sample', action="store_true", required = False,
+                    help = "Also break the metrics.json of the run down by sample.")
+Oflag.add_argument('--batch-unit', action="store", type=str, default = 'bytes', choices = ['bytes', 'reads'],
+                    help = "Unit of --batch-size.")
+Oflag.add_argument('--demux-fastq', action="store", type=str, default = None, choices = ['plain', 'gzip'],
+                    help = "Also split the classified/unclassified fastq files of Kraken2 into <sample>classified_seqs*.fastq and <sample>unclassified_seqs*.fastq, plain or gzip compressed.")
+Oflag.add_argument('--binary-output', action="store", type=str, default = None, choices = ['taxids', 'full'],
+                    help = "Also write every <sample>out.txt in a compact columnar binary form, <sample>out.k2b (see binary_output.py): classified flag, taxid and read lengths, plus the zlib compressed k-mer hit lists with full. The builtin kreport engine reads it instead of the text.")
+Oflag.add_argument('--matrix', action="store_true", required = False,
+                    help = "Merge the results of all samples into a sparse samples x taxa matrix of direct and clade read counts, abundance_matrix.npz (see abundance_matrix.py).")
+Oflag.add_argument('--confidence-sweep', action="store", type=str, default = None,
+                    help = "Comma separated confidence thresholds, e.g. '0.05,0.1,0.2'. The reads are reclassified at each of them from the k-mer hit lists of Kraken2 (no rerun), into confidence_sweep/confidence_<c>/<sample>out.txt and <sample>kreport.txt.")
+Oflag.add_argument('--max-memory', action="store", type=str, default = None,
+                    help = "Memory budget for the Kraken2 runs of several DBs, e.g. '200G'. DBs whose hash.k2d files fit in it together are classified at the same time. Defaults to the available memory.")
+Oflag.add_argument('--shard', action="store", type=str, default = None,
+                    help = "Run shard I of N, e.g. '2/8': the samples are divided in order into N shards of about the same input size, this run classifies shard I into <output>/shard_I_of_N. Run every shard (e.g. one per node) with the same arguments, then merge_shards.py -o <output>.")
+Oflag.add_argument('--pipeline', action="store_true", required = False,
+                    help = "Split output.txt while Kraken2 is still writing it, every sample is cut as soon as its last read is classified and (with the builtin kreport engine) its kreport is built right away.")
 
 if not debug:
     opt = parser.parse_args()
@@ -52,17 +88,35 @@ if debug:
 args['input'] = os.path.abspath(args['input'])
 args['output'] = os.path.abspath(args['output'])
 suffix = args['suffix'].split(',')
+if args['confidence_sweep']:
+    try:
+        parse_thresholds(args['confidence_sweep'])
+    except ValueError as e:
+        parser.error(str(e))
+shard = None
+if args['shard']:
+    m = re.match(r'^(\d+)/(\d+)$', args['shard'])
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        parser.error('--shard must be I/N with 1 <= I <= N, e.g. 2/8.')
+    shard = (int(m.group(1)), int(m.group(2)))
+    # every shard is a run of its own, merge_shards.py combines them into <output>
+    shardRoot = args['output']
+    args['output'] = shard_dir(shardRoot, *shard)
 
 if not os.path.isdir(args['output']):
-    os.mkdir(args['output'])
+    os.makedirs(args['output'])
+if shard is not None and os.path.isfile(args['output'] + '/shard.json'):
+    # only a finished run of this shard may be merged
+    os.remove(args['output'] + '/shard.json')
 tmpDir = args['output'] + '/tmp'
 if not os.path.isdir(tmpDir):
     os.mkdir(tmpDir)
 if len(suffix) not in [1, 2]:
     'Bad value for --suffix argument.'
     sys.exit()
-if not os.path.isdir(args['db']):
-    logging.error('Unable to find the Kraken2 DB in ' + args['db'] + '.')
+for db in args['db']:
+    if not os.path.isdir(db):
+        logging.error('Unable to find the Kraken2 DB in ' + db + '.')
 if args['kraken_tools'] == None or (not os.path.isdir(args['kraken_tools'])):
     logging.error('Unable to find KrakenTools.')
 # %% logging DB information
@@ -86,137 +140,681 @@ mode = 'single-end'
 if len(suffix) == 2:
     fileNameList = [f.replace(suffix[1], '') for f in fileNameList]
     fileNameList = list(set(fileNameList))
-    fileNameList.sort()
     mode = 'paired-end'
+fileNameList.sort()
 logging.info(str(len(fileNameList)) + ' ' + mode + ' samples')
+if shard is not None:
+    shards = load_or_plan_shards(shardRoot + '/shards.json', fileNameList,
+                                 [sum(os.path.getsize(args['input'] + '/' + f + sf) for sf in suffix) for f in fileNameList], shard[1])
+    fileNameList = shards[shard[0] - 1]
+    logging.info('shard ' + args['shard'] + ': ' + str(len(fileNameList)) + ' samples' +
+                 (' (' + fileNameList[0] + ' .. ' + fileNameList[-1] + ')' if fileNameList else ''))
 
 # %% concatenate reads
-logging.info('*' * 15 + ' concatenate reads ' + '*' * 15)
-if not os.path.isfile(tmpDir + '/' + suffix[0]):
-    logging.info('start')
-    for i,f in enumerate(fileNameList):
-        if i == 0: 
-            append_mode = '>'
-        else:
-            append_mode = '>>'
-        command = ' '.join(['cat', args['input'] + '/' + f + suffix[0], append_mode, tmpDir + '/' + suffix[0]])
-        logging.info(str(i+1) + '/' + str(len(fileNameList)) + ': ' + f + suffix[0] + ' -> ' + suffix[0])
-        os.system(command)
-        if len(suffix) == 2:
-            command = ' '.join(['cat', args['input'] + '/' + f + suffix[1], append_mode, tmpDir + '/' + suffix[1]])
-            logging.info(str(i+1) + '/' + str(len(fileNameList)) + ': ' + f + suffix[1] + ' -> ' + suffix[1])
-            os.system(command)
-    logging.info('end')
-else:
-    logging.info('The concatenated file already exit.')
+# the read counts of the first mates are taken on the way and cached for the "count reads" stage
+countManifest = ReadCountManifest(tmpDir + '/read_counts.json')
+# Kraken2 runs of several DBs may update the counts at the same time in streaming mode
+countLock = threading.Lock()
+gzipped = True if args['gzip_compressed'] else None
+# wall/CPU time, peak RSS, IO and reads/s of every stage go to metrics.json
+metrics = StageMetrics(args['output'] + '/metrics.json', args['metrics_per_sample'])
+# every stage records its inputs, parameters and outputs here, reruns redo only what is missing or changed
+runManifest = RunManifest(tmpDir + '/run_manifest.json')
+
+# every DB gets its output directory, manifest and taxonomy; with one DB they are the ones of the run
+multiDB = len(args['db']) > 1
+targets = []
+for db in args['db']:
+    name = os.path.basename(os.path.normpath(db))
+    if name in [t['name'] for t in targets]:
+        name = name + '_' + str(len(targets) + 1)
+    target = {'db': db, 'name': name, 'taxonomy': None, 'pool': None, 'pipelinePool': None,
+              'params': {'kraken': args['kraken'], 'db': os.path.abspath(db), 'confidence': str(args['confidence']),
+                         'suffix': args['suffix'], 'hash': fingerprints([db + '/hash.k2d'])[os.path.abspath(db + '/hash.k2d')]}}
+    if multiDB:
+        target['output'] = args['output'] + '/' + name
+        target['tmpDir'] = target['output'] + '/tmp'
+        for d in (target['output'], target['tmpDir']):
+            if not os.path.isdir(d):
+                os.mkdir(d)
+        target['manifest'] = RunManifest(target['tmpDir'] + '/run_manifest.json')
+    else:
+        target['output'] = args['output']
+        target['tmpDir'] = tmpDir
+        target['manifest'] = runManifest
+    targets.append(target)
+if multiDB:
+    logging.info(str(len(targets)) + ' DBs: ' + ', '.join(t['name'] + ' (' + t['db'] + ')' for t in targets))
+
+def sample_inputs(samples):
+    return [args['input'] + '/' + f + sf for f in samples for sf in suffix]
+
+def work_key(workDir):
+    return os.path.relpath(workDir, args['output'])
+
+def label(target):
+    return ' [' + target['name'] + ']' if multiDB else ''
+
+def target_key(target, key):
+    return target['name'] + ':' + key if multiDB else key
+
+def target_dir(target, workDir):
+    """The directory of target's Kraken2 results for the reads staged in workDir."""
+    res = target['tmpDir'] + workDir[len(tmpDir):]
+    if not os.path.isdir(res):
+        os.makedirs(res)
+    return res
+
+def kraken2_done(target, samples, workDir):
+    return target['manifest'].is_complete('kraken2', work_key(target_dir(target, workDir)), sample_inputs(samples), target['params'])
+
+def concatenate_reads(samples, workDir, needed):
+    logging.info('*' * 15 + ' concatenate reads ' + '*' * 15)
+    if args['stream']:
+        logging.info('Streaming mode, the samples are fed to Kraken2 directly.')
+    elif all(kraken2_done(t, samples, workDir) for t in needed):
+        logging.info('Kraken2 classification is already done, no need to concatenate.')
+    elif not runManifest.is_complete('concatenate', work_key(workDir), sample_inputs(samples)):
+        runManifest.start('concatenate', work_key(workDir))
+        with metrics.stage('concatenate', work_key(workDir)) as st:
+            logging.info('start')
+            for i,f in enumerate(samples):
+                append_mode = i > 0
+                src = args['input'] + '/' + f + suffix[0]
+                logging.info(str(i+1) + '/' + str(len(samples)) + ': ' + f + suffix[0] + ' -> ' + suffix[0])
+                t0 = time.time()
+                lines = copy_and_count(src, workDir + '/' + suffix[0], append_mode, gzipped)
+                countManifest.set(src, lines // 4)
+                st['reads'] += lines // 4
+                metrics.sample('concatenate', f, reads = lines // 4, wall_s = round(time.time() - t0, 3))
+                if len(suffix) == 2:
+                    logging.info(str(i+1) + '/' + str(len(samples)) + ': ' + f + suffix[1] + ' -> ' + suffix[1])
+                    # only mate 1 is counted, mate 2 is a plain copy
+                    with open(args['input'] + '/' + f + suffix[1], 'rb') as fi, open(workDir + '/' + suffix[1], 'ab' if append_mode else 'wb') as fo:
+                        shutil.copyfileobj(fi, fo, COPY_BLOCK)
+            countManifest.save()
+            st['bytes_in'] = st['bytes_out'] = sum(os.path.getsize(p) for p in sample_inputs(samples))
+        runManifest.record('concatenate', work_key(workDir), sample_inputs(samples), [workDir + '/' + sf for sf in suffix])
+        logging.info('end')
+    else:
+        logging.info('The concatenated file already exit.')
 
 # %% running kraken2
-logging.info('*' * 15 + ' running kraken2 ' + '*' * 15)
-if os.path.isfile(tmpDir + '/classified_seqs.fastq') or os.path.isfile(tmpDir + '/unclassified_seqs.fastq') or os.path.isfile(tmpDir + '/classified_seqs_1.fastq') or os.path.isfile(tmpDir + '/unclassified_seqs_1.fastq'):
-    logging.info('Kraken2 classification looks like already done, skip and continue next part.')
-else:
+def start_pipeline(target, samples, kDir, readCount, pool, submitted):
+    """Follow kDir/output.txt while Kraken2 writes it, each sample is split as soon as it is complete and its kreport built in pool.
+
+    The results of the kreports submitted to pool are appended to submitted.
+    """
+    output = target['output']
+    def reported(s, n):
+        metrics.sample('kreport', target_key(target, s), reads = n)
+        target['manifest'].record('kreport', s, [output + '/' + s + 'out.txt'] + taxonomy_inputs(target),
+                                  [output + '/' + s + 'kreport.txt'], {'engine': args['kreport_engine']})
+    def on_sample(i, lines):
+        s = samples[i]
+        metrics.sample('split', target_key(target, s), reads = lines, bytes = os.path.getsize(output + '/' + s + 'out.txt'))
+        # an incomplete sample is split again after Kraken2
+        if lines != readCount(i):
+            return
+        target['manifest'].record('split', s, sample_inputs([s]), [output + '/' + s + 'out.txt'], target['params'], lines = lines)
+        if args['binary_output']:
+            record_binary(target, s)
+        logging.info(str(i+1) + '/' + str(len(samples)) + ': ' + s + 'out.txt' + label(target) + ' split while classifying')
+        if pool is not None:
+            submitted.append(submit_kreport(pool, report_source(target, s), output + '/' + s + 'kreport.txt',
+                                            callback = lambda n: reported(s, n),
+                                            error_callback = lambda e: logging.warning('kreport of ' + s + label(target) + ' failed: ' + str(e))))
+    # an output.txt left by an earlier run must not be followed
+    if os.path.exists(kDir + '/output.txt'):
+        os.remove(kDir + '/output.txt')
+    # samples this DB already has, classified again for another DB, keep their files and kreports
+    kept = set(s for s in samples if split_done(target, s))
+    tailer = OutputTailer(kDir + '/output.txt', output, samples, readCount, on_sample, binary = args['binary_output'], skip = kept)
+    tailer.start()
+    return tailer
+
+def run_kraken2(target, samples, workDir, threads, pool = None):
+    """Classify the concatenated (or streamed) samples of workDir against one DB, returns the exit status of Kraken2.
+
+    With --pipeline the samples are split (and reported in pool) while Kraken2 runs.
+    """
+    logging.info('*' * 15 + ' running kraken2' + label(target) + ' ' + '*' * 15)
+    if kraken2_done(target, samples, workDir):
+        logging.info('Kraken2 classification' + label(target) + ' is already done, skip and continue next part.')
+        return 0
+    kDir = target_dir(target, workDir)
+    target['manifest'].start('kraken2', work_key(kDir))
+    if args['stream']:
+        streamer = SampleStreamer([[args['input'] + '/' + f + sf for f in samples] for sf in suffix], kDir, gzipped)
+        readsIn = streamer.fifoPaths
+    else:
+        readsIn = [workDir + '/' + sf for sf in suffix]
+    command = [args['kraken'], '--threads', str(threads), '--db', target['db'],
+               '--confidence', str(args['confidence']),
+               '--report', kDir + '/' + 'report.txt',
+               '--output', kDir + '/' + 'output.txt',
+               '--use-names']
     if mode == 'single-end':
-        command = [args['kraken2'], '--threads', args['threads'], '--db', args['db'], 
-                   '--confidence', str(args['confidence']),
-                   '--classified-out', tmpDir + '/classified_seqs.fastq', 
-                   '--unclassified-out', tmpDir + '/unclassified_seqs.fastq',
-                   '--report', tmpDir + '/' + 'report.txt',
-                   '--output', tmpDir + '/' + 'output.txt',
-                   '--use-names']
-        if args['gzip_compressed']:
-            command.append('--gzip-compressed')
-        command = command.append(tmpDir + '/' + suffix[0])
+        command += ['--classified-out', kDir + '/classified_seqs.fastq',
+                    '--unclassified-out', kDir + '/unclassified_seqs.fastq']
     else:
-        command = [args['kraken'], '--threads', args['threads'], '--db', args['db'], 
-                   '--paired', tmpDir + '/' + suffix[0], tmpDir + '/' + suffix[1],
-                   '--confidence', str(args['confidence']),
-                   '--classified-out', tmpDir + '/classified_seqs#.fastq', 
-                   '--unclassified-out', tmpDir + '/unclassified_seqs#.fastq',
-                   '--report', tmpDir + '/' + 'report.txt',
-                   '--output', tmpDir + '/' + 'output.txt',
-                   '--use-names']
-        if args['gzip_compressed']:
-            command.append('--gzip-compressed')
-    command = ' '.join(command)
-    logging.debug('command: ' + command)
-    logging.info('start')
-    kstat = os.system(command)
-    if kstat == 0:logging.info('end')
+        command += ['--classified-out', kDir + '/classified_seqs#.fastq',
+                    '--unclassified-out', kDir + '/unclassified_seqs#.fastq',
+                    '--paired']
+    # in streaming mode Kraken2 reads the already inflated text from the pipes
+    if args['gzip_compressed'] and not args['stream']:
+        command.append('--gzip-compressed')
+    # batches map the DB instead of loading it, so it stays in the page cache between runs
+    if args['batch_size']:
+        command.append('--memory-mapping')
+    command += readsIn
+    logging.debug('command: ' + ' '.join(command))
+    tailer = None
+    submitted = []
+    if args['pipeline']:
+        if args['stream']:
+            tailer = start_pipeline(target, samples, kDir, streamer.count, pool, submitted)
+        else:
+            knownCounts = [countManifest.get(p) for p in sample_inputs(samples)[::len(suffix)]]
+            if None in knownCounts:
+                logging.info('Some read counts are unknown, output.txt is split after Kraken2.')
+            else:
+                tailer = start_pipeline(target, samples, kDir, knownCounts.__getitem__, pool, submitted)
+    with metrics.stage('kraken2', work_key(kDir)) as st:
+        logging.info('start')
+        if args['stream']:
+            streamer.start()
+            try:
+                kstat = subprocess.call(command)
+            except OSError as e:
+                logging.error('Unable to run Kraken2: ' + str(e))
+                kstat = 127
+            streamer.abort()
+            try:
+                streamCounts = streamer.join()
+            except RuntimeError as e:
+                logging.error(str(e))
+                kstat = kstat or 1
+            else:
+                with countLock:
+                    for f, n in zip(samples, streamCounts):
+                        countManifest.set(args['input'] + '/' + f + suffix[0], n)
+                    countManifest.save()
+        else:
+            try:
+                kstat = subprocess.call(command)
+            except OSError as e:
+                logging.error('Unable to run Kraken2: ' + str(e))
+                kstat = 127
+        if tailer is not None:
+            tailer.finish()
+            tailer.join()
+        st['bytes_in'] = sum(os.path.getsize(p) for p in sample_inputs(samples))
+        # output.txt, report.txt and the classified/unclassified reads, whatever Kraken2 got to write
+        st['bytes_out'] = sum(os.path.getsize(kDir + '/' + f) for f in os.listdir(kDir)
+                              if f in ('output.txt', 'report.txt') or re.match(r'^(un)?classified_seqs(_[12])?\.fastq$', f))
+        counts = [countManifest.get(p) for p in sample_inputs(samples)[::len(suffix)]]
+        st['reads'] = sum(counts) if None not in counts else 0
+    # the pool serves the whole run, wait for the kreports of these samples only
+    for r in submitted:
+        r.wait()
+    if kstat == 0:
+        target['manifest'].record('kraken2', work_key(kDir), sample_inputs(samples),
+                                  [kDir + '/output.txt', kDir + '/report.txt'], target['params'], samples = samples)
+        logging.info('end' + label(target))
+    else:
+        logging.error('Kraken2' + label(target) + ' exited with status ' + str(kstat) + '.')
+    return kstat
+
+def run_kraken2_all(needed, samples, workDir):
+    """Classify workDir against every DB in needed, DBs that fit in memory together run at the same time.
+
+    With --pipeline the kreports are built in the pipeline pools of open_pools().
+    """
+    if len(needed) == 1:
+        return run_kraken2(needed[0], samples, workDir, int(args['threads']), needed[0]['pipelinePool']) == 0
+    budget = parse_size(args['max_memory']) if args['max_memory'] else available_memory()
+    sizes = [db_memory(t['db']) for t in needed]
+    waves = plan_batches(sizes, budget)
+    logging.info('Memory budget ' + str(budget // 1024 ** 2) + ' MB for ' + str(len(needed)) + ' DBs (' +
+                 ', '.join(t['name'] + ': ' + str(n // 1024 ** 2) + ' MB' for t, n in zip(needed, sizes)) + '), ' +
+                 str(len(waves)) + ' round(s): ' + ' | '.join(', '.join(needed[i]['name'] for i in w) for w in waves))
+    ok = True
+    for wave in waves:
+        threads = max(1, int(args['threads']) // len(wave))
+        with ThreadPoolExecutor(max_workers = len(wave)) as pool:
+            stats = list(pool.map(lambda i: run_kraken2(needed[i], samples, workDir, threads, needed[i]['pipelinePool']), wave))
+        ok = ok and all(k == 0 for k in stats)
+    return ok
 
 # %% count reads for each sample
-logging.info('*' * 15 + ' count reads ' + '*' * 15)
-readCounts = []
-for i,f in enumerate(fileNameList):
-    catMode = 'cat'
-    if args['gzip_compressed']:
-        catMode = 'zcat'
-    command = [catMode, args['input'] + '/' + fileNameList[i] + suffix[0], '| echo $((`wc -l`/4))']
-    rn = os.popen(' '.join(command)).read().strip()
-    logging.info(str(i+1) + '/' + str(len(fileNameList)) + ': ' + f + suffix[0] + ' : ' + rn)
-    readCounts.append(int(rn))
+def count_sample_reads(samples, workDir, processes):
+    logging.info('*' * 15 + ' count reads ' + '*' * 15)
+    with metrics.stage('count reads', work_key(workDir)) as st:
+        readCounts = count_reads([args['input'] + '/' + f + suffix[0] for f in samples],
+                                 processes, countManifest, gzipped)
+        st['reads'] = sum(readCounts)
+    for i,f in enumerate(samples):
+        logging.info(str(i+1) + '/' + str(len(samples)) + ': ' + f + suffix[0] + ' : ' + str(readCounts[i]))
+    write_sample_reads(workDir + '/sample_reads.tsv', samples, readCounts)
+    return readCounts
 
 # %% split output.txt sample by sample
-if os.path.isfile(args['output'] + '/' + fileNameList[-1] + 'out.txt'):
-    logging.info('Looks like it had been splited, skip and continue to next step.')
-else:
-    readCountsAcc = np.cumsum(readCounts)
-    logging.info('*' * 15 + ' split output.txt ' + '*' * 15)
-    resF = open(tmpDir + '/output.txt', 'r')
-    ind = 0
-    fh = fileNameList[ind]
-    logging.info(str(ind+1) + '/' + str(len(fileNameList)) + ': output.txt -> ' + fh + 'out.txt')
-    spOUT = open(args['output'] + '/' + fh + 'out.txt', 'w')   
-    for i,rows in enumerate(resF):
-        spOUT.write(rows)
-        if i+1 in readCountsAcc:
-            ind += 1
-            if ind == len(fileNameList): break
-            fh = fileNameList[ind]
-            logging.info(str(ind+1) + '/' + str(len(fileNameList)) + ': output.txt -> ' + fh + 'out.txt')
-            spOUT.close()
-            spOUT = open(args['output'] + '/' + fh + 'out.txt', 'w')
-    spOUT.close()
+def split_done(target, sample):
+    return target['manifest'].is_complete('split', sample, sample_inputs([sample]), target['params'])
+
+def split_results(target, samples, readCounts, workDir):
+    logging.info('*' * 15 + ' split output.txt' + label(target) + ' ' + '*' * 15)
+    # samples split before, e.g. by the pipeline of a run that failed later, keep their files and kreports
+    kept = set(s for s in samples if split_done(target, s))
+    if kept:
+        logging.info(str(len(kept)) + '/' + str(len(samples)) + ' samples' + label(target) + ' are already split, keep them.')
+    with metrics.stage('split', work_key(workDir)) as st:
+        written = split_output(workDir + '/output.txt', target['output'], samples, readCounts, binary = args['binary_output'], skip = kept)
+        st['bytes_in'] = os.path.getsize(workDir + '/output.txt')
+        for s, w in zip(samples, written):
+            if s in kept:
+                continue
+            size = os.path.getsize(target['output'] + '/' + s + 'out.txt')
+            st['reads'] += w
+            st['bytes_out'] += size
+            metrics.sample('split', target_key(target, s), reads = w, bytes = size)
+    for s, n, w in zip(samples, readCounts, written):
+        # a sample whose line count does not match its reads is left incomplete
+        if n == w and s not in kept:
+            target['manifest'].record('split', s, sample_inputs([s]), [target['output'] + '/' + s + 'out.txt'], target['params'], lines = w)
+            if args['binary_output']:
+                record_binary(target, s)
+
+# %% compact binary per-read files
+def binary_params():
+    return {'hits': args['binary_output'] == 'full'}
+
+def binary_done(target, sample):
+    return not args['binary_output'] or target['manifest'].is_complete('binary', sample, [target['output'] + '/' + sample + 'out.txt'], binary_params())
+
+def record_binary(target, sample):
+    output = target['output']
+    target['manifest'].record('binary', sample, [output + '/' + sample + 'out.txt'], [output + '/' + sample + BINARY_SUFFIX], binary_params())
+
+def binary_results(target, samples, processes):
+    """Write the .k2b files the split did not, e.g. when --binary-output is added to a finished run."""
+    todo = [s for s in samples if not binary_done(target, s)]
+    if not todo:
+        return
+    logging.info('*' * 15 + ' write binary outputs' + label(target) + ' ' + '*' * 15)
+    output = target['output']
+    with metrics.stage('binary', target_key(target, '')) as st:
+        jobs = [(output + '/' + s + 'out.txt', output + '/' + s + BINARY_SUFFIX) for s in todo]
+        reads = convert_files(jobs, args['binary_output'] == 'full', pool = stage_pool(target, processes))
+        st['reads'] = sum(reads)
+        st['bytes_in'] = sum(os.path.getsize(k) for k, _ in jobs)
+        st['bytes_out'] = sum(os.path.getsize(b) for _, b in jobs)
+    for s in todo:
+        record_binary(target, s)
+
+def report_source(target, sample):
+    """The file the builtin engine builds a kreport from, the .k2b form when there is one."""
+    if args['binary_output'] and args['kreport_engine'] == 'builtin' and binary_done(target, sample):
+        return target['output'] + '/' + sample + BINARY_SUFFIX
+    return target['output'] + '/' + sample + 'out.txt'
+
+# %% demultiplex the classified/unclassified fastq sample by sample
+def demux_params(target):
+    return dict(target['params'], demux = args['demux_fastq'])
+
+def demux_done(target, sample):
+    return not args['demux_fastq'] or target['manifest'].is_complete('demux', sample, sample_inputs([sample]), demux_params(target))
+
+def demux_results(target, samples, workDir, processes):
+    """Demultiplex the fastq files of the samples classified together in workDir."""
+    todo = [s for s in samples if not demux_done(target, s)]
+    if not todo:
+        return
+    logging.info('*' * 15 + ' demultiplex fastq' + label(target) + ' ' + '*' * 15)
+    # the boundaries come from the <sample>out.txt files, all of them are needed
+    if not all(split_done(target, s) for s in samples):
+        logging.error('Some samples of ' + work_key(workDir) + ' are not split, unable to demultiplex its fastq files.')
+        return
+    with metrics.stage('demux', work_key(workDir)) as st:
+        counts = [count_classified(target['output'] + '/' + s + 'out.txt') for s in samples]
+        written = demux_samples(workDir, target['output'], samples, [c for c, _ in counts], [u for _, u in counts],
+                                mode == 'paired-end', args['demux_fastq'] == 'gzip', processes, todo)
+        for s, (c, u) in zip(samples, counts):
+            if s in written:
+                size = sum(os.path.getsize(p) for p in written[s])
+                st['reads'] += c + u
+                st['bytes_out'] += size
+                metrics.sample('demux', target_key(target, s), reads = c + u, classified = c, bytes = size)
+        st['bytes_in'] = sum(os.path.getsize(workDir + '/' + f) for kind in ('classified', 'unclassified')
+                             for f in combined_names(kind, mode == 'paired-end'))
+    for s in todo:
+        if s in written:
+            target['manifest'].record('demux', s, sample_inputs([s]), written[s], demux_params(target))
 
 # %% convert results to report
 # need KrakenTools by jenniferlu717 https://github.com/lexinwei/KrakenTools.git
 # make ktaxonomy
-logging.info('*' * 15 + ' convert results to report ' + '*' * 15)
-if not os.path.isfile(args['db'] + '/mydb_taxonomy.txt'):
-    logging.info('Making ktaxonomy ...')
-    command = ['python', args['kraken_tools'] + '/make_ktaxonomy.py', 
-               '--node', args['db'] + '/taxonomy' + '/nodes.dmp',
-               '--names', args['db'] + '/taxonomy' + '/names.dmp',
-               '--seqid2taxid', args['db'] + '/seqid2taxid.map',
-               '-o', args['db'] + '/mydb_taxonomy.txt']
-    command = ' '.join(command)
-    logging.debug('command: ', command)
-    logging.info('start')
-    process = subprocess.Popen(command, shell = True,
-                           stdout = subprocess.PIPE, 
-                           stderr = subprocess.PIPE)
-    out, err = process.communicate()
-    outF = open(args['db'] + '/make_ktaxonomy_out.txt', 'wb')
-    outF.write(out)
-    outF.close()
-    errF = open(args['db'] + '/make_ktaxonomy_err.txt', 'wb')
-    errF.write(err)
-    errF.close()
-    returncode = process.returncode
-    returncode = process.returncode
-    if returncode == 0: logging.info('end')
-else:
-    logging.info('No need to make ktaxonomy again, already exist in this DB.')
+def prepare_taxonomy(target):
+    """Make the ktaxonomy if needed and load the taxonomy once for the builtin engine and the confidence sweep."""
+    if target['taxonomy'] is not None:
+        return target['taxonomy']
+    db = target['db']
+    # the builtin engine reads the binary taxonomy cache made from the .dmp files of the DB instead
+    useTaxonomyCache = args['kreport_engine'] == 'builtin' and os.path.isfile(db + '/taxonomy/nodes.dmp')
+    if useTaxonomyCache:
+        logging.info('Using the taxonomy cache of ' + db + '.')
+    elif not os.path.isfile(db + '/mydb_taxonomy.txt'):
+        logging.info('Making ktaxonomy ...')
+        command = ['python', args['kraken_tools'] + '/make_ktaxonomy.py',
+                   '--node', db + '/taxonomy' + '/nodes.dmp',
+                   '--names', db + '/taxonomy' + '/names.dmp',
+                   '--seqid2taxid', db + '/seqid2taxid.map',
+                   '-o', db + '/mydb_taxonomy.txt']
+        command = ' '.join(command)
+        logging.debug('command: ' + command)
+        logging.info('start')
+        process = subprocess.Popen(command, shell = True,
+                               stdout = subprocess.PIPE,
+                               stderr = subprocess.PIPE)
+        out, err = process.communicate()
+        outF = open(db + '/make_ktaxonomy_out.txt', 'wb')
+        outF.write(out)
+        outF.close()
+        errF = open(db + '/make_ktaxonomy_err.txt', 'wb')
+        errF.write(err)
+        errF.close()
+        returncode = process.returncode
+        if returncode != 0 or not os.path.isfile(db + '/mydb_taxonomy.txt'):
+            logging.error('make_ktaxonomy.py exited with status ' + str(returncode) + ', see ' + db + '/make_ktaxonomy_err.txt')
+            sys.exit(1)
+        logging.info('end')
+    else:
+        logging.info('No need to make ktaxonomy again, already exist in this DB.')
+    if args['kreport_engine'] == 'builtin' or args['confidence_sweep']:
+        if useTaxonomyCache:
+            target['taxonomy'] = load_taxonomy_cache(db)
+        else:
+            target['taxonomy'] = KTaxonomy.from_ktaxonomy(db + '/mydb_taxonomy.txt')
+        logging.info('Loaded ' + str(len(target['taxonomy'])) + ' taxa')
+    return target['taxonomy']
 
 # make kreport
-logging.info('start converting')
-for i,s in enumerate(fileNameList):
-    command = ['python', args['kraken_tools'] + '/make_kreport.py', 
-            '-i', args['output'] + '/' + s + 'out.txt', 
-            '-t', args['db'] + '/mydb_taxonomy.txt',
-            '-o', args['output'] + '/' + s + 'kreport.txt']
-    command = ' '.join(command)
-    logging.info(str(i+1) + '/' + str(len(fileNameList)) + ': ' + s + 'out.txt -> ' + s + 'kreport.txt')
-    stat = os.system(command)
-    if not stat == 0:
-        logging.warning('fail converting')
-logging.info('all done')
\ No newline at end of file
+def taxonomy_inputs(target):
+    if args['kreport_engine'] == 'builtin' and os.path.isfile(target['db'] + '/taxonomy/nodes.dmp'):
+        return [target['db'] + '/taxonomy/nodes.dmp', target['db'] + '/taxonomy/names.dmp']
+    return [target['db'] + '/mydb_taxonomy.txt']
+
+def report_done(target, sample):
+    return target['manifest'].is_complete('kreport', sample, [target['output'] + '/' + sample + 'out.txt'] + taxonomy_inputs(target),
+                                          {'engine': args['kreport_engine']})
+
+def convert_reports(target, samples, processes):
+    logging.info('*' * 15 + ' convert results to report' + label(target) + ' ' + '*' * 15)
+    output = target['output']
+    todo = [s for s in samples if not report_done(target, s)]
+    if len(todo) < len(samples):
+        logging.info(str(len(samples) - len(todo)) + '/' + str(len(samples)) + ' kreports' + label(target) + ' are up to date, skip them.')
+    if not todo:
+        return
+    with metrics.stage('taxonomy', target_key(target, '')):
+        prepare_taxonomy(target)
+    logging.info('start converting')
+    done = []
+    with metrics.stage('kreport', target_key(target, todo[0] + '..' + todo[-1])) as st:
+        st['bytes_in'] = sum(os.path.getsize(output + '/' + s + 'out.txt') for s in todo)
+        if args['kreport_engine'] == 'builtin':
+            reads = build_kreports(target['taxonomy'], [(report_source(target, s), output + '/' + s + 'kreport.txt') for s in todo],
+                                   pool = stage_pool(target, processes))
+            st['reads'] = sum(reads)
+            for s, n in zip(todo, reads):
+                metrics.sample('kreport', target_key(target, s), reads = n)
+            done = todo
+        else:
+            for i,s in enumerate(todo):
+                command = ['python', args['kraken_tools'] + '/make_kreport.py',
+                        '-i', output + '/' + s + 'out.txt',
+                        '-t', target['db'] + '/mydb_taxonomy.txt',
+                        '-o', output + '/' + s + 'kreport.txt']
+                command = ' '.join(command)
+                logging.info(str(i+1) + '/' + str(len(todo)) + ': ' + s + 'out.txt -> ' + s + 'kreport.txt')
+                stat = os.system(command)
+                if not stat == 0:
+                    logging.warning('fail converting')
+                else:
+                    done.append(s)
+        st['bytes_out'] = sum(os.path.getsize(output + '/' + s + 'kreport.txt') for s in done)
+    for s in done:
+        target['manifest'].record('kreport', s, [output + '/' + s + 'out.txt'] + taxonomy_inputs(target),
+                                  [output + '/' + s + 'kreport.txt'], {'engine': args['kreport_engine']})
+
+# %% merge all samples into one matrix
+def merge_matrix(target, processes):
+    logging.info('*' * 15 + ' merge samples into a matrix' + label(target) + ' ' + '*' * 15)
+    if shard is not None:
+        logging.info('The matrix of all shards is built by merge_shards.py.')
+        return
+    manifest = target['manifest']
+    matrixPath = target['output'] + '/abundance_matrix.npz'
+    # the builtin engine has the taxonomy at hand and reads the outputs, KrakenTools users get it from the kreports
+    if args['kreport_engine'] == 'builtin':
+        inputs = [target['output'] + '/' + s + 'out.txt' for s in fileNameList]
+        matrixInputs = inputs + taxonomy_inputs(target)
+    else:
+        inputs = [target['output'] + '/' + s + 'kreport.txt' for s in fileNameList]
+        matrixInputs = inputs
+    if manifest.is_complete('matrix', 'all', matrixInputs, {'engine': args['kreport_engine']}):
+        logging.info('The matrix is up to date.')
+        return
+    manifest.start('matrix', 'all')
+    with metrics.stage('matrix', target_key(target, '')) as st:
+        if args['kreport_engine'] == 'builtin':
+            matrix = matrix_from_outputs(prepare_taxonomy(target), inputs, pool = stage_pool(target, processes))
+        else:
+            matrix = matrix_from_kreports(inputs)
+        matrix.save(matrixPath)
+        st['reads'] = int(matrix.totals().sum())
+        st['bytes_in'] = sum(os.path.getsize(p) for p in inputs)
+        st['bytes_out'] = os.path.getsize(matrixPath)
+    logging.info(str(matrix.shape[0]) + ' samples x ' + str(matrix.shape[1]) + ' taxa saved to ' + matrixPath)
+    manifest.record('matrix', 'all', matrixInputs, [matrixPath], {'engine': args['kreport_engine']})
+
+# %% reclassify at other confidence thresholds
+def sweep_confidence(target, processes):
+    logging.info('*' * 15 + ' confidence sweep' + label(target) + ' ' + '*' * 15)
+    manifest = target['manifest']
+    thresholds = parse_thresholds(args['confidence_sweep'])
+    sweepDir = target['output'] + '/confidence_sweep'
+    def inputs(s):
+        return [target['output'] + '/' + s + 'out.txt'] + taxonomy_inputs(target)
+    def outputs(s):
+        return [threshold_dir(sweepDir, c) + '/' + s + f for c in thresholds for f in ('out.txt', 'kreport.txt')]
+    todo = [s for s in fileNameList if not manifest.is_complete('sweep', s, inputs(s), {'thresholds': thresholds})]
+    if not todo:
+        logging.info('The confidence sweep is up to date.')
+        return
+    for s in todo:
+        manifest.start('sweep', s)
+    with metrics.stage('sweep', target_key(target, '')) as st:
+        krakenOuts = [target['output'] + '/' + s + 'out.txt' for s in todo]
+        classified = sweep(prepare_taxonomy(target), krakenOuts, thresholds, sweepDir, pool = stage_pool(target, processes))
+        st['reads'] = sum(countManifest.get(p) or 0 for p in sample_inputs(todo)[::len(suffix)])
+        st['bytes_in'] = sum(os.path.getsize(p) for p in krakenOuts)
+        st['bytes_out'] = sum(os.path.getsize(p) for s in todo for p in outputs(s))
+    logging.info('classified reads at ' + ', '.join('%g' % c for c in thresholds) + ':')
+    for s in todo:
+        logging.info(s + ': ' + ', '.join(str(n) for n in classified[s]))
+        metrics.sample('sweep', target_key(target, s), classified = classified[s])
+        manifest.record('sweep', s, inputs(s), outputs(s), {'thresholds': thresholds})
+
+# %% worker pools
+def open_pools():
+    """Fork the worker pools of every DB, holding its taxonomy, before any thread of the run starts.
+
+    The multi-DB, batch and pipeline modes run threads, and a process forked
+    while another thread holds a lock (logging, stdio, malloc) can deadlock,
+    so the stages do not fork: they get these pools from stage_pool(), and
+    with --pipeline the kreports built while Kraken2 runs go to a smaller
+    pipeline pool, reused by every batch.
+    """
+    threads = int(args['threads'])
+    stagePools = threads > 1 and (args['kreport_engine'] == 'builtin' or args['binary_output'] or args['confidence_sweep'])
+    pipelinePools = args['pipeline'] and args['kreport_engine'] == 'builtin'
+    if not (stagePools or pipelinePools):
+        return
+    for t in targets:
+        with metrics.stage('taxonomy', target_key(t, '')):
+            prepare_taxonomy(t)
+        if stagePools:
+            t['pool'] = taxonomy_pool(t['taxonomy'], threads)
+        if pipelinePools:
+            # a few workers beside Kraken2, which has the threads
+            t['pipelinePool'] = taxonomy_pool(t['taxonomy'], max(1, threads // (4 * len(targets))))
+
+def stage_pool(target, processes):
+    """The pool a stage of target runs its jobs in, None to run them in this process."""
+    return target['pool'] if processes > 1 else None
+
+def close_pools():
+    for t in targets:
+        for k in ('pool', 'pipelinePool'):
+            if t[k] is not None:
+                t[k].close()
+                t[k].join()
+                t[k] = None
+
+# %% classify, split and report a group of samples
+def sample_done(target, sample):
+    return split_done(target, sample) and demux_done(target, sample)
+
+def classify(samples, workDir, processes):
+    """Classify the samples of workDir that are not split yet, against the DBs that miss them.
+
+    Returns (samples classified, their read counts, the directory used,
+    the DBs they were classified against), or None if Kraken2 failed.
+    When only some samples changed they are classified alone in
+    workDir/partial.
+    """
+    needed = [t for t in targets if not all(sample_done(t, s) for s in samples)]
+    if not needed:
+        logging.info('All ' + str(len(samples)) + ' samples are already classified and split.')
+        return [], [], workDir, []
+    # the reads are staged once for all DBs, so a sample any of them misses is classified by all that miss one
+    todo = [s for s in samples if any(not sample_done(t, s) for t in needed)]
+    if len(todo) < len(samples):
+        logging.info(str(len(samples) - len(todo)) + '/' + str(len(samples)) + ' samples are up to date, classify the other ' + str(len(todo)) + ' only.')
+        workDir = workDir + '/partial'
+        if not os.path.isdir(workDir):
+            os.mkdir(workDir)
+    concatenate_reads(todo, workDir, needed)
+    if not run_kraken2_all(needed, todo, workDir):
+        return None
+    readCounts = count_sample_reads(todo, workDir, processes)
+    return todo, readCounts, workDir, needed
+
+def finish_target(target, samples, classified, readCounts, workDir, processes, cleanup = False):
+    """Split the results of one DB and build its reports of all samples."""
+    kDir = target_dir(target, workDir)
+    if classified:
+        # with --pipeline the samples are usually split already
+        if not all(split_done(target, s) for s in classified):
+            split_results(target, classified, readCounts, kDir)
+        demux_results(target, classified, kDir, processes)
+    binary_results(target, samples, processes)
+    convert_reports(target, samples, processes)
+    if cleanup and os.path.isfile(kDir + '/output.txt') and all(split_done(target, s) for s in classified):
+        os.remove(kDir + '/output.txt')
+    # the combined fastq files of a batch are no longer needed once every sample has its own
+    if cleanup and args['demux_fastq'] and all(demux_done(target, s) for s in classified):
+        for f in os.listdir(kDir):
+            if f.startswith(('classified_seqs', 'unclassified_seqs')):
+                os.remove(kDir + '/' + f)
+
+def finish(samples, classified, readCounts, workDir, needed, processes, cleanup = False):
+    """Split what classify() returned and build the reports of all samples, one DB after another with the pool of each."""
+    for t in targets:
+        finish_target(t, samples, classified if t in needed else [], readCounts, workDir, processes, cleanup)
+
+# %% batches
+def batch_done(samples):
+    return all(sample_done(t, s) and report_done(t, s) for t in targets for s in samples)
+
+def run_batches():
+    logging.info('*' * 15 + ' plan batches ' + '*' * 15)
+    budget = parse_size(args['batch_size'])
+    with metrics.stage('plan batches'):
+        if args['batch_unit'] == 'reads':
+            weights = count_reads([args['input'] + '/' + f + suffix[0] for f in fileNameList],
+                                  int(args['threads']), countManifest, gzipped)
+        else:
+            weights = [sum(os.path.getsize(args['input'] + '/' + f + sf) for sf in suffix) for f in fileNameList]
+        batches = load_or_plan(tmpDir + '/batches.json', fileNameList, weights, budget, args['batch_unit'])
+    todo = [k for k in range(len(batches)) if not batch_done(batches[k])]
+    logging.info(str(len(batches)) + ' batches of at most ' + args['batch_size'] + ' ' + args['batch_unit'] + ', ' + str(len(todo)) + ' to run')
+    pending = None
+    # the previous batch is split and reported in the background while the next one is classified. Nothing
+    # may fork while this thread runs: the pools were forked by open_pools() before it started, the
+    # background finish runs its stages in this process (processes = 1, leaving the CPUs to Kraken2)
+    # and the last batch, finished in the main thread once it is gone, uses the pools
+    with ThreadPoolExecutor(max_workers = 1) as post:
+        for k in todo:
+            samples = batches[k]
+            workDir = batch_dir(tmpDir, k)
+            if not os.path.isdir(workDir):
+                os.mkdir(workDir)
+            logging.info('#' * 15 + ' batch ' + str(k+1) + '/' + str(len(batches)) + ': ' + str(len(samples)) + ' samples ' + '#' * 15)
+            # reads missing from the count manifest are counted in this process while the previous batch is finished
+            res = classify(samples, workDir, int(args['threads']) if pending is None else 1)
+            if res is None:
+                logging.error('Stopping at batch ' + str(k+1) + ', run again to resume from it.')
+                if pending is not None:
+                    pending.result()
+                return False
+            classified, readCounts, workDir, needed = res
+            for sf in suffix:
+                if os.path.isfile(workDir + '/' + sf):
+                    os.remove(workDir + '/' + sf)
+            if pending is not None:
+                pending.result()
+            if k == todo[-1]:
+                finish(samples, classified, readCounts, workDir, needed, int(args['threads']), cleanup = True)
+                pending = None
+            else:
+                pending = post.submit(finish, samples, classified, readCounts, workDir, needed, 1, True)
+    return True
+
+# %% shards
+def write_shard_record(ok):
+    """Tell merge_shards.py which samples this shard covered and whether it finished."""
+    record = {'shard': shard[0], 'of': shard[1], 'ok': ok, 'samples': fileNameList,
+              'engine': args['kreport_engine'], 'matrix': args['matrix'], 'confidence_sweep': args['confidence_sweep'],
+              'targets': [{'name': t['name'], 'db': os.path.abspath(t['db']), 'dir': os.path.relpath(t['output'], args['output'])}
+                          for t in targets],
+              'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+    path = args['output'] + '/shard.json'
+    with open(path + '.tmp', 'w') as f:
+        json.dump(record, f, indent = 1)
+    os.replace(path + '.tmp', path)
+
+# %% run
+open_pools()
+if args['batch_size']:
+    ok = run_batches()
+else:
+    res = classify(fileNameList, tmpDir, int(args['threads']))
+    ok = res is not None
+    if ok:
+        finish(fileNameList, res[0], res[1], res[2], res[3], int(args['threads']))
+for target in targets:
+    if ok and args['matrix']:
+        merge_matrix(target, int(args['threads']))
+    if ok and args['confidence_sweep']:
+        sweep_confidence(target, int(args['threads']))
+close_pools()
+logging.info('*' * 15 + ' metrics ' + '*' * 15)
+metrics.report()
+if shard is not None:
+    write_shard_record(ok)
+if not ok:
+    sys.exit(1)
+logging.info('all done')
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Build Kraken2 style reports (kreport) from per-sample Kraken2
+# outputs in-process. The taxonomy is loaded once into array-backed
+# parent/rank/depth/name tables with a dense taxid index, the taxids
+# of a sample are tallied with np.bincount and rolled up the tree one
+# depth level at a time. Samples can be processed by forked workers
+# sharing the loaded taxonomy.
+#################################################################
+import argparse, os, re, sys, time, logging
+from argparse import ArgumentDefaultsHelpFormatter
+import numpy as np
+from binary_output import SUFFIX as BINARY_SUFFIX, read_taxids as read_binary_taxids
+from taxonomy_cache import taxonomy_pool, pool_taxonomy
+
+BLOCK_SIZE = 16 * 1024 * 1024
+# taxid column of a Kraken2 output line, with or without --use-names
+TAXID_RE = re.compile(rb'^[CU]\t[^\t\n]*\t(?:[^\t\n]*\(taxid )?(\d+)', re.M)
+
+class KTaxonomy(object):
+    """A taxonomy held in parallel arrays, node i has taxid taxids[i] and parent parents[i] (-1 for the root).
+
+    The derived tables (dense taxid index, nodes ordered by depth and the
+    children in CSR form) are computed unless given, e.g. by taxonomy_cache.py.
+    """
+    def __init__(self, taxids, parents, ranks, depths, names,
+                 index = None, order = None, levelBounds = None, childStart = None, children = None):
+        self.taxids = np.asarray(taxids)
+        self.parents = np.asarray(parents)
+        self.ranks = ranks
+        self.depths = np.asarray(depths)
+        self.names = names
+        if index is None:
+            index = np.full(int(self.taxids.max()) + 1, -1, dtype = np.int64)
+            index[self.taxids] = np.arange(len(self.taxids))
+        self.index = index
+        # nodes grouped by depth, for bottom-up rollups
+        if order is None:
+            order = np.argsort(self.depths, kind = 'stable')
+            levelBounds = np.searchsorted(self.depths[order], np.arange(int(self.depths.max()) + 2))
+        self.order = order
+        self.levelBounds = levelBounds
+        self.levels = [order[levelBounds[d]:levelBounds[d + 1]] for d in range(len(levelBounds) - 1)]
+        # children of every node in CSR form, kept in taxonomy order
+        if childStart is None:
+            hasParent = np.nonzero(self.parents >= 0)[0]
+            children = hasParent[np.argsort(self.parents[hasParent], kind = 'stable')]
+            childStart = np.searchsorted(self.parents[children], np.arange(len(self.taxids) + 1))
+        self.childStart = childStart
+        self.children = children
+        self.root = int(order[0])
+
+    def __len__(self):
+        return len(self.taxids)
+
+    @classmethod
+    def from_ktaxonomy(cls, path):
+        """Load the taxonomy file written by KrakenTools' make_ktaxonomy.py (taxid | parent | rank | depth | name)."""
+        taxids, parentTaxids, ranks, depths, names = [], [], [], [], []
+        with open(path) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                taxid, parent, rank, depth, name = line.split('\t|\t', 4)
+                taxids.append(int(taxid))
+                parentTaxids.append(int(parent))
+                ranks.append(rank)
+                depths.append(int(depth))
+                names.append(name)
+        taxids = np.array(taxids, dtype = np.int64)
+        index = np.full(int(taxids.max()) + 1, -1, dtype = np.int64)
+        index[taxids] = np.arange(len(taxids))
+        parents = index[np.array(parentTaxids, dtype = np.int64)]
+        parents[parents == np.arange(len(taxids))] = -1
+        return cls(taxids, parents, ranks, depths, names)
+
+    def lineage(self, taxid):
+        """Return the node indices from the root down to taxid."""
+        i = int(self.index[taxid]) if 0 <= taxid < len(self.index) else -1
+        if i < 0:
+            raise KeyError(taxid)
+        path = []
+        while i >= 0:
+            path.append(i)
+            i = int(self.parents[i])
+        return path[::-1]
+
+    def tally(self, taxids):
+        """Return the per-node read counts of an array of taxids and the number of taxids not in the taxonomy."""
+        taxids = np.asarray(taxids, dtype = np.int64)
+        ok = taxids < len(self.index)
+        ind = np.full(len(taxids), -1, dtype = np.int64)
+        ind[ok] = self.index[taxids[ok]]
+        missing = int(np.count_nonzero(ind < 0))
+        return np.bincount(ind[ind >= 0], minlength = len(self)), missing
+
+    def rollup(self, counts):
+        """Return the clade counts, i.e. counts summed over every subtree."""
+        clade = np.array(counts, dtype = np.int64)
+        for nodes in reversed(self.levels[1:]):
+            np.add.at(clade, self.parents[nodes], clade[nodes])
+        return clade
+
+def read_taxids(path, blockSize = BLOCK_SIZE):
+    """Return the taxid column of a Kraken2 output file (or of its .k2b form) as an int64 array."""
+    if path.endswith(BINARY_SUFFIX):
+        return read_binary_taxids(path)
+    chunks = []
+    with open(path, 'rb') as f:
+        rest = b''
+        while True:
+            block = f.read(blockSize)
+            if not block:
+                break
+            block = rest + block
+            cut = block.rfind(b'\n') + 1
+            rest = block[cut:]
+            hits = TAXID_RE.findall(block, 0, cut)
+            if hits:
+                chunks.append(np.array(hits).astype(np.int64))
+        if rest:
+            hits = TAXID_RE.findall(rest)
+            if hits:
+                chunks.append(np.array(hits).astype(np.int64))
+    if not chunks:
+        return np.zeros(0, dtype = np.int64)
+    return np.concatenate(chunks)
+
+def format_kreport(taxonomy, counts, clade, unclassified, total):
+    """Return the report lines, children sorted by clade count (ties keep the taxonomy order)."""
+    lines = []
+    pct = (lambda n: 100.0 * n / total) if total > 0 else (lambda n: 0.0)
+    if unclassified > 0:
+        lines.append('%6.2f\t%i\t%i\t%s\t%i\t%s\n' % (pct(unclassified), unclassified, unclassified, 'U', 0, 'unclassified'))
+    stack = [taxonomy.root]
+    while stack:
+        i = stack.pop()
+        if clade[i] == 0:
+            continue
+        lines.append('%6.2f\t%i\t%i\t%s\t%i\t%s%s\n' % (pct(clade[i]), clade[i], counts[i], taxonomy.ranks[i],
+                                                       taxonomy.taxids[i], '  ' * int(taxonomy.depths[i]), taxonomy.names[i]))
+        kids = taxonomy.children[taxonomy.childStart[i]:taxonomy.childStart[i + 1]]
+        kids = kids[clade[kids] > 0]
+        if len(kids):
+            # pushed in reverse so that the largest clade is popped first
+            kids = kids[np.argsort(-clade[kids], kind = 'stable')]
+            stack.extend(kids[::-1].tolist())
+    return lines
+
+def build_kreport(taxonomy, krakenOut, reportOut):
+    """Write the kreport of one Kraken2 output file, returns the number of reads."""
+    taxids = read_taxids(krakenOut)
+    unclassified = int(np.count_nonzero(taxids == 0))
+    counts, missing = taxonomy.tally(taxids[taxids != 0])
+    if missing:
+        logging.warning(os.path.basename(krakenOut) + ': ' + str(missing) + ' reads assigned to taxids missing from the taxonomy.')
+    clade = taxonomy.rollup(counts)
+    with open(reportOut, 'w') as f:
+        f.writelines(format_kreport(taxonomy, counts, clade, unclassified, len(taxids)))
+    return len(taxids)
+
+def _build_job(job):
+    return build_kreport(pool_taxonomy(), job[0], job[1])
+
+def submit_kreport(pool, krakenOut, reportOut, callback = None, error_callback = None):
+    """Build one kreport in a taxonomy_pool, callback gets the number of reads."""
+    return pool.apply_async(_build_job, ((krakenOut, reportOut),), callback = callback, error_callback = error_callback)
+
+def build_kreports(taxonomy, jobs, threads = 1, pool = None):
+    """Build the kreports of a list of (krakenOut, reportOut) pairs.
+
+    They are built in pool, a taxonomy_pool of taxonomy, when given, else
+    in forked workers when threads > 1.
+    """
+    t0 = time.time()
+    if pool is not None:
+        reads = pool.map(_build_job, jobs, chunksize = 1)
+    elif threads > 1 and len(jobs) > 1:
+        # workers are forked after the taxonomy is loaded, so they share its pages
+        with taxonomy_pool(taxonomy, min(threads, len(jobs))) as p:
+            reads = p.map(_build_job, jobs, chunksize = 1)
+    else:
+        reads = [build_kreport(taxonomy, k, r) for k, r in jobs]
+    logging.info(str(len(jobs)) + ' kreports (' + str(sum(reads)) + ' reads) built in ' + '{:.2f}'.format(time.time() - t0) + ' s')
+    return reads
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'kreport_builder',
+                                     description = 'Build kreports from Kraken2 outputs with a taxonomy loaded once.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', type = str, nargs = '+', required = True,
+                        help = 'Kraken2 output files, <name>out.txt gives <name>kreport.txt.')
+    parser.add_argument('-t', '--taxonomy', type = str, required = True,
+                        help = 'The taxonomy file made by make_ktaxonomy.py.')
+    parser.add_argument('-o', '--output', type = str, default = '.',
+                        help = 'A directory for saving the kreports.')
+    parser.add_argument('-p', '--processes', type = int, default = 1,
+                        help = 'Number of worker processes.')
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s > %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S')
+    taxonomy = KTaxonomy.from_ktaxonomy(opt.taxonomy)
+    jobs = [(k, os.path.join(opt.output, re.sub(r'out\.txt$', '', os.path.basename(k)) + 'kreport.txt')) for k in opt.input]
+    build_kreports(taxonomy, jobs, opt.processes)
+
+if __name__ == '__main__':
+    main()
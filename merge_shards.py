@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Combine the shards of a sharded kraken2M run (kraken2M.py --shard
+# I/N, each in <output>/shard_I_of_N) into <output>. Every shard must
+# have finished with the sample list of the saved plan (shards.json)
+# and left the out.txt and kreport.txt of all its samples, otherwise
+# nothing is merged. The per-sample files (and confidence sweeps) are
+# hard-linked into <output>, falling back to copies across file
+# systems, the logs are concatenated, the metrics records pooled with
+# a new summary, and the abundance matrix of all samples is built when
+# the shards were run with --matrix.
+#################################################################
+import argparse, os, re, sys, json, time, shutil, logging
+from argparse import ArgumentDefaultsHelpFormatter
+from batch_scheduler import shard_dir
+from stage_metrics import StageMetrics
+from kreport_builder import KTaxonomy
+from taxonomy_cache import load_taxonomy_cache
+from abundance_matrix import matrix_from_outputs, matrix_from_kreports
+
+PLAN = 'shards.json'
+# what follows the sample name in the per-sample files of kraken2M.py
+SAMPLE_FILE = re.compile(r'^(out\.txt|out\.k2b|kreport\.txt|(un)?classified_seqs(_[12])?\.fastq(\.gz)?)$')
+
+def load_plan(outDir):
+    with open(os.path.join(outDir, PLAN)) as f:
+        return json.load(f)
+
+def check_shards(outDir, plan):
+    """Return (shard records, problems), the run can be merged only without problems."""
+    records, problems = [], []
+    n = plan['shards']
+    for k in range(1, n + 1):
+        d = shard_dir(outDir, k, n)
+        path = os.path.join(d, 'shard.json')
+        if not os.path.isfile(path):
+            problems.append('shard ' + str(k) + '/' + str(n) + ' has not finished (no ' + path + ')')
+            continue
+        with open(path) as f:
+            rec = json.load(f)
+        records.append(rec)
+        if not rec['ok']:
+            problems.append('shard ' + str(k) + '/' + str(n) + ' failed, see ' + os.path.join(d, 'log.log'))
+        elif rec['samples'] != plan['plan'][k - 1]:
+            problems.append('shard ' + str(k) + '/' + str(n) + ' was run with another sample list than ' + PLAN)
+        else:
+            for t in rec['targets']:
+                for s in rec['samples']:
+                    for f in ('out.txt', 'kreport.txt'):
+                        if not os.path.isfile(os.path.join(d, t['dir'], s + f)):
+                            problems.append('shard ' + str(k) + '/' + str(n) + ' misses ' + os.path.join(t['dir'], s + f))
+    if len(set(json.dumps(r['targets']) for r in records)) > 1:
+        problems.append('the shards were run against different DBs')
+    return records, problems
+
+def sample_files(dirPath, samples):
+    """Return the names of the per-sample files in dirPath."""
+    # the longest matching name wins, so sample1 does not take the files of sample10
+    names = sorted(samples, key = len, reverse = True)
+    res = []
+    for f in sorted(os.listdir(dirPath)):
+        for s in names:
+            if f.startswith(s) and SAMPLE_FILE.match(f[len(s):]):
+                res.append(f)
+                break
+    return res
+
+def link(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def merge_outputs(outDir, records):
+    """Link the per-sample files of every shard and DB into outDir, returns the number of files."""
+    n = 0
+    for rec in records:
+        d = shard_dir(outDir, rec['shard'], rec['of'])
+        for t in rec['targets']:
+            src = os.path.normpath(os.path.join(d, t['dir']))
+            dst = os.path.normpath(os.path.join(outDir, t['dir']))
+            subDirs = ['']
+            sweepDir = os.path.join(src, 'confidence_sweep')
+            if os.path.isdir(sweepDir):
+                subDirs += [os.path.join('confidence_sweep', c) for c in sorted(os.listdir(sweepDir))]
+            for sub in subDirs:
+                os.makedirs(os.path.join(dst, sub), exist_ok = True)
+                for f in sample_files(os.path.join(src, sub), rec['samples']):
+                    link(os.path.join(src, sub, f), os.path.join(dst, sub, f))
+                    n += 1
+    return n
+
+def merge_logs(outDir, records):
+    with open(os.path.join(outDir, 'log.log'), 'w') as out:
+        for rec in records:
+            out.write('#' * 15 + ' shard ' + str(rec['shard']) + '/' + str(rec['of']) + ' ' + '#' * 15 + '\n')
+            with open(os.path.join(shard_dir(outDir, rec['shard'], rec['of']), 'log.log')) as f:
+                shutil.copyfileobj(f, out)
+
+def merge_metrics(outDir, records):
+    """Pool the metrics records of the shards into outDir/metrics.json, returns the summed StageMetrics."""
+    metrics = StageMetrics(os.path.join(outDir, 'metrics.json'))
+    data = {'started': None, 'wall_s': 0.0, 'shards': []}
+    for rec in records:
+        with open(os.path.join(shard_dir(outDir, rec['shard'], rec['of']), 'metrics.json')) as f:
+            m = json.load(f)
+        for r in m['stages']:
+            r['shard'] = rec['shard']
+            metrics.records.append(r)
+        for stage, samples in m.get('samples', dict()).items():
+            metrics.samples.setdefault(stage, dict()).update(samples)
+        data['shards'].append({'shard': rec['shard'], 'started': m['started'], 'wall_s': m['wall_s']})
+        data['started'] = min(data['started'] or m['started'], m['started'])
+        # the shards run side by side, the run takes as long as the slowest one
+        data['wall_s'] = max(data['wall_s'], m['wall_s'])
+    data.update({'summary': metrics.summary(), 'stages': metrics.records})
+    if metrics.samples:
+        data['samples'] = metrics.samples
+    with open(metrics.path + '.tmp', 'w') as f:
+        json.dump(data, f, indent = 1)
+    os.replace(metrics.path + '.tmp', metrics.path)
+    return metrics
+
+def merge_matrices(outDir, records, samples, threads = 1):
+    """Build the abundance matrix of every DB over all samples, in the order of the plan."""
+    rec = records[0]
+    for t in rec['targets']:
+        dst = os.path.normpath(os.path.join(outDir, t['dir']))
+        if rec['engine'] == 'builtin':
+            if os.path.isfile(t['db'] + '/taxonomy/nodes.dmp'):
+                taxonomy = load_taxonomy_cache(t['db'])
+            else:
+                taxonomy = KTaxonomy.from_ktaxonomy(t['db'] + '/mydb_taxonomy.txt')
+            matrix = matrix_from_outputs(taxonomy, [os.path.join(dst, s + 'out.txt') for s in samples], threads)
+        else:
+            matrix = matrix_from_kreports([os.path.join(dst, s + 'kreport.txt') for s in samples])
+        matrix.save(os.path.join(dst, 'abundance_matrix.npz'))
+        logging.info(t['name'] + ': ' + str(matrix.shape[0]) + ' samples x ' + str(matrix.shape[1]) + ' taxa saved to ' + dst + '/abundance_matrix.npz')
+
+def merge(outDir, threads = 1):
+    """Merge the shards of outDir, returns the list of problems that kept it from merging."""
+    t0 = time.time()
+    plan = load_plan(outDir)
+    records, problems = check_shards(outDir, plan)
+    if problems:
+        for p in problems:
+            logging.error(p)
+        return problems
+    files = merge_outputs(outDir, records)
+    logging.info(str(files) + ' per-sample files of ' + str(len(plan['samples'])) + ' samples from ' + str(len(records)) + ' shards')
+    merge_logs(outDir, records)
+    metrics = merge_metrics(outDir, records)
+    for line in metrics.table():
+        logging.info(line)
+    if records[0]['matrix']:
+        merge_matrices(outDir, records, plan['samples'], threads)
+    logging.info('merged in ' + '{:.2f}'.format(time.time() - t0) + ' s')
+    return []
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'merge_shards',
+                                     description = 'Check and merge the shards of a kraken2M.py --shard run.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-o', '--output', type = str, default = './kraken2_output',
+                        help = 'The --output directory given to every shard.')
+    parser.add_argument('-p', '--processes', type = int, default = 1,
+                        help = 'Number of worker processes for the abundance matrix.')
+    parser.add_argument('--check', action = 'store_true',
+                        help = 'Only check that every shard finished, do not merge.')
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s > %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S')
+    outDir = os.path.abspath(opt.output)
+    if not os.path.isfile(os.path.join(outDir, PLAN)):
+        parser.error('No ' + PLAN + ' in ' + outDir + ', was kraken2M.py run with --shard?')
+    if opt.check:
+        _, problems = check_shards(outDir, load_plan(outDir))
+        for p in problems:
+            logging.error(p)
+        if not problems:
+            logging.info('All shards finished.')
+    else:
+        problems = merge(outDir, opt.processes)
+    if problems:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Resume manifest of a kraken2M run. For every stage and key (a sample
+# or a work directory) it records the fingerprints (size, mtime) of the
+# inputs, the parameters, the size of every output and extra facts such
+# as line counts. A unit of work is skipped on a rerun only if it was
+# completed with the same inputs and parameters and its outputs are
+# still there with the recorded sizes.
+#################################################################
+import os, json, time, logging, threading
+
+def fingerprints(paths):
+    """Return {abspath: [size, mtime]} of the given files, None for missing ones."""
+    res = dict()
+    for p in paths:
+        try:
+            st = os.stat(p)
+            res[os.path.abspath(p)] = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            res[os.path.abspath(p)] = None
+    return res
+
+class RunManifest(object):
+    """Stage records kept in a JSON file, saved atomically after every change."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stages = dict()
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.stages = json.load(f).get('stages', dict())
+            except ValueError:
+                logging.warning('Ignoring the broken run manifest ' + path + ', everything will be redone.')
+
+    def get(self, stage, key):
+        return self.stages.get(stage, dict()).get(key)
+
+    def is_complete(self, stage, key, inputs, params = None):
+        """True if stage was completed for key with the same inputs and params and its outputs are unchanged."""
+        entry = self.get(stage, key)
+        if entry is None or entry.get('status') != 'done':
+            return False
+        if entry.get('params') != params or entry.get('inputs') != fingerprints(inputs):
+            return False
+        for p, size in entry.get('outputs', dict()).items():
+            if not os.path.isfile(p) or os.path.getsize(p) != size:
+                return False
+        return True
+
+    def start(self, stage, key):
+        """Mark stage as running for key, so an interrupted unit is never mistaken for a finished one."""
+        with self.lock:
+            self.stages.setdefault(stage, dict())[key] = {'status': 'running', 'started': time.strftime('%Y-%m-%d %H:%M:%S')}
+            self._save()
+
+    def record(self, stage, key, inputs, outputs, params = None, **extra):
+        """Mark stage as done for key, taking the fingerprints of inputs and the sizes of outputs now."""
+        entry = {'status': 'done', 'inputs': fingerprints(inputs), 'params': params,
+                 'outputs': {os.path.abspath(p): os.path.getsize(p) for p in outputs},
+                 'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+        entry.update(extra)
+        with self.lock:
+            old = self.stages.setdefault(stage, dict()).get(key)
+            if old and 'started' in old:
+                entry['started'] = old['started']
+            self.stages[stage][key] = entry
+            self._save()
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'stages': self.stages}, f, indent = 1)
+        os.replace(tmp, self.path)
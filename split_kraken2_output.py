@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Split the combined Kraken2 output.txt back into one file per sample.
+# The boundaries are walked in order with a cursor and the data is
+# copied in large blocks, so the cost is linear in the size of
+# output.txt and does not depend on the number of samples. OutputTailer
+# does the same while Kraken2 is still writing output.txt, handing each
+# sample over as soon as its last line is there. Both can write the
+# compact <sample>out.k2b form (binary_output.py) in the same pass.
+#################################################################
+import argparse, os, sys, time, logging, threading
+from argparse import ArgumentDefaultsHelpFormatter
+import numpy as np
+from binary_output import BinaryOutputWriter, SUFFIX as BINARY_SUFFIX
+
+BLOCK_SIZE = 16 * 1024 * 1024
+
+class LineBlock(object):
+    """A block of a line-based file, consumed from the front.
+
+    The offsets just after its newlines are found once, with NumPy, so
+    cutting the next n lines off is an index lookup rather than a search.
+    """
+    def __init__(self, data = b''):
+        self.data = data
+        self.ends = np.flatnonzero(np.frombuffer(data, dtype = np.uint8) == 10) + 1
+        self.start = 0
+        self.line = 0
+
+    def __len__(self):
+        return len(self.data) - self.start
+
+    def lines(self):
+        """The number of newlines left."""
+        return len(self.ends) - self.line
+
+    def take(self, n = None):
+        """Remove and return the next n lines, or all that is left (with a partial last line) if n is None."""
+        if n is None:
+            cut = len(self.data)
+            self.line = len(self.ends)
+        else:
+            cut = int(self.ends[self.line + n - 1]) if n > 0 else self.start
+            self.line += n
+        res = self.data[self.start:cut]
+        self.start = cut
+        return res
+
+class SampleFile(object):
+    """The text file of a sample, also fed to a BinaryOutputWriter when binary is 'taxids' or 'full'."""
+    def __init__(self, outDir, name, outSuffix, binary = None):
+        self.f = open(os.path.join(outDir, name + outSuffix), 'wb')
+        self.binary = BinaryOutputWriter(os.path.join(outDir, name + BINARY_SUFFIX), binary == 'full') if binary else None
+
+    def write(self, data):
+        self.f.write(data)
+        if self.binary is not None:
+            self.binary.write(data)
+
+    def close(self):
+        self.f.close()
+        if self.binary is not None:
+            self.binary.close()
+
+class SkippedSample(object):
+    """Stands for a sample whose files are kept, its lines are passed over."""
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+def open_sample(outDir, name, outSuffix, binary, skip):
+    return SkippedSample() if name in skip else SampleFile(outDir, name, outSuffix, binary)
+
+def split_output(outputPath, outDir, sampleNames, readCounts, outSuffix = 'out.txt', blockSize = BLOCK_SIZE, binary = None, skip = ()):
+    """Copy readCounts[i] lines of outputPath into outDir/<sampleNames[i]><outSuffix>.
+
+    Returns the number of lines written for each sample, a sample whose
+    count does not match its readCounts entry is logged as an error.
+    With binary ('taxids' or 'full', i.e. with the hit lists) every
+    sample also gets its <sample>out.k2b. The lines of the samples in
+    skip are passed over (and counted) without touching their files.
+    """
+    if len(sampleNames) != len(readCounts):
+        raise ValueError('sampleNames and readCounts must have the same length.')
+    t0 = time.time()
+    written = [0] * len(sampleNames)
+    totalLines = 0
+    ind = 0
+    spOUT = None
+    with open(outputPath, 'rb') as resF:
+        block = LineBlock()
+        while ind < len(sampleNames):
+            if spOUT is None:
+                fh = sampleNames[ind]
+                logging.info(str(ind+1) + '/' + str(len(sampleNames)) + ': output.txt -> ' + fh + outSuffix + (' (kept)' if fh in skip else ''))
+                spOUT = open_sample(outDir, fh, outSuffix, binary, skip)
+            if not block:
+                block = LineBlock(resF.read(blockSize))
+                if not block:
+                    break
+            need = readCounts[ind] - written[ind]
+            nlines = block.lines()
+            if nlines < need:
+                # the rest of the block belongs to the current sample
+                spOUT.write(block.take())
+                written[ind] += nlines
+                totalLines += nlines
+                continue
+            spOUT.write(block.take(need))
+            written[ind] += need
+            totalLines += need
+            spOUT.close()
+            spOUT = None
+            ind += 1
+        if spOUT is not None:
+            # output.txt ended before the current sample was complete
+            spOUT.close()
+        elif block or resF.read(1):
+            logging.warning('output.txt has more lines than the sum of read counts, the extra lines are ignored.')
+    # samples never reached because output.txt was too short still get an (empty) file
+    for j in range(ind + 1, len(sampleNames)):
+        open_sample(outDir, sampleNames[j], outSuffix, binary, skip).close()
+    for j, s in enumerate(sampleNames):
+        if written[j] != readCounts[j]:
+            logging.error(s + outSuffix + ': expected ' + str(readCounts[j]) + ' lines but got ' + str(written[j]) + '.')
+    elapsed = time.time() - t0
+    rate = totalLines / elapsed if elapsed > 0 else float('inf')
+    logging.info('split ' + str(totalLines) + ' lines in ' + '{:.2f}'.format(elapsed) + ' s (' + '{:.0f}'.format(rate) + ' lines/s)')
+    return written
+
+class OutputTailer(threading.Thread):
+    """Split output.txt into per-sample files while it is being written.
+
+    readCount(i) returns the read count of sample i, or None while it is
+    not known yet (e.g. the sample is still being streamed). onSample(i,
+    lines) is called from this thread as soon as sample i is complete,
+    except for the samples in skip, whose lines are passed over without
+    touching their files. Call finish() once the writer of output.txt has
+    exited, then join().
+    """
+    def __init__(self, outputPath, outDir, sampleNames, readCount, onSample = None,
+                 outSuffix = 'out.txt', blockSize = BLOCK_SIZE, poll = 0.5, binary = None, skip = ()):
+        threading.Thread.__init__(self, daemon = True)
+        self.outputPath = outputPath
+        self.outDir = outDir
+        self.sampleNames = sampleNames
+        self.readCount = readCount
+        self.onSample = onSample
+        self.outSuffix = outSuffix
+        self.blockSize = blockSize
+        self.poll = poll
+        self.binary = binary
+        self.skip = skip
+        self.written = [0] * len(sampleNames)
+        self.writerDone = threading.Event()
+        self.error = None
+
+    def finish(self):
+        self.writerDone.set()
+
+    def read(self, f):
+        """Return the next block, waiting for the writer; b'' once it exited and everything was read."""
+        while True:
+            block = f.read(self.blockSize)
+            if block:
+                return block
+            if self.writerDone.is_set():
+                # whatever was written before the writer exited
+                return f.read(self.blockSize)
+            self.writerDone.wait(self.poll)
+
+    def run(self):
+        try:
+            self.follow()
+        except Exception as e:
+            self.error = e
+            logging.error('Following ' + self.outputPath + ' failed: ' + str(e))
+
+    def follow(self):
+        t0 = time.time()
+        while not os.path.exists(self.outputPath):
+            if self.writerDone.is_set():
+                return
+            self.writerDone.wait(self.poll)
+        ind = 0
+        spOUT = None
+        with open(self.outputPath, 'rb') as resF:
+            block = LineBlock()
+            while ind < len(self.sampleNames):
+                need = self.readCount(ind)
+                if need is None:
+                    if self.writerDone.is_set() and self.readCount(ind) is None:
+                        logging.error('The read count of ' + self.sampleNames[ind] + ' never came, stop following ' + self.outputPath + '.')
+                        break
+                    self.writerDone.wait(self.poll)
+                    continue
+                if spOUT is None:
+                    spOUT = open_sample(self.outDir, self.sampleNames[ind], self.outSuffix, self.binary, self.skip)
+                left = need - self.written[ind]
+                if left > 0:
+                    if not block:
+                        block = LineBlock(self.read(resF))
+                        if not block:
+                            break
+                    nlines = block.lines()
+                    if nlines < left:
+                        spOUT.write(block.take())
+                        self.written[ind] += nlines
+                        continue
+                    spOUT.write(block.take(left))
+                    self.written[ind] += left
+                spOUT.close()
+                spOUT = None
+                if self.onSample is not None and self.sampleNames[ind] not in self.skip:
+                    self.onSample(ind, self.written[ind])
+                ind += 1
+            if spOUT is not None:
+                spOUT.close()
+        for j in range(ind + 1, len(self.sampleNames)):
+            open_sample(self.outDir, self.sampleNames[j], self.outSuffix, self.binary, self.skip).close()
+        for j, s in enumerate(self.sampleNames):
+            n = self.readCount(j)
+            if n is not None and self.written[j] != n:
+                logging.error(s + self.outSuffix + ': expected ' + str(n) + ' lines but got ' + str(self.written[j]) + '.')
+        logging.info('followed ' + os.path.basename(self.outputPath) + ' into ' + str(ind) + ' samples (' + str(sum(self.written)) + ' lines) in ' + '{:.2f}'.format(time.time() - t0) + ' s')
+
+def read_sample_reads(path):
+    """Load a two-column tab separated file of sample name and read count."""
+    sampleNames, readCounts = [], []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                s, n = line.rstrip('\n').split('\t')[:2]
+                sampleNames.append(s)
+                readCounts.append(int(n))
+    return sampleNames, readCounts
+
+def write_sample_reads(path, sampleNames, readCounts):
+    with open(path, 'w') as f:
+        for s, n in zip(sampleNames, readCounts):
+            f.write(s + '\t' + str(n) + '\n')
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'split_kraken2_output',
+                                     description = 'Split a combined Kraken2 output.txt into one <sample>out.txt per sample.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input', type = str, required = True,
+                        help = 'The combined Kraken2 output.txt.')
+    parser.add_argument('-c', '--counts', type = str, required = True,
+                        help = 'A two-column tab separated file of sample name and read count, in the order of output.txt.')
+    parser.add_argument('-o', '--output', type = str, default = '.',
+                        help = 'A directory for saving the per-sample files.')
+    parser.add_argument('--binary', type = str, default = None, choices = ['taxids', 'full'],
+                        help = 'Also write <sample>out.k2b, with the k-mer hit lists for full.')
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s > %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S')
+    sampleNames, readCounts = read_sample_reads(opt.counts)
+    written = split_output(opt.input, opt.output, sampleNames, readCounts, binary = opt.binary)
+    if written != readCounts:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
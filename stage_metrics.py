@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Per-stage profiling of a kraken2M run: wall time, CPU time of the
+# process and of its children (e.g. Kraken2), peak RSS, bytes read and
+# written and reads/s. Records are saved to a JSON file and summed by
+# stage into a summary table at the end of the run.
+#################################################################
+import os, sys, json, time, logging, resource, threading
+from contextlib import contextmanager
+
+def io_counters():
+    """Return (read_bytes, write_bytes) of this process from /proc/self/io, (0, 0) where unavailable."""
+    try:
+        with open('/proc/self/io') as f:
+            vals = dict(line.split(': ') for line in f.read().splitlines())
+        return int(vals['read_bytes']), int(vals['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def peak_rss_mb(usage):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return usage.ru_maxrss / scale
+
+class StageMetrics(object):
+    """Collect one record per stage run, and optionally per-sample values."""
+    def __init__(self, path, perSample = False):
+        self.path = path
+        self.perSample = perSample
+        self.records = []
+        self.samples = dict()
+        self.lock = threading.Lock()
+        self.t0 = time.time()
+
+    @contextmanager
+    def stage(self, name, key = ''):
+        """Measure the body of a with statement, which may fill reads/bytes_in/bytes_out of the yielded dict.
+
+        CPU and IO are counted for the whole process, so stages that
+        overlap in threads share them.
+        """
+        rec = {'stage': name, 'key': key, 'reads': 0, 'bytes_in': 0, 'bytes_out': 0}
+        wall = time.time()
+        selfUsage = resource.getrusage(resource.RUSAGE_SELF)
+        childUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        ioRead, ioWrite = io_counters()
+        try:
+            yield rec
+        finally:
+            selfEnd = resource.getrusage(resource.RUSAGE_SELF)
+            childEnd = resource.getrusage(resource.RUSAGE_CHILDREN)
+            ioReadEnd, ioWriteEnd = io_counters()
+            rec['wall_s'] = round(time.time() - wall, 3)
+            rec['cpu_s'] = round(selfEnd.ru_utime - selfUsage.ru_utime + selfEnd.ru_stime - selfUsage.ru_stime, 3)
+            rec['children_cpu_s'] = round(childEnd.ru_utime - childUsage.ru_utime + childEnd.ru_stime - childUsage.ru_stime, 3)
+            rec['peak_rss_mb'] = round(peak_rss_mb(selfEnd), 1)
+            rec['children_peak_rss_mb'] = round(peak_rss_mb(childEnd), 1)
+            rec['read_bytes'] = ioReadEnd - ioRead
+            rec['write_bytes'] = ioWriteEnd - ioWrite
+            rec['reads_per_s'] = round(rec['reads'] / rec['wall_s'], 1) if rec['wall_s'] > 0 else 0
+            with self.lock:
+                self.records.append(rec)
+                self.save()
+
+    def sample(self, stage, sample, **values):
+        """Add per-sample values (e.g. reads, bytes) of a stage, kept only with perSample."""
+        if not self.perSample:
+            return
+        with self.lock:
+            self.samples.setdefault(stage, dict()).setdefault(sample, dict()).update(values)
+
+    def summary(self):
+        """Return the records summed by stage, in the order the stages first ran."""
+        res = dict()
+        for r in self.records:
+            s = res.setdefault(r['stage'], {'stage': r['stage'], 'runs': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'children_cpu_s': 0.0,
+                                            'peak_rss_mb': 0.0, 'children_peak_rss_mb': 0.0, 'read_bytes': 0, 'write_bytes': 0, 'bytes_in': 0, 'bytes_out': 0, 'reads': 0})
+            s['runs'] += 1
+            for k in ('wall_s', 'cpu_s', 'children_cpu_s', 'read_bytes', 'write_bytes', 'bytes_in', 'bytes_out', 'reads'):
+                s[k] += r[k]
+            s['peak_rss_mb'] = max(s['peak_rss_mb'], r['peak_rss_mb'])
+            s['children_peak_rss_mb'] = max(s['children_peak_rss_mb'], r['children_peak_rss_mb'])
+        for s in res.values():
+            s['reads_per_s'] = round(s['reads'] / s['wall_s'], 1) if s['wall_s'] > 0 else 0
+            for k in ('wall_s', 'cpu_s', 'children_cpu_s'):
+                s[k] = round(s[k], 3)
+        return list(res.values())
+
+    def save(self):
+        data = {'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.t0)),
+                'wall_s': round(time.time() - self.t0, 3), 'summary': self.summary(), 'stages': self.records}
+        if self.perSample:
+            data['samples'] = self.samples
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent = 1)
+        os.replace(tmp, self.path)
+
+    def table(self):
+        """Return the summary as aligned text lines."""
+        cols = ['stage', 'runs', 'wall_s', 'cpu_s', 'children_cpu_s', 'peak_rss_mb', 'children_peak_rss_mb', 'read_bytes', 'write_bytes', 'bytes_in', 'bytes_out', 'reads', 'reads_per_s']
+        rows = [cols] + [[str(s[c]) for c in cols] for s in self.summary()]
+        widths = [max(len(r[j]) for r in rows) for j in range(len(cols))]
+        return ['  '.join(v.rjust(w) if j else v.ljust(w) for j, (v, w) in enumerate(zip(r, widths))) for r in rows]
+
+    def report(self):
+        """Save the metrics and log the summary table."""
+        with self.lock:
+            self.save()
+        for line in self.table():
+            logging.info(line)
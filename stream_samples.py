@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# Feed all samples to Kraken2 in order through named pipes (FIFOs)
+# instead of concatenating them into tmp/ first. One writer thread per
+# mate copies the sample files into its FIFO (inflating gzip input on
+# the way) and counts the reads of every sample as the data flows.
+#################################################################
+import os, zlib, errno, logging, threading
+from count_reads import BLOCK_SIZE, is_gzip
+
+# longest wait between two attempts to open a FIFO that has no reader yet
+OPEN_POLL = 0.05
+
+class MateWriter(threading.Thread):
+    """Write the files of one mate into a FIFO, counting the lines of each file."""
+    def __init__(self, srcPaths, fifoPath, gzipped = None, blockSize = BLOCK_SIZE, aborted = None):
+        threading.Thread.__init__(self, daemon = True)
+        self.srcPaths = srcPaths
+        self.fifoPath = fifoPath
+        self.gzipped = gzipped
+        self.blockSize = blockSize
+        self.aborted = aborted or threading.Event()
+        self.lines = []
+        self.error = None
+
+    def open_fifo(self):
+        """Open the FIFO for writing as soon as a reader has it open, None if aborted before."""
+        delay = 0.001
+        while not self.aborted.is_set():
+            try:
+                fd = os.open(self.fifoPath, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                # ENXIO: no reader yet
+                if e.errno != errno.ENXIO:
+                    raise
+                self.aborted.wait(delay)
+                delay = min(delay * 2, OPEN_POLL)
+                continue
+            os.set_blocking(fd, True)
+            return os.fdopen(fd, 'wb')
+        return None
+
+    def run(self):
+        try:
+            fo = self.open_fifo()
+            if fo is None:
+                self.error = OSError(errno.ENXIO, 'aborted before Kraken2 opened the FIFO')
+                return
+            with fo:
+                for src in self.srcPaths:
+                    self.lines.append(self.copy(src, fo))
+        except OSError as e:
+            # BrokenPipeError when Kraken2 went away before reading everything
+            self.error = e
+
+    def copy(self, src, fo):
+        gzipped = is_gzip(src) if self.gzipped is None else self.gzipped
+        dec = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        n = 0
+        with open(src, 'rb', buffering = 0) as fi:
+            while True:
+                block = fi.read(self.blockSize)
+                if not block:
+                    break
+                while dec is not None and block:
+                    data = dec.decompress(block)
+                    n += data.count(b'\n')
+                    fo.write(data)
+                    if not dec.eof:
+                        break
+                    block = dec.unused_data
+                    dec = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                if dec is None:
+                    n += block.count(b'\n')
+                    fo.write(block)
+        return n
+
+class SampleStreamer(object):
+    """Stream samples mate by mate into FIFOs created under fifoDir.
+
+    mates is a list of one (single-end) or two (paired-end) lists of
+    files, all in the same sample order. Kraken2 gets the plain text
+    stream, so it must not be run with --gzip-compressed.
+    """
+    def __init__(self, mates, fifoDir, gzipped = None):
+        self.fifoPaths = []
+        self.writers = []
+        self.aborted = threading.Event()
+        for j, srcPaths in enumerate(mates):
+            fifo = os.path.join(fifoDir, 'mate' + str(j + 1) + '.fifo')
+            if os.path.exists(fifo):
+                os.remove(fifo)
+            os.mkfifo(fifo)
+            self.fifoPaths.append(fifo)
+            self.writers.append(MateWriter(srcPaths, fifo, gzipped, aborted = self.aborted))
+
+    def start(self):
+        for w in self.writers:
+            w.start()
+
+    def abort(self):
+        """Stop the writers still waiting for a reader, e.g. when Kraken2 failed to start.
+
+        Writers that already opened their FIFO end with a broken pipe once
+        Kraken2 has exited.
+        """
+        self.aborted.set()
+
+    def count(self, i):
+        """The read count of sample i once it is fully streamed, else None."""
+        lines = self.writers[0].lines
+        return lines[i] // 4 if i < len(lines) else None
+
+    def join(self, timeout = 60):
+        """Wait for the writers, remove the FIFOs and return the read count of each sample."""
+        for w in self.writers:
+            w.join(timeout)
+        for fifo in self.fifoPaths:
+            if os.path.exists(fifo):
+                os.remove(fifo)
+        for w in self.writers:
+            if w.is_alive():
+                # a daemon thread, it does not keep kraken2M from exiting
+                raise RuntimeError('Streaming into ' + w.fifoPath + ' did not stop within ' + str(timeout) + ' s')
+            if w.error is not None:
+                raise RuntimeError('Streaming into ' + w.fifoPath + ' failed: ' + str(w.error))
+        counts = [n // 4 for n in self.writers[0].lines]
+        for w in self.writers[1:]:
+            if [n // 4 for n in w.lines] != counts:
+                logging.warning('The mates of some samples have different read counts.')
+        return counts
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#################################################################
+# A compact binary taxonomy cache kept next to the Kraken2 DB.
+# nodes.dmp and names.dmp are parsed once into NumPy arrays (parent,
+# depth, rank code and scientific name tables plus the derived taxid
+# index, depth order and children) saved as .npy files under
+# <db>/taxonomy_cache. Loading memory-maps them, so a lookup touches
+# only the pages it needs. The cache is rebuilt automatically when the
+# size or mtime of a source .dmp file changes. Every build goes to a new
+# version directory, taxonomy_cache/v1.XXXXXXXX, published by replacing
+# taxonomy_cache/current. Builders hold an exclusive flock on
+# taxonomy_cache/lock and readers a shared one while they open a version.
+#################################################################
+import argparse, os, sys, json, time, fcntl, shutil, logging, tempfile, contextlib
+import multiprocessing
+from argparse import ArgumentDefaultsHelpFormatter
+import numpy as np
+
+CACHE_DIR = 'taxonomy_cache'
+CACHE_VERSION = 1
+# names of the lock file and of the file pointing to the published version, in CACHE_DIR
+LOCK = 'lock'
+CURRENT = 'current'
+# rank names of nodes.dmp with a one letter Kraken2 report code
+RANK_CODES = {'superkingdom': 'D', 'domain': 'D', 'kingdom': 'K', 'phylum': 'P', 'class': 'C',
+              'order': 'O', 'family': 'F', 'genus': 'G', 'species': 'S'}
+ARRAYS = ['taxids', 'parents', 'depths', 'index', 'order', 'levelBounds', 'childStart', 'children',
+          'rankBlob', 'rankOffsets', 'nameBlob', 'nameOffsets']
+
+class StringTable(object):
+    """Strings stored as one utf-8 blob and an offset table, decoded on access."""
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    @classmethod
+    def build(cls, strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype = np.int64)
+        np.cumsum([len(e) for e in encoded], out = offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype = np.uint8), offsets)
+
+def source_paths(dbDir):
+    return [os.path.join(dbDir, 'taxonomy', 'nodes.dmp'), os.path.join(dbDir, 'taxonomy', 'names.dmp')]
+
+def source_fingerprints(dbDir):
+    res = dict()
+    for p in source_paths(dbDir):
+        st = os.stat(p)
+        res[os.path.basename(p)] = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+    return res
+
+def read_dmp(path, columns):
+    """Yield the given columns of a NCBI .dmp file."""
+    with open(path, encoding = 'utf-8') as f:
+        for line in f:
+            vals = line.rstrip('\t|\n').split('\t|\t')
+            yield [vals[c] for c in columns]
+
+def build_arrays(nodesPath, namesPath):
+    """Parse nodes.dmp and names.dmp into the arrays of the cache."""
+    taxids, parentTaxids, rankNames = [], [], []
+    for taxid, parent, rank in read_dmp(nodesPath, (0, 1, 2)):
+        taxids.append(int(taxid))
+        parentTaxids.append(int(parent))
+        rankNames.append(rank)
+    taxids = np.array(taxids, dtype = np.int32)
+    n = len(taxids)
+    index = np.full(int(taxids.max()) + 1, -1, dtype = np.int32)
+    index[taxids] = np.arange(n, dtype = np.int32)
+    parents = index[np.array(parentTaxids, dtype = np.int64)]
+    parents[parents == np.arange(n)] = -1
+    names = [''] * n
+    for taxid, name, nameClass in read_dmp(namesPath, (0, 1, 3)):
+        if nameClass == 'scientific name':
+            names[index[int(taxid)]] = name
+    # children in CSR form, kept in nodes.dmp order
+    hasParent = np.nonzero(parents >= 0)[0]
+    children = hasParent[np.argsort(parents[hasParent], kind = 'stable')].astype(np.int32)
+    childStart = np.searchsorted(parents[children], np.arange(n + 1)).astype(np.int64)
+    # walk the tree level by level from the root(s), giving depths and rank codes
+    depths = np.full(n, -1, dtype = np.int32)
+    baseCode = np.array([RANK_CODES.get(r, '') for r in rankNames], dtype = 'U1')
+    offset = np.zeros(n, dtype = np.int32)
+    level = np.nonzero(parents < 0)[0]
+    baseCode[level] = 'R'
+    d = 0
+    order = []
+    levelBounds = [0]
+    while len(level):
+        depths[level] = d
+        order.append(level)
+        levelBounds.append(levelBounds[-1] + len(level))
+        starts = childStart[level]
+        lens = childStart[level + 1] - starts
+        if lens.sum() == 0:
+            break
+        src = np.repeat(level, lens)
+        pos = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens) + np.repeat(starts, lens)
+        nxt = children[pos]
+        # an unranked node takes the code of its parent and one more step of offset
+        unranked = baseCode[nxt] == ''
+        baseCode[nxt[unranked]] = baseCode[src[unranked]]
+        offset[nxt[unranked]] = offset[src[unranked]] + 1
+        level = nxt
+        d += 1
+    if (depths < 0).any():
+        raise ValueError(nodesPath + ' has ' + str(int((depths < 0).sum())) + ' nodes not connected to the root.')
+    ranks = [b + (str(o) if o else '') for b, o in zip(baseCode.tolist(), offset.tolist())]
+    rankTable = StringTable.build(ranks)
+    nameTable = StringTable.build(names)
+    return {'taxids': taxids, 'parents': parents.astype(np.int32), 'depths': depths, 'index': index,
+            'order': np.concatenate(order).astype(np.int32), 'levelBounds': np.array(levelBounds, dtype = np.int64),
+            'childStart': childStart, 'children': children,
+            'rankBlob': rankTable.blob, 'rankOffsets': rankTable.offsets,
+            'nameBlob': nameTable.blob, 'nameOffsets': nameTable.offsets}
+
+def current_dir(dbDir):
+    """Return the published version directory of the cache, None if there is none."""
+    try:
+        with open(os.path.join(dbDir, CACHE_DIR, CURRENT)) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(dbDir, CACHE_DIR, name) if name else None
+
+def cache_is_valid(dbDir, versionDir = None):
+    versionDir = versionDir or current_dir(dbDir)
+    if versionDir is None or not os.path.isfile(os.path.join(versionDir, 'meta.json')):
+        return False
+    with open(os.path.join(versionDir, 'meta.json')) as f:
+        info = json.load(f)
+    return info.get('version') == CACHE_VERSION and info.get('sources') == source_fingerprints(dbDir)
+
+@contextlib.contextmanager
+def cache_lock(dbDir, exclusive):
+    """Hold a flock on <dbDir>/taxonomy_cache/lock, shared while a cache is opened and exclusive while one is built."""
+    root = os.path.join(dbDir, CACHE_DIR)
+    try:
+        os.makedirs(root, exist_ok = True)
+        fd = os.open(os.path.join(root, LOCK), os.O_RDONLY | os.O_CREAT, 0o644)
+    except OSError:
+        if exclusive:
+            raise
+        # a read-only DB, nobody can rebuild its cache either
+        yield
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(fd)
+
+def _build_version(dbDir):
+    """Build a new version of the cache and publish it, the exclusive cache_lock must be held."""
+    t0 = time.time()
+    nodesPath, namesPath = source_paths(dbDir)
+    sources = source_fingerprints(dbDir)
+    arrays = build_arrays(nodesPath, namesPath)
+    root = os.path.join(dbDir, CACHE_DIR)
+    versionDir = tempfile.mkdtemp(prefix = 'v' + str(CACHE_VERSION) + '.', dir = root)
+    try:
+        os.chmod(versionDir, 0o755)
+        for k in ARRAYS:
+            np.save(os.path.join(versionDir, k + '.npy'), arrays[k])
+        with open(os.path.join(versionDir, 'meta.json'), 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'sources': sources, 'nodes': len(arrays['taxids'])}, f, indent = 1)
+    except BaseException:
+        shutil.rmtree(versionDir)
+        raise
+    # readers follow the pointer, so they see the old version or the new one, never a partial one
+    pointer = os.path.join(root, CURRENT)
+    with open(pointer + '.tmp', 'w') as f:
+        f.write(os.path.basename(versionDir) + '\n')
+    os.replace(pointer + '.tmp', pointer)
+    # no reader is between the pointer and its np.load while the lock is held, and the
+    # arrays already memory-mapped by others stay readable after their files are unlinked
+    for f in os.listdir(root):
+        if f not in (LOCK, CURRENT, os.path.basename(versionDir)):
+            p = os.path.join(root, f)
+            if os.path.isdir(p):
+                shutil.rmtree(p)
+            else:
+                os.remove(p)
+    logging.info('Taxonomy cache of ' + str(len(arrays['taxids'])) + ' nodes built in ' + '{:.2f}'.format(time.time() - t0) + ' s')
+    return versionDir
+
+def build_taxonomy_cache(dbDir):
+    """(Re)build <dbDir>/taxonomy_cache from taxonomy/nodes.dmp and names.dmp."""
+    with cache_lock(dbDir, True):
+        return _build_version(dbDir)
+
+def open_cache(versionDir):
+    # kreport_builder imports this module for taxonomy_pool()
+    from kreport_builder import KTaxonomy
+    a = {k: np.load(os.path.join(versionDir, k + '.npy'), mmap_mode = 'r') for k in ARRAYS}
+    return KTaxonomy(a['taxids'], a['parents'], StringTable(a['rankBlob'], a['rankOffsets']), a['depths'],
+                     StringTable(a['nameBlob'], a['nameOffsets']), index = a['index'], order = a['order'],
+                     levelBounds = a['levelBounds'], childStart = a['childStart'], children = a['children'])
+
+def load_taxonomy_cache(dbDir, rebuild = True):
+    """Return the KTaxonomy of a Kraken2 DB from its memory-mapped cache, building the cache if it is stale.
+
+    Safe with several processes loading the same DB, e.g. the shards of a
+    run: one of them builds the cache while the others wait for it.
+    """
+    with cache_lock(dbDir, False):
+        versionDir = current_dir(dbDir)
+        if cache_is_valid(dbDir, versionDir):
+            return open_cache(versionDir)
+    if not rebuild:
+        raise IOError('The taxonomy cache of ' + dbDir + ' is missing or out of date.')
+    with cache_lock(dbDir, True):
+        # another process may have built it while this one waited for the lock
+        versionDir = current_dir(dbDir)
+        if not cache_is_valid(dbDir, versionDir):
+            logging.info('Building the taxonomy cache of ' + dbDir)
+            versionDir = _build_version(dbDir)
+        return open_cache(versionDir)
+
+_poolTaxonomy = None
+
+def _init_worker(taxonomy):
+    global _poolTaxonomy
+    _poolTaxonomy = taxonomy
+
+def pool_taxonomy():
+    """The taxonomy of the taxonomy_pool() running this worker."""
+    return _poolTaxonomy
+
+def taxonomy_pool(taxonomy, processes):
+    """Return a pool of worker processes holding taxonomy (None for jobs that need none), see pool_taxonomy().
+
+    The workers are forked and share the pages of the loaded taxonomy. A
+    process forked while another thread holds a lock (logging, stdio,
+    malloc) can deadlock, so the pool has to be opened before the caller
+    starts any thread, and kept for every job that needs it.
+    """
+    return multiprocessing.get_context('fork').Pool(processes, initializer = _init_worker, initargs = (taxonomy,))
+
+def main(argv = sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog = 'taxonomy_cache',
+                                     description = 'Build the binary taxonomy cache of a Kraken2 DB, or look up lineages with it.',
+                                     formatter_class = ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-d', '--db', type = str, required = True,
+                        help = 'The Kraken2 DB directory, containing taxonomy/nodes.dmp and taxonomy/names.dmp.')
+    parser.add_argument('--force', action = 'store_true',
+                        help = 'Rebuild the cache even if it is up to date.')
+    parser.add_argument('-l', '--lineage', type = int, nargs = '*', default = [],
+                        help = 'Print the lineage of these taxids.')
+    opt = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s > %(message)s',
+                        datefmt = '%Y-%m-%d %H:%M:%S')
+    if opt.force:
+        build_taxonomy_cache(opt.db)
+    taxonomy = load_taxonomy_cache(opt.db)
+    for taxid in opt.lineage:
+        print(str(taxid) + '\t' + ';'.join(taxonomy.ranks[i] + '__' + taxonomy.names[i] for i in taxonomy.lineage(taxid)))
+
+if __name__ == '__main__':
+    main()